@@ -0,0 +1,208 @@
+"""
+本地模拟 Flow2API + 图片服务器 (压测用，不访问外网)
+
+- POST /v1/chat/completions：按真实节奏输出 SSE (首字节延迟、进度文本、分片的图片链接)，
+  可按比例注入 5xx、429 (带 Retry-After) 和慢速流
+- GET  /v1/models：健康检查
+- GET  /img/{name}：JPEG/PNG/GIF 各种尺寸的输入图片，例如 /img/large.png
+
+单独运行：python bench/mock_server.py --port 18080
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+
+from aiohttp import web
+
+try:
+    from PIL import Image as PyImage
+except ImportError:
+    PyImage = None
+
+IMAGE_SIZES = {"small": (256, 256), "medium": (1024, 768), "large": (3000, 2000)}
+IMAGE_FORMATS = {"jpg": "JPEG", "png": "PNG", "gif": "GIF"}
+
+PROGRESS_TEXT = ["正在理解描述…", "正在构图…", "正在渲染细节…", "正在上传结果…"]
+
+
+class MockOptions:
+    """模拟上游的行为参数 (时间单位：秒，比例为 0~1)"""
+
+    def __init__(self, ttfb: float = 1.0, chunk_interval: float = 0.2, chunks: int = 6,
+                 jitter: float = 0.3, fail_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: int = 1, slow_rate: float = 0.0, slow_factor: float = 5.0, seed: int = None):
+        self.ttfb = ttfb
+        self.chunk_interval = chunk_interval
+        self.chunks = max(1, chunks)
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.random = random.Random(seed)
+
+    @classmethod
+    def add_arguments(cls, parser: argparse.ArgumentParser):
+        group = parser.add_argument_group("模拟上游")
+        group.add_argument("--ttfb", type=float, default=1.0, help="首字节延迟 (秒)")
+        group.add_argument("--chunk-interval", type=float, default=0.2, help="SSE 分片间隔 (秒)")
+        group.add_argument("--chunks", type=int, default=6, help="图片链接前的进度分片数")
+        group.add_argument("--jitter", type=float, default=0.3, help="延迟随机浮动比例")
+        group.add_argument("--fail-rate", type=float, default=0.0, help="返回 5xx 的比例")
+        group.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的比例")
+        group.add_argument("--slow-rate", type=float, default=0.0, help="慢速流的比例")
+        group.add_argument("--slow-factor", type=float, default=5.0, help="慢速流的延迟倍数")
+        group.add_argument("--seed", type=int, default=None, help="随机种子 (便于复现)")
+
+    @classmethod
+    def from_args(cls, args) -> "MockOptions":
+        return cls(ttfb=args.ttfb, chunk_interval=args.chunk_interval, chunks=args.chunks, jitter=args.jitter,
+                   fail_rate=args.fail_rate, rate_limit_rate=args.rate_limit_rate, slow_rate=args.slow_rate,
+                   slow_factor=args.slow_factor, seed=args.seed)
+
+    def delay(self, base: float, factor: float = 1.0) -> float:
+        return max(0.0, base * factor * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+
+def make_images() -> dict:
+    """生成各格式各尺寸的测试图片 (噪点 + 渐变，压缩率接近真实照片)"""
+    if PyImage is None:
+        raise RuntimeError("生成测试图片需要安装 Pillow")
+    images = {}
+    for size_name, (w, h) in IMAGE_SIZES.items():
+        noise = PyImage.effect_noise((w, h), 40).convert("RGB")
+        gradient = PyImage.linear_gradient("L").resize((w, h)).convert("RGB")
+        base = PyImage.blend(noise, gradient, 0.6)
+        for ext, fmt in IMAGE_FORMATS.items():
+            buf = io.BytesIO()
+            if fmt == "GIF":
+                frames = [base.rotate(i * 5).convert("P", palette=PyImage.ADAPTIVE) for i in range(3)]
+                frames[0].save(buf, "GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+            elif fmt == "JPEG":
+                base.save(buf, "JPEG", quality=92)
+            else:
+                base.save(buf, "PNG")
+            images[f"{size_name}.{ext}"] = buf.getvalue()
+    return images
+
+
+class MockFlow2API:
+    """模拟服务本体，stats 记录收到的请求和注入的故障"""
+
+    def __init__(self, options: MockOptions, images: dict = None):
+        self.options = options
+        self.images = images if images is not None else make_images()
+        self.stats = {"requests": 0, "ok": 0, "failed": 0, "rate_limited": 0, "slow": 0, "aborted": 0,
+                      "image_requests": 0, "bytes_in": 0}
+        self.base_url = ""
+        self._runner = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_get("/v1/models", self.handle_models)
+        app.router.add_get("/img/{name}", self.handle_image)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle_models(self, request):
+        return web.json_response({"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+
+    async def handle_image(self, request):
+        name = request.match_info["name"]
+        data = self.images.get(name)
+        if data is None:
+            raise web.HTTPNotFound()
+        self.stats["image_requests"] += 1
+        ext = name.rsplit(".", 1)[-1]
+        return web.Response(body=data, content_type="image/jpeg" if ext == "jpg" else f"image/{ext}")
+
+    async def handle_chat(self, request):
+        opts = self.options
+        body = await request.read()
+        self.stats["requests"] += 1
+        self.stats["bytes_in"] += len(body)
+
+        roll = opts.random.random()
+        if roll < opts.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            await asyncio.sleep(opts.delay(0.05))
+            return web.Response(status=429, text='{"error": "RESOURCE_EXHAUSTED: quota exceeded"}',
+                                headers={"Retry-After": str(opts.retry_after)})
+        if roll < opts.rate_limit_rate + opts.fail_rate:
+            self.stats["failed"] += 1
+            await asyncio.sleep(opts.delay(opts.ttfb * 0.5))
+            return web.Response(status=opts.random.choice((500, 502, 503)), text="upstream error")
+
+        factor = 1.0
+        if opts.random.random() < opts.slow_rate:
+            factor = opts.slow_factor
+            self.stats["slow"] += 1
+
+        model = "mock-model"
+        try:
+            model = json.loads(body).get("model", model)
+        except ValueError:
+            pass
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        image_url = f"{self.base_url}/out/{model}/{time.monotonic_ns()}.png"
+        pieces = [PROGRESS_TEXT[i % len(PROGRESS_TEXT)] + "\n" for i in range(opts.chunks)]
+        # 图片链接故意拆在两个分片里，与真实上游一致
+        markdown = f"![image]({image_url})"
+        cut = opts.random.randint(5, len(markdown) - 2)
+        pieces += [markdown[:cut], markdown[cut:]]
+        try:
+            await asyncio.sleep(opts.delay(opts.ttfb, factor))
+            for piece in pieces:
+                event = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": piece}}]}
+                await resp.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(opts.delay(opts.chunk_interval, factor))
+            await resp.write(b"data: [DONE]\n\n")
+            self.stats["ok"] += 1
+        except ConnectionResetError:
+            # 插件拿到链接后会提前断开
+            self.stats["ok"] += 1
+            self.stats["aborted"] += 1
+        return resp
+
+
+async def _serve(args):
+    server = MockFlow2API(MockOptions.from_args(args))
+    url = await server.start(args.host, args.port)
+    print(f"模拟 Flow2API 已启动: {url}/v1/chat/completions")
+    print("测试图片: " + ", ".join(f"{url}/img/{name}" for name in sorted(server.images)))
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟 Flow2API + 图片服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    MockOptions.add_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
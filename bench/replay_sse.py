@@ -0,0 +1,150 @@
+"""
+SSE 回放：把插件录制的上游原始流 (配置 sse_record) 重新喂给 SSEStreamParser
+
+按录制时的节奏 (或加速) 回放，统计解析器 CPU 耗时和出链接时间，并检查
+提取到的图片链接与录制时是否一致，用来给解析/正则的改动做回归测试。
+需要在装有 AstrBot 的环境里运行 (插件本身依赖 astrbot.api)。
+
+示例：
+    python bench/replay_sse.py data/plugin_data/astrbot_plugin_gemini/sse_records
+    python bench/replay_sse.py records/ --speed 0 --repeat 50     # 不等待，只测解析 CPU
+    python bench/replay_sse.py records/ --speed 10                # 10 倍速回放
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from run_bench import load_plugin_module, percentile  # noqa: E402
+
+
+def load_records(paths: list) -> list:
+    records = []
+    for path in paths:
+        path = Path(path)
+        files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+        for file in files:
+            try:
+                record = json.loads(file.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                print(f"跳过 {file}: {e}", file=sys.stderr)
+                continue
+            record["file"] = file.name
+            record["chunks"] = [(t, base64.b64decode(c)) for t, c in record.get("chunks", [])]
+            records.append(record)
+    return records
+
+
+def parse_once(parser_cls, chunks: list):
+    """与插件 _post_generation 相同的解析流程，返回 (链接, 出链接的分片序号, 解析耗时)"""
+    parser = parser_cls()
+    cpu = 0.0
+    for index, (_, chunk) in enumerate(chunks):
+        started = time.perf_counter()
+        added = parser.feed(chunk)
+        url = parser.find_image_url() if ")" in added else ""
+        cpu += time.perf_counter() - started
+        if url:
+            return url, index, cpu
+        if parser.done:
+            break
+    started = time.perf_counter()
+    parser.close()
+    url = parser.find_image_url(final=True)
+    cpu += time.perf_counter() - started
+    return url, len(chunks) - 1, cpu
+
+
+async def replay_paced(parser_cls, record: dict, speed: float) -> dict:
+    """按录制节奏回放一份记录 (speed 倍速)，返回墙钟出链接时间"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    parser = parser_cls()
+    url = ""
+    for t, chunk in record["chunks"]:
+        delay = start + t / speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        added = parser.feed(chunk)
+        if ")" in added:
+            url = parser.find_image_url()
+            if url:
+                break
+        if parser.done:
+            break
+    if not url:
+        parser.close()
+        url = parser.find_image_url(final=True)
+    return {"url": url, "wall": loop.time() - start}
+
+
+async def main_async(args):
+    module = load_plugin_module()
+    parser_cls = module.SSEStreamParser
+    records = load_records(args.paths)
+    if not records:
+        print("没有找到录制文件")
+        return 1
+
+    total_bytes = sum(len(c) for r in records for _, c in r["chunks"])
+    cpu_per_record, time_to_url, mismatches = [], [], []
+    for record in records:
+        chunks = record["chunks"]
+        best = None
+        for _ in range(args.repeat):
+            url, index, cpu = parse_once(parser_cls, chunks)
+            best = cpu if best is None else min(best, cpu)
+        cpu_per_record.append(best)
+        if url and chunks:
+            time_to_url.append(chunks[index][0])
+        if url != (record.get("url") or ""):
+            mismatches.append((record["file"], record.get("url") or "", url))
+
+    lines = [
+        f"=== 回放 {len(records)} 份录制 | {sum(len(r['chunks']) for r in records)} 个分片 | "
+        f"{total_bytes / 1024:.1f} KB ===",
+        f"解析 CPU (每份取 {args.repeat} 次最小值): 合计 {sum(cpu_per_record) * 1000:.2f}ms | "
+        f"P50 {percentile(cpu_per_record, 0.5) * 1e6:.0f}µs | P95 {percentile(cpu_per_record, 0.95) * 1e6:.0f}µs | "
+        f"最大 {max(cpu_per_record) * 1e6:.0f}µs | "
+        f"{sum(cpu_per_record) / max(total_bytes, 1) * 1024 * 1024 * 1000:.2f}ms/MB",
+        f"出链接时间 (录制时间轴): P50 {percentile(time_to_url, 0.5):.2f}s | "
+        f"P95 {percentile(time_to_url, 0.95):.2f}s | 有链接 {len(time_to_url)}/{len(records)}",
+    ]
+
+    if args.speed > 0:
+        started = time.monotonic()
+        paced = await asyncio.gather(*(replay_paced(parser_cls, r, args.speed) for r in records))
+        walls = [p["wall"] for p in paced if p["url"]]
+        lines.append(
+            f"{args.speed:g} 倍速回放: 总耗时 {time.monotonic() - started:.2f}s | "
+            f"出链接 P50 {percentile(walls, 0.5):.2f}s P95 {percentile(walls, 0.95):.2f}s"
+        )
+
+    if mismatches:
+        lines.append(f"⚠️ 链接与录制不一致 {len(mismatches)} 份:")
+        lines += [f"  {name}: 录制 {old[:60]!r} -> 回放 {new[:60]!r}" for name, old, new in mismatches[:20]]
+    else:
+        lines.append("✅ 提取的链接与录制时全部一致")
+
+    print("\n".join(lines))
+    return 1 if mismatches and args.strict else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的 SSE 流，测试解析性能与正确性")
+    parser.add_argument("paths", nargs="+", help="录制目录或单个录制文件")
+    parser.add_argument("--speed", type=float, default=0, help="回放倍速，0 表示只测解析不按节奏等待")
+    parser.add_argument("--repeat", type=int, default=5, help="每份录制重复解析次数 (取最小耗时)")
+    parser.add_argument("--strict", action="store_true", help="链接不一致时以非零状态退出 (用于 CI)")
+    args = parser.parse_args()
+    args.repeat = max(1, args.repeat)
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
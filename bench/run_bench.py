@@ -0,0 +1,292 @@
+"""
+离线压测：用本地模拟的 Flow2API 和图片服务器驱动 GeminiDraw，不访问外网
+
+统计延迟 P50/P95/P99、吞吐 (RPS)、事件循环卡顿和内存峰值，用于检查
+_generate_image / _process_image_url 的改动有没有带来性能回退。
+需要在装有 AstrBot 的环境里运行 (插件本身依赖 astrbot.api)。
+
+示例：
+    python bench/run_bench.py --scenario t2i --requests 200 --concurrency 20
+    python bench/run_bench.py --scenario i2i --images large.png,medium.gif --fail-rate 0.1 --rate-limit-rate 0.05
+    python bench/run_bench.py --scenario process --unique-images --plugin-config my_config.json
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import importlib.util
+import json
+import resource
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_server import IMAGE_FORMATS, IMAGE_SIZES, MockFlow2API, MockOptions  # noqa: E402
+
+import aiohttp  # noqa: E402
+
+PLUGIN_PATH = Path(__file__).resolve().parent.parent / "main.py"
+
+
+def load_plugin_module():
+    """按文件路径加载插件 (不要求插件目录是一个包)"""
+    spec = importlib.util.spec_from_file_location("gemini_draw_bench", PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb():
+    """本进程与子进程 (process 模式的图片处理池) 的内存峰值 (MB)；ru_maxrss 在 Linux 下单位为 KB，macOS 下为字节"""
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / divisor, children / divisor
+
+
+class LoopLagSampler:
+    """每 interval 秒醒来一次，实际醒来时间与预期的差值即事件循环卡顿"""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class NetworkGuard:
+    """记录插件发出的每个 HTTP 请求的目标主机；压测必须完全离线，访问了非本机地址就判定失败"""
+
+    def __init__(self):
+        self.hosts = Counter()
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_start.append(self._on_request_start)
+        self.trace.freeze()
+
+    async def _on_request_start(self, _session, _ctx, params):
+        self.hosts[params.url.host or ""] += 1
+
+    def install(self, plugin):
+        """包装插件的连接池获取函数，给每个新建的会话挂上请求跟踪"""
+        get_session = plugin._get_session
+
+        def guarded(pool: str = "api"):
+            session = get_session(pool)
+            if self.trace not in session.trace_configs:
+                session.trace_configs.append(self.trace)
+            return session
+
+        plugin._get_session = guarded
+
+    @staticmethod
+    def is_loopback(host: str) -> bool:
+        if host == "localhost":
+            return True
+        try:
+            return ipaddress.ip_address(host.strip("[]")).is_loopback
+        except ValueError:
+            return False
+
+    def external_hosts(self) -> dict:
+        return {host: n for host, n in self.hosts.items() if not self.is_loopback(host)}
+
+
+class _Context:
+    """GeminiDraw 只在发送主动消息时用到 Context，压测用不到"""
+
+
+class FakeEvent:
+    """模拟消息事件：只提供排队逻辑用到的发送者/群号和排队提示"""
+
+    def __init__(self, user: str, group: str):
+        self.user = user
+        self.group = group
+        self.notices = 0
+
+    def get_sender_id(self):
+        return self.user
+
+    def get_group_id(self):
+        return self.group
+
+    def plain_result(self, text: str):
+        return text
+
+    async def send(self, _message):
+        self.notices += 1
+
+
+async def run_benchmark(args) -> dict:
+    module = load_plugin_module()
+    server = MockFlow2API(MockOptions.from_args(args))
+    base_url = await server.start()
+
+    config = {
+        "api_url": f"{base_url}/v1/chat/completions",
+        "apikey": "bench-key",
+        "model": "imagen-4.0-generate-preview-landscape",
+        # 离线压测：不调用第三方转换API，输入图片只走本地处理
+        "enable_convert_api": False,
+        "input_strategy": {"policy": "local"},
+    }
+    if args.plugin_config:
+        config.update(json.loads(Path(args.plugin_config).read_text(encoding="utf-8")))
+    plugin = module.GeminiDraw(_Context(), config)
+    guard = NetworkGuard()
+    guard.install(plugin)
+
+    image_names = args.images.split(",") if args.images else sorted(server.images)
+    latencies = []
+    outcomes = Counter()
+    sampler = LoopLagSampler()
+
+    async def one_request(i: int):
+        prompt = f"bench prompt {i}" if not args.same_prompt else "bench prompt"
+        # 请求均匀分布到 users 个用户、groups 个群，排队/公平调度按真实情况生效
+        event = FakeEvent(f"user{i % args.users}", f"group{i % args.groups}")
+        started = time.monotonic()
+        try:
+            if args.scenario == "t2i":
+                ok, result = await plugin._generate_image_shared("文", prompt, None, is_image_to_image=False,
+                                                                 event=event)
+            else:
+                name = image_names[i % len(image_names)]
+                url = f"{base_url}/img/{name}" + (f"?n={i}" if args.unique_images else "")
+                image, error, _ = await plugin._process_image_url(url)
+                if image is None:
+                    ok, result = False, f"图片处理失败: {error[:40]}"
+                elif args.scenario == "process":
+                    ok, result = True, ""
+                else:
+                    ok, result = await plugin._generate_image_shared("图", prompt, image, is_image_to_image=True,
+                                                                     event=event)
+        except Exception as e:
+            ok, result = False, f"异常: {type(e).__name__}"
+        latencies.append(time.monotonic() - started)
+        outcomes["成功" if ok else str(result).split("\n")[0][:40]] += 1
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(i: int):
+        async with semaphore:
+            await one_request(i)
+
+    # 预热：建立连接池、加载线程池
+    for i in range(min(args.warmup, args.requests)):
+        await one_request(-1 - i)
+    latencies.clear()
+    outcomes.clear()
+
+    sampler.start()
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(limited(i) for i in range(args.requests)))
+    finally:
+        elapsed = time.monotonic() - started
+        await sampler.stop()
+        stage_lines = plugin.metrics.stage_lines() if hasattr(plugin, "metrics") else []
+        await plugin.terminate()
+        await server.stop()
+
+    rss_self, rss_children = peak_rss_mb()
+    return {
+        "scenario": args.scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "elapsed": elapsed,
+        "rps": args.requests / elapsed if elapsed else 0.0,
+        "latency": {q: percentile(latencies, q) for q in (0.5, 0.95, 0.99, 1.0)},
+        "loop_lag": {q: percentile(sampler.samples, q) for q in (0.5, 0.99, 1.0)},
+        "rss_mb": rss_self,
+        "rss_children_mb": rss_children,
+        "outcomes": dict(outcomes),
+        "upstream": dict(server.stats),
+        "stages": stage_lines,
+        "external_hosts": guard.external_hosts(),
+    }
+
+
+def format_report(result: dict) -> str:
+    lat, lag = result["latency"], result["loop_lag"]
+    lines = [
+        f"=== {result['scenario']} | 请求 {result['requests']} | 并发 {result['concurrency']} ===",
+        f"耗时 {result['elapsed']:.2f}s | 吞吐 {result['rps']:.2f} req/s",
+        f"延迟 P50 {lat[0.5] * 1000:.0f}ms | P95 {lat[0.95] * 1000:.0f}ms | "
+        f"P99 {lat[0.99] * 1000:.0f}ms | 最大 {lat[1.0] * 1000:.0f}ms",
+        f"事件循环卡顿 P50 {lag[0.5] * 1000:.1f}ms | P99 {lag[0.99] * 1000:.1f}ms | 最大 {lag[1.0] * 1000:.1f}ms",
+        f"内存峰值 {result['rss_mb']:.0f} MB (子进程 {result['rss_children_mb']:.0f} MB)",
+        "结果: " + " | ".join(f"{k} {v}" for k, v in sorted(result["outcomes"].items(), key=lambda kv: -kv[1])),
+        "上游: " + " | ".join(f"{k} {v}" for k, v in result["upstream"].items()),
+    ]
+    if result["external_hosts"]:
+        lines.append("⚠️ 访问了外网主机 (压测结果无效): " + " | ".join(
+            f"{host} {n}" for host, n in result["external_hosts"].items()))
+    if result["stages"]:
+        lines.append("插件分阶段耗时:")
+        lines += [f"  {line}" for line in result["stages"]]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GeminiDraw 离线压测 (本地模拟 Flow2API)")
+    parser.add_argument("--scenario", choices=("t2i", "i2i", "process"), default="t2i",
+                        help="t2i=文生图，i2i=下载+处理+图生图，process=只测图片下载与处理")
+    parser.add_argument("--requests", type=int, default=100, help="请求总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同时在途的请求数")
+    parser.add_argument("--users", type=int, default=1000, help="模拟的用户数")
+    parser.add_argument("--groups", type=int, default=20, help="模拟的群数")
+    parser.add_argument("--warmup", type=int, default=2, help="预热请求数 (不计入结果)")
+    parser.add_argument("--images", default="",
+                        help="使用的输入图片，逗号分隔，可选: " + ",".join(
+                            f"{s}.{e}" for s in IMAGE_SIZES for e in IMAGE_FORMATS))
+    parser.add_argument("--unique-images", action="store_true", help="每个请求的图片链接都不同 (绕过图片缓存)")
+    parser.add_argument("--same-prompt", action="store_true", help="所有请求使用相同描述 (测试请求合并/结果缓存)")
+    parser.add_argument("--plugin-config", default="", help="覆盖插件配置的 JSON 文件")
+    parser.add_argument("--output", default="", help="把报告追加写入该文件 (例如 bench_output.txt)")
+    parser.add_argument("--json", action="store_true", help="输出 JSON 而不是文本报告")
+    MockOptions.add_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    if args.json:
+        report = json.dumps({**result, "latency": {str(k): v for k, v in result["latency"].items()},
+                             "loop_lag": {str(k): v for k, v in result["loop_lag"].items()}},
+                            ensure_ascii=False, indent=2)
+    else:
+        report = format_report(result)
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n\n")
+    if result["external_hosts"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 from astrbot.api.message_components import *
-from astrbot.api.event import filter, AstrMessageEvent
+from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 import aiohttp
+from aiohttp import web
 import asyncio
 import json
 import re
@@ -10,17 +11,2200 @@ import time
 from datetime import datetime
 import base64
 import io  # <--- 新增
+import os
+import functools
+import hashlib
+import uuid
+import random
+import sys
+import threading
+import traceback
+import sqlite3
+import contextvars
+from contextlib import closing, contextmanager
+from pathlib import Path
+from collections import Counter, OrderedDict, deque
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 # 尝试导入图片处理库
 try:
     from PIL import Image as PyImage
 except ImportError:
     PyImage = None
+# 提示词库文件用 YAML 时需要 PyYAML (JSON 不需要)
+try:
+    import yaml
+except ImportError:
+    yaml = None
+# 旧版 AstrBot 没有 StarTools，数据目录回退到 data/plugin_data
+try:
+    from astrbot.api.star import StarTools
+except ImportError:
+    StarTools = None
+
+
+# ---------------- 核心：Pillow 任务 (模块级函数，方便进程池序列化) ----------------
+def _pil_open_reduced(img_data: bytes, max_size: int):
+    """
+    打开首帧并尽量在解码阶段就缩小：JPEG 用 draft 模式按 1/2~1/8 直接解码到接近目标尺寸，
+    其他格式缩放时先用 reduce 粗缩再精细重采样 (reducing_gap)。返回 (RGB 图像, 原尺寸, 原格式)
+    """
+    img = PyImage.open(io.BytesIO(img_data))
+    # 如果是动图，seek到第一帧
+    img.seek(0)
+    original_size = img.size
+    source_format = img.format
+    if source_format == "JPEG" and (img.width > max_size or img.height > max_size):
+        # 按最终尺寸 (保持比例) 请求，draft 只会选不小于它的缩放比
+        ratio = max_size / max(img.size)
+        img.draft("RGB", (max(1, int(img.width * ratio)), max(1, int(img.height * ratio))))
+    # 转换为 RGB (去除透明通道/GIF索引颜色，防止JPG保存失败)
+    img = img.convert("RGB")
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), reducing_gap=3.0)
+    return img, original_size, source_format
+
+
+def _pil_preprocess(img_data: bytes, max_size: int = 1536, quality: int = 85):
+    """首帧 → RGB → 限制最大边长 → JPEG，返回 (JPEG字节, 原尺寸, 新尺寸)"""
+    img, original_size, _ = _pil_open_reduced(img_data, max_size)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue(), original_size, img.size
+
+
+def _pil_encode_jpeg(img, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _pil_fit_budget(img, budget: int, scales, min_quality: int, max_quality: int):
+    """在 (缩放, 质量) 空间里找能装进预算的最佳组合：尺寸优先，同尺寸下二分找最高质量"""
+    for scale in scales:
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        candidate = img if scale == 1.0 else img.resize(size, PyImage.LANCZOS)
+
+        best = None
+        low, high = min_quality, max_quality
+        while low <= high:
+            quality = (low + high) // 2
+            data = _pil_encode_jpeg(candidate, quality)
+            if len(data) <= budget:
+                best = (data, size, quality, scale)
+                low = quality + 5
+            else:
+                high = quality - 5
+        if best:
+            return best
+
+    # 最小尺寸最低质量也装不下：交出最小的那一档，让上游去判断
+    scale = scales[-1]
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    return _pil_encode_jpeg(img.resize(size, PyImage.LANCZOS), min_quality), size, min_quality, scale
+
+
+def _pil_encode_ladder(img_data: bytes, budgets: list, max_size: int = 1536, min_quality: int = 55, max_quality: int = 90):
+    """
+    从原始像素一次性生成多档 JPEG (每档对应一次尝试的字节预算)，
+    每档都从原图编码，不在上一档的有损结果上反复压缩。
+    返回 [(JPEG字节, (宽, 高), 质量)]，质量为 0 表示原样沿用输入字节
+    """
+    img, original_size, source_format = _pil_open_reduced(img_data, max_size)
+    if img.size != original_size:
+        source_format = None
+
+    scales = [1.0, 0.85, 0.7, 0.55, 0.4, 0.3, 0.2]
+    ladder = []
+    for budget in budgets:
+        if not ladder and source_format == "JPEG" and len(img_data) <= budget:
+            # 原图已经装得下，第一档直接用原始字节
+            ladder.append((img_data, img.size, 0))
+            continue
+        data, size, quality, scale = _pil_fit_budget(img, budget, scales, min_quality, max_quality)
+        ladder.append((data, size, quality))
+        # 后面的档位只会更小，从当前缩放比继续往下找
+        scales = [item for item in scales if item <= scale]
+    return ladder
+
+
+class EncodedImage:
+    """编码后的图片：原始字节 + 尺寸/格式，data URL 按需生成一次并缓存"""
+
+    __slots__ = ("data", "width", "height", "format", "_data_url", "_digest")
+
+    def __init__(self, data: bytes, width: int = 0, height: int = 0, fmt: str = "jpeg"):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.format = fmt
+        self._data_url = None
+        self._digest = None
+
+    @classmethod
+    def from_data_url(cls, data_url: str, width: int = 0, height: int = 0):
+        """解析 data:image/...;base64,xxx (或裸 base64)，只解码一次；base64 格式错误抛 ValueError"""
+        fmt = "jpeg"
+        if "base64," in data_url:
+            header, data = data_url.split("base64,", 1)
+            match = re.match(r'data:image/([\w.+-]+)', header)
+            if match:
+                fmt = match.group(1).lower()
+        else:
+            data = data_url
+        return cls(base64.b64decode(data), width, height, fmt)
+
+    @property
+    def mime(self) -> str:
+        return f"image/{self.format}"
+
+    @property
+    def b64_size(self) -> int:
+        """base64 编码后的长度 (不含头部)，不实际编码"""
+        return (len(self.data) + 2) // 3 * 4
+
+    @property
+    def data_url(self) -> str:
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime};base64,{base64.b64encode(self.data).decode('ascii')}"
+        return self._data_url
+
+    @property
+    def digest(self) -> str:
+        """图片内容哈希 (用于合并相同请求)"""
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.data).hexdigest()
+        return self._digest
+
+    @property
+    def nbytes(self) -> int:
+        """缓存占用估算：原始字节 + 发送时生成的 data URL (放进缓存前就按生成后的体积计费)"""
+        return len(self.data) + self.b64_size
+
+    def fingerprint(self) -> dict:
+        """不含图片内容的指纹 (录制 SSE 时记录输入图片用)"""
+        return {"sha1": self.digest, "format": self.format, "width": self.width,
+                "height": self.height, "bytes": len(self.data)}
+
+    def describe(self) -> str:
+        size = f"{self.width}x{self.height} | " if self.width else ""
+        return f"{size}{len(self.data) / 1024:.2f} KB ({self.format})"
+
+
+# ---------------- 核心：LRU 缓存 (字节上限 + TTL) ----------------
+class LRUCache:
+    """按字节数限制容量的 LRU 缓存，条目过期自动失效，记录命中/未命中/淘汰次数"""
+
+    def __init__(self, max_bytes: int, ttl: float, max_items: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()  # key -> (value, size, expires_at)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, size, expires_at = item
+        if expires_at and expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes:
+            return  # 单个条目超过总容量，不缓存
+        if key in self._items:
+            self._remove(key)
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        self._items[key] = (value, size, expires_at)
+        self.total_bytes += size
+        while self._items and (
+            self.total_bytes > self.max_bytes or (self.max_items and len(self._items) > self.max_items)
+        ):
+            oldest = next(iter(self._items))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def pop(self, key):
+        if key in self._items:
+            return self._remove(key)
+        return None
+
+    def clear(self):
+        self._items.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key):
+        value, size, _ = self._items.pop(key)
+        self.total_bytes -= size
+        return value
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"{len(self._items)} 条 / {self.total_bytes / 1024 / 1024:.1f}MB | "
+            f"命中 {self.hits} 未命中 {self.misses} ({self.hit_ratio() * 100:.0f}%) | "
+            f"淘汰 {self.evictions} 过期 {self.expirations}"
+        )
+
+
+# ---------------- 核心：文生图结果缓存 ----------------
+class ResultCache:
+    """文生图结果缓存：内存 LRU 在前，可选 SQLite 持久层在后；只保存生成结果链接"""
+
+    def __init__(self, ttl: float, max_entries: int, db_path: Path = None):
+        self.ttl = ttl
+        self._memory = LRUCache(max_bytes=max_entries * 2048, ttl=ttl, max_items=max_entries)
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+        if db_path is not None:
+            with closing(sqlite3.connect(db_path)) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, url TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        # 规范化：去首尾空白、合并连续空白、忽略大小写
+        normalized = " ".join(prompt.split()).casefold()
+        return hashlib.sha1(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def _db_get(self, key: str):
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            row = conn.execute("SELECT url, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > self.ttl:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            return row[0]
+
+    def _db_put(self, key: str, url: str):
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO results (key, url, created_at) VALUES (?, ?, ?)", (key, url, time.time()))
+            conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,))
+
+    async def get(self, key: str):
+        url = self._memory.get(key)
+        if url is None and self.db_path is not None:
+            try:
+                url = await asyncio.to_thread(self._db_get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ 读取结果缓存失败: {e}")
+                url = None
+            if url is not None:
+                self.db_hits += 1
+                self._memory.put(key, url, len(url))
+        if url is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return url
+
+    async def put(self, key: str, url: str):
+        self._memory.put(key, url, len(url))
+        if self.db_path is not None:
+            try:
+                await asyncio.to_thread(self._db_put, key, url)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ 写入结果缓存失败: {e}")
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        tier = "内存+SQLite" if self.db_path is not None else "内存"
+        return f"{tier} | {len(self._memory)} 条 | 命中 {self.hits}/{total} ({ratio:.0f}%)，其中磁盘 {self.db_hits}"
+
+
+# ---------------- 核心：后台任务队列 (SQLite 持久化) ----------------
+class JobStore:
+    """
+    后台生成任务：提交时写入 SQLite (含已处理好的输入图片)，工作协程按提交顺序领取执行，
+    结果主动推送回原会话；插件重载/重启后未完成的任务重新排队，已完成未送达的继续投递。
+    所有方法都是同步的，调用方放到线程里执行。
+    """
+
+    STATUS_NAMES = {"queued": "排队中", "running": "生成中", "done": "已完成", "failed": "失败", "cancelled": "已取消"}
+    MAX_DELIVER_ATTEMPTS = 5
+
+    def __init__(self, db_path: Path, max_attempts: int = 2, keep_hours: float = 24):
+        self.db_path = db_path
+        self.max_attempts = max(1, max_attempts)
+        self.keep_seconds = keep_hours * 3600
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, command TEXT NOT NULL, prompt TEXT NOT NULL, "
+                "model TEXT NOT NULL DEFAULT '', fresh INTEGER NOT NULL DEFAULT 0, "
+                "image BLOB, image_format TEXT NOT NULL DEFAULT '', image_width INTEGER NOT NULL DEFAULT 0, "
+                "image_height INTEGER NOT NULL DEFAULT 0, umo TEXT NOT NULL, user TEXT NOT NULL, grp TEXT NOT NULL, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT NOT NULL DEFAULT '', error TEXT NOT NULL DEFAULT '', "
+                "delivered INTEGER NOT NULL DEFAULT 0, deliver_attempts INTEGER NOT NULL DEFAULT 0, "
+                "delivering INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "delivering" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN delivering INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, created_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, job: dict):
+        columns = ", ".join(job)
+        marks = ", ".join("?" for _ in job)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"INSERT INTO jobs ({columns}) VALUES ({marks})", tuple(job.values()))
+
+    def pending_counts(self, user: str):
+        """(全部未完成数, 该用户未完成数)"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(user = ?), 0) FROM jobs WHERE status IN ('queued', 'running')", (user,)
+            ).fetchone()
+        return row[0], row[1]
+
+    def claim(self, exclude_users=()):
+        """领取最早排队的任务 (跳过已有任务在执行的用户，避免一个人占满工作协程)；没有返回 None"""
+        exclude = list(exclude_users)
+        skip = f"AND user NOT IN ({', '.join('?' for _ in exclude)}) " if exclude else ""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE status = 'queued' {skip}ORDER BY created_at LIMIT 1", exclude
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), row["id"]),
+            )
+        return dict(row)
+
+    def finish(self, job_id: str, status: str, result: str = "", error: str = ""):
+        """任务结束：记录结果并删除输入图片 (只在排队/执行时需要)"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, image = NULL WHERE id = ?",
+                (status, result, error, time.time(), job_id),
+            )
+
+    def claim_delivery(self, job_id: str) -> bool:
+        """原子地占用一次投递 (工作协程和补投循环同时发现同一个结果时只有一方能推送)；返回是否占用成功"""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute(
+                "UPDATE jobs SET delivering = 1 WHERE id = ? AND delivered = 0 AND delivering = 0", (job_id,)
+            ).rowcount > 0
+
+    def mark_delivered(self, job_id: str, ok: bool):
+        """结束一次投递：成功标记已送达，失败释放占用并计数，留给补投循环重试"""
+        with closing(self._connect()) as conn, conn:
+            if ok:
+                conn.execute("UPDATE jobs SET delivered = 1, delivering = 0 WHERE id = ?", (job_id,))
+            else:
+                conn.execute(
+                    "UPDATE jobs SET delivering = 0, deliver_attempts = deliver_attempts + 1 WHERE id = ?", (job_id,)
+                )
+
+    def undelivered(self, limit: int = 20) -> list:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, umo, status, result, error, created_at, finished_at FROM jobs "
+                "WHERE status IN ('done', 'failed') AND delivered = 0 AND delivering = 0 AND deliver_attempts < ? "
+                "ORDER BY finished_at LIMIT ?",
+                (self.MAX_DELIVER_ATTEMPTS, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def recover(self):
+        """
+        启动时：上次执行到一半的任务重新排队，已经因此重跑过多次的判为失败 (防止坏任务反复拖垮插件)；
+        投递到一半被中断的结果释放占用，重新投递
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE jobs SET delivering = 0 WHERE delivering = 1")
+            failed = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = '任务多次中断 (插件重启)，已放弃', finished_at = ?, "
+                "image = NULL WHERE status = 'running' AND attempts >= ?",
+                (time.time(), self.max_attempts),
+            ).rowcount
+            requeued = conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        return requeued, failed
+
+    def get(self, job_id: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, status, command, prompt, model, user, created_at, started_at, finished_at, "
+                "attempts, result, error, delivered FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def recent(self, user: str, limit: int = 5) -> list:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, status, command, prompt, created_at, finished_at FROM jobs WHERE user = ? "
+                "ORDER BY created_at DESC LIMIT ?", (user, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def position(self, created_at: float) -> int:
+        """排在该任务前面的排队任务数"""
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (created_at,)
+            ).fetchone()[0]
+
+    def cancel(self, job_id: str) -> bool:
+        """只取消还在排队的任务；返回是否取消成功"""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ?, image = NULL, delivered = 1 "
+                "WHERE id = ? AND status = 'queued'", (time.time(), job_id)
+            ).rowcount > 0
+
+    def counts(self) -> dict:
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def prune(self) -> int:
+        """删除过了保留期的已结束任务"""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+                (time.time() - self.keep_seconds,),
+            ).rowcount
+
+
+class JobOrigin:
+    """后台任务的发起者：代替消息事件参与排队调度 (按原用户/群公平排队)；任务已受理，排队提示不再发送"""
+
+    def __init__(self, user: str, group: str):
+        self.user = user
+        self.group = group
+
+    def get_sender_id(self):
+        return self.user
+
+    def get_group_id(self):
+        return self.group
+
+    def plain_result(self, text: str):
+        return text
+
+    async def send(self, _message):
+        pass
+
+
+# ---------------- 核心：SSE 录制 (回放压测用) ----------------
+class SSERecorder:
+    """
+    按采样比例把上游原始 SSE 字节流 (含每个分片的到达时间) 和输入图片指纹写到磁盘，
+    供 bench/replay_sse.py 回放；只保留最近 max_files 份。
+    """
+
+    def __init__(self, root: Path, sample_percent: float = 100, max_files: int = 500):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_percent / 100
+        self.max_files = max(1, max_files)
+        self.stats = {"recorded": 0, "failed": 0}
+
+    def should_record(self) -> bool:
+        return random.random() < self.sample_rate
+
+    def _write(self, record: dict):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.json"
+        tmp_path = self.root / f"{name}.tmp"
+        tmp_path.write_text(json.dumps(record, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.root / name)
+        files = sorted(self.root.glob("*.json"))
+        for path in files[:max(0, len(files) - self.max_files)]:
+            path.unlink(missing_ok=True)
+
+    async def save(self, record: dict):
+        try:
+            await asyncio.to_thread(self._write, record)
+            self.stats["recorded"] += 1
+        except OSError as e:
+            self.stats["failed"] += 1
+            logger.warning(f"⚠️ SSE 录制写入失败: {e}")
+
+    def summary(self) -> str:
+        return f"已录制 {self.stats['recorded']} (采样 {self.sample_rate * 100:.0f}%，保留 {self.max_files} 份)"
+
+
+# ---------------- 核心：QQ 头像磁盘缓存 ----------------
+_AVATAR_URL_RE = re.compile(r'^https?://q\d?\.qlogo\.cn/.*[?&]nk=(\d+)')
+
+
+class AvatarStore:
+    """QQ 头像磁盘缓存：保存预处理后的 JPEG 及 ETag/Last-Modified，重启后依然有效"""
+
+    def __init__(self, root: Path, fresh_ttl: float, memory_mb: float = 16):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fresh_ttl = fresh_ttl
+        self._memory = LRUCache(max_bytes=int(memory_mb * 1024 * 1024), ttl=0)
+        self.stats = {"fresh": 0, "stale": 0, "miss": 0, "not_modified": 0, "updated": 0}
+
+    def _paths(self, qq: str):
+        return self.root / f"{qq}.jpg", self.root / f"{qq}.json"
+
+    def _read(self, qq: str):
+        image_path, meta_path = self._paths(qq)
+        if not image_path.exists() or not meta_path.exists():
+            return None
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        image = EncodedImage(image_path.read_bytes(), meta.get("width", 0), meta.get("height", 0), "jpeg")
+        return image, meta
+
+    def _write(self, qq: str, image: EncodedImage, meta: dict):
+        # 先写临时文件再替换，避免中途退出留下半个文件
+        image_path, meta_path = self._paths(qq)
+        for path, data in ((image_path, image.data), (meta_path, json.dumps(meta).encode("utf-8"))):
+            tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+    async def load(self, qq: str):
+        """返回 (EncodedImage, meta) 或 (None, None)，优先走内存"""
+        entry = self._memory.get(qq)
+        if entry is None:
+            try:
+                entry = await asyncio.to_thread(self._read, qq)
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ 读取头像缓存失败 ({qq}): {e}")
+                entry = None
+            if entry is None:
+                return None, None
+            self._memory.put(qq, entry, entry[0].nbytes)
+        return entry
+
+    async def save(self, qq: str, image: EncodedImage, meta: dict):
+        meta = dict(meta, width=image.width, height=image.height)
+        self._memory.put(qq, (image, meta), image.nbytes)
+        try:
+            await asyncio.to_thread(self._write, qq, image, meta)
+        except OSError as e:
+            logger.warning(f"⚠️ 写入头像缓存失败 ({qq}): {e}")
+
+    async def touch(self, qq: str, image: EncodedImage, meta: dict):
+        """304 未修改：只刷新校验时间"""
+        meta = dict(meta, fetched_at=time.time())
+        await self.save(qq, image, meta)
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time.time() - meta.get("fetched_at", 0) < self.fresh_ttl
+
+    def summary(self) -> str:
+        st = self.stats
+        return (
+            f"新鲜 {st['fresh']} 过期复用 {st['stale']} 未命中 {st['miss']} | "
+            f"304 {st['not_modified']} 更新 {st['updated']}"
+        )
+
+
+# ---------------- 核心：生成请求准入控制 ----------------
+class AdmissionRejected(Exception):
+    """排队已满，请求被直接拒绝"""
+
+
+class AdmissionTicket:
+    __slots__ = ("user", "group", "limit", "granted", "_event")
+
+    def __init__(self, user: str, group: str, limit: int = 1):
+        self.user = user
+        self.group = group
+        self.limit = limit  # 该用户同时执行的上限 (批量生成可以高于默认值)
+        self.granted = False
+        self._event = asyncio.Event()
+
+    async def wait(self):
+        await self._event.wait()
+
+
+def _adjust_count(counter: dict, key, delta: int):
+    """计数增减，归零时删除条目"""
+    value = counter.get(key, 0) + delta
+    if value > 0:
+        counter[key] = value
+    else:
+        counter.pop(key, None)
+
+
+class AdmissionController:
+    """
+    生成请求准入：全局并发上限 + 每用户/每群并发上限，
+    排队按群轮转 (一个大群刷屏不会饿死其他群)，队列有界，超出直接拒绝。
+    """
+
+    def __init__(self, max_concurrent: int = 8, per_user: int = 1, per_group: int = 3,
+                 max_queue: int = 50, max_queue_per_user: int = 2, queue_timeout: float = 300):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user = max(1, per_user)
+        self.per_group = max(1, per_group)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_per_user = max(0, max_queue_per_user)
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        # 计数归零即删除、空队列即移除，长期运行不会为每个出现过的用户/群留下条目
+        self._user_running: dict = {}
+        self._group_running: dict = {}
+        self._user_queued: dict = {}
+        self._queues: dict = {}  # group -> deque[AdmissionTicket]
+        self._order = deque()  # 有排队请求的群，轮转顺序
+        self.queued = 0
+        self.stats = {"admitted": 0, "waited": 0, "rejected": 0, "timeout": 0, "peak_queue": 0}
+
+    def submit(self, user: str, group: str, user_limit: int = 0) -> AdmissionTicket:
+        """
+        登记一个请求；能立即执行则 granted=True，否则排队；队列满抛 AdmissionRejected。
+        user_limit 高于 per_user 时 (批量生成) 该请求的个人并发与排队额度相应放宽，全局/每群上限不变
+        """
+        limit = max(self.per_user, user_limit)
+        # 需要排队的请求 (全局、每群或个人任一上限已满) 一律受队列上限约束；能立即执行的不进队列
+        if not self._can_start(user, group, limit):
+            if self.queued >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise AdmissionRejected(f"当前排队请求过多 ({self.queued})，请稍后再试")
+            if self._user_queued.get(user, 0) >= self.max_queue_per_user + limit - self.per_user:
+                self.stats["rejected"] += 1
+                raise AdmissionRejected("你已有请求在排队，请等待完成后再试")
+
+        ticket = AdmissionTicket(user, group, limit)
+        if group not in self._queues:
+            self._queues[group] = deque()
+            self._order.append(group)
+        self._queues[group].append(ticket)
+        _adjust_count(self._user_queued, user, 1)
+        self.queued += 1
+        self._dispatch()
+        if not ticket.granted:
+            self.stats["waited"] += 1
+            self.stats["peak_queue"] = max(self.stats["peak_queue"], self.queued)
+        return ticket
+
+    def try_acquire(self, user: str, group: str, user_limit: int = 0):
+        """
+        不排队的准入 (对冲等附加请求用)：有人在排队或任一上限已满时返回 None，不计入拒绝；
+        拿到的名额同样要 release
+        """
+        limit = max(self.per_user, user_limit)
+        if self.queued or not self._can_start(user, group, limit):
+            return None
+        ticket = AdmissionTicket(user, group, limit)
+        ticket.granted = True
+        self.running += 1
+        _adjust_count(self._user_running, user, 1)
+        _adjust_count(self._group_running, group, 1)
+        self.stats["admitted"] += 1
+        return ticket
+
+    def _can_start(self, user: str, group: str, limit: int) -> bool:
+        return (self.running < self.max_concurrent and self._group_running.get(group, 0) < self.per_group
+                and self._user_running.get(user, 0) < limit)
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """按轮转顺序估算排队位置 (从 1 开始)"""
+        queues = [list(self._queues[group]) for group in self._order]
+        position = 0
+        while any(queues):
+            for queue in queues:
+                if queue:
+                    position += 1
+                    if queue.pop(0) is ticket:
+                        return position
+        return 0
+
+    def release(self, ticket: AdmissionTicket):
+        """请求结束 (成功/失败/取消/超时) 时调用"""
+        if ticket.granted:
+            self.running -= 1
+            _adjust_count(self._user_running, ticket.user, -1)
+            _adjust_count(self._group_running, ticket.group, -1)
+        else:
+            queue = self._queues.get(ticket.group)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self._dequeued(ticket)
+                if not queue:
+                    self._drop_group(ticket.group)
+        self._dispatch()
+
+    def _dequeued(self, ticket: AdmissionTicket):
+        self.queued -= 1
+        _adjust_count(self._user_queued, ticket.user, -1)
+
+    def _drop_group(self, group: str):
+        del self._queues[group]
+        self._order.remove(group)
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self._order:
+            granted = None
+            for _ in range(len(self._order)):
+                group = self._order[0]
+                self._order.rotate(-1)
+                if self._group_running.get(group, 0) >= self.per_group:
+                    continue
+                queue = self._queues[group]
+                for ticket in queue:
+                    if self._user_running.get(ticket.user, 0) < ticket.limit:
+                        granted = ticket
+                        break
+                if granted is not None:
+                    queue.remove(granted)
+                    if not queue:
+                        self._drop_group(group)
+                    break
+            if granted is None:
+                return  # 剩下的都被个人/群上限挡住了
+
+            self._dequeued(granted)
+            granted.granted = True
+            self.running += 1
+            _adjust_count(self._user_running, granted.user, 1)
+            _adjust_count(self._group_running, granted.group, 1)
+            self.stats["admitted"] += 1
+            granted._event.set()
+
+    def summary(self) -> str:
+        st = self.stats
+        return (
+            f"运行 {self.running}/{self.max_concurrent} | 排队 {self.queued}/{self.max_queue} (峰值 {st['peak_queue']}) | "
+            f"放行 {st['admitted']} 排过队 {st['waited']} 拒绝 {st['rejected']} 超时 {st['timeout']}"
+        )
+
+
+# ---------------- 核心：多后端负载均衡 ----------------
+class Backend:
+    """单个 Flow2API 后端的运行状态"""
+
+    def __init__(self, url: str):
+        self.url = url
+        parsed = urlparse(url)
+        self.name = parsed.netloc or url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ewma_latency = 0.0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.healthy = True  # 主动健康检查结果
+        self.last_error = ""
+
+    @property
+    def models_url(self) -> str:
+        """健康检查地址：/v1/chat/completions -> /v1/models"""
+        if self.url.rstrip("/").endswith("/chat/completions"):
+            return self.url.rstrip("/")[: -len("/chat/completions")] + "/models"
+        return self.url
+
+
+class BackendPool:
+    """
+    Flow2API 多后端调度：最少在途请求 (或按延迟加权) 选路，
+    连续失败自动摘除，冷却后重新放入；主动健康检查失败的后端同样不参与调度。
+    """
+
+    def __init__(self, urls: list, strategy: str = "least_outstanding", eject_after: int = 3,
+                 eject_seconds: float = 30):
+        self.backends = [Backend(url) for url in urls]
+        self.strategy = strategy
+        self.eject_after = max(1, eject_after)
+        self.eject_seconds = eject_seconds
+
+    def __len__(self):
+        return len(self.backends)
+
+    def is_available(self, backend: Backend, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return backend.healthy and backend.ejected_until <= now
+
+    def pick(self, exclude=()) -> Backend:
+        now = time.monotonic()
+        pool = [b for b in self.backends if b not in exclude] or self.backends
+        candidates = [b for b in pool if self.is_available(b, now)]
+        if not candidates:
+            # 全部不可用时不直接报错：选最早恢复的那个试试
+            return min(pool, key=lambda b: (not b.healthy, b.ejected_until))
+
+        if self.strategy == "latency":
+            known = [b.ewma_latency for b in candidates if b.ewma_latency > 0]
+            default = sum(known) / len(known) if known else 1.0
+            return min(candidates, key=lambda b: (
+                (b.ewma_latency or default) * (b.outstanding + 1) * (1 + b.consecutive_failures)
+            ))
+        return min(candidates, key=lambda b: (b.outstanding, b.consecutive_failures, b.ewma_latency))
+
+    def acquire(self, backend: Backend):
+        backend.outstanding += 1
+        backend.requests += 1
+
+    def release(self, backend: Backend, ok: bool, latency: float, error: str = ""):
+        """请求结束：ok=False 表示后端本身的问题 (超时/连接失败/5xx)，None 表示请求被主动取消"""
+        backend.outstanding -= 1
+        if ok is None:
+            return
+        if ok:
+            backend.consecutive_failures = 0
+            backend.ejections = 0
+            backend.ewma_latency = latency if backend.ewma_latency == 0 else 0.7 * backend.ewma_latency + 0.3 * latency
+            return
+
+        backend.errors += 1
+        backend.consecutive_failures += 1
+        backend.last_error = error[:100]
+        if backend.consecutive_failures >= self.eject_after:
+            self.eject(backend, f"连续失败 {backend.consecutive_failures} 次")
+
+    def eject(self, backend: Backend, reason: str):
+        backend.ejections += 1
+        cooldown = min(self.eject_seconds * 2 ** (backend.ejections - 1), 600)
+        backend.ejected_until = time.monotonic() + cooldown
+        backend.consecutive_failures = 0
+        logger.warning(f"🚫 后端 {backend.name} 已摘除 {cooldown:.0f} 秒: {reason}")
+
+    def mark_health(self, backend: Backend, healthy: bool, error: str = ""):
+        if backend.healthy != healthy:
+            logger.info(f"{'✅' if healthy else '🚫'} 后端 {backend.name} 健康检查: {'恢复' if healthy else '失败 ' + error[:100]}")
+        backend.healthy = healthy
+        if not healthy:
+            backend.last_error = error[:100]
+
+    def summary_lines(self) -> list:
+        now = time.monotonic()
+        lines = []
+        for b in self.backends:
+            if not b.healthy:
+                state = "🔴 健康检查失败"
+            elif b.ejected_until > now:
+                state = f"🟠 摘除中 ({b.ejected_until - now:.0f}s)"
+            else:
+                state = "🟢 正常"
+            lines.append(
+                f"{b.name} {state} | 在途 {b.outstanding} | 请求 {b.requests} 失败 {b.errors} | "
+                f"平均耗时 {b.ewma_latency:.1f}s"
+            )
+        return lines
+
+
+# ---------------- 核心：熔断器 (按后端 / 按模型) ----------------
+class CircuitBreaker:
+    """
+    单个熔断器：滑动窗口内错误率或超时率过高时打开 (直接快速失败)，
+    冷却结束后进入半开状态，只放行少量探测请求，探测成功才重新关闭。
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, window: float = 60, min_requests: int = 5, error_rate: float = 0.5,
+                 timeout_rate: float = 0.5, open_seconds: float = 30, probes: int = 1):
+        self.name = name
+        self.window = window
+        self.min_requests = max(1, min_requests)
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.state = self.CLOSED
+        self.events = deque()  # (时间, 是否失败, 是否超时)
+        self.opened_until = 0.0
+        self.opens = 0
+        self.reopens = 0
+        self.probing = 0
+        self.probe_successes = 0
+        self.probe_round = 0  # 每次进入半开加一，用来识别探测票据属于哪一轮
+        self.rejected = 0
+        self.last_reason = ""
+
+    def _trim(self, now: float):
+        while self.events and now - self.events[0][0] > self.window:
+            self.events.popleft()
+
+    def _refresh(self, now: float):
+        if self.state == self.OPEN and now >= self.opened_until:
+            self.state = self.HALF_OPEN
+            self.probing = 0
+            self.probe_successes = 0
+            self.probe_round += 1
+            logger.info(f"🟡 熔断器 [{self.name}] 进入半开状态，开始探测")
+
+    def available(self) -> bool:
+        """当前是否放行请求 (不占用探测名额)"""
+        self._refresh(time.monotonic())
+        if self.state == self.CLOSED:
+            return True
+        return self.state == self.HALF_OPEN and self.probing < self.probes
+
+    def allow(self):
+        """
+        拒绝返回 None；放行返回探测票据：半开状态下占用一个探测名额，票据为本轮编号 (>0)，
+        否则为 0。结束时把票据交给 record/release，只有本轮的探测票据才归还名额
+        """
+        if not self.available():
+            self.rejected += 1
+            return None
+        if self.state == self.HALF_OPEN:
+            self.probing += 1
+            return self.probe_round
+        return 0
+
+    def _is_probe(self, probe: int) -> bool:
+        return self.state == self.HALF_OPEN and probe and probe == self.probe_round
+
+    def release(self, probe: int):
+        """放行后没有真正发出请求：归还探测名额，不记录结果"""
+        if self._is_probe(probe):
+            self.probing = max(0, self.probing - 1)
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def _open(self, now: float, reason: str):
+        cooldown = min(self.open_seconds * 2 ** self.reopens, 600)
+        self.state = self.OPEN
+        self.opened_until = now + cooldown
+        self.opens += 1
+        self.events.clear()
+        self.last_reason = reason
+        logger.warning(f"⚡ 熔断器 [{self.name}] 打开 {cooldown:.0f} 秒: {reason}")
+
+    def record(self, failed, timed_out: bool = False, probe: int = 0):
+        """
+        记录一次结果：failed=None 表示与后端/模型无关的结果 (限流、请求本身有误等)。
+        半开状态只看本轮探测请求的结果；熔断前发出、现在才结束的请求不影响探测
+        """
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            if not self._is_probe(probe):
+                return
+            self.probing = max(0, self.probing - 1)
+            if failed is None:
+                return
+            if failed:
+                self.reopens += 1
+                self._open(now, "探测请求失败")
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= self.probes:
+                self.state = self.CLOSED
+                self.reopens = 0
+                self.events.clear()
+                logger.info(f"🟢 熔断器 [{self.name}] 探测成功，恢复正常")
+            return
+        if self.state == self.OPEN or failed is None:
+            return
+
+        self.events.append((now, bool(failed), timed_out))
+        self._trim(now)
+        total = len(self.events)
+        if total < self.min_requests:
+            return
+        errors = sum(1 for _, f, _ in self.events if f)
+        timeouts = sum(1 for _, _, t in self.events if t)
+        if timeouts / total >= self.timeout_rate:
+            self._open(now, f"超时率 {timeouts}/{total}")
+        elif errors / total >= self.error_rate:
+            self._open(now, f"错误率 {errors}/{total}")
+
+    def describe(self) -> str:
+        now = time.monotonic()
+        self._refresh(now)
+        if self.state == self.OPEN:
+            state = f"🔴 熔断中 ({self.opened_until - now:.0f}s，{self.last_reason})"
+        elif self.state == self.HALF_OPEN:
+            state = f"🟡 半开探测中 ({self.probing}/{self.probes})"
+        else:
+            self._trim(now)
+            total = len(self.events)
+            errors = sum(1 for _, f, _ in self.events if f)
+            state = f"🟢 正常 (近 {self.window:.0f}s 失败 {errors}/{total})"
+        return f"{self.name} {state} | 打开 {self.opens} 次 | 拦截 {self.rejected}"
+
+
+class CircuitBreakerBoard:
+    """熔断器集合：按名称懒创建，未启用时一律放行"""
+
+    # 重试策略的结果分类 -> (是否算失败, 是否算超时)；None 表示不计入
+    OUTCOME_FAILURE = {
+        "ok": (False, False),
+        "timeout": (True, True),
+        "network": (True, False),
+        "server_error": (True, False),
+        "no_url": (True, False),
+    }
+
+    def __init__(self, enabled: bool = True, **params):
+        self.enabled = enabled
+        self.params = params
+        self.breakers = OrderedDict()
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(name, **self.params)
+        return breaker
+
+    def available(self, name: str) -> bool:
+        return not self.enabled or self.get(name).available()
+
+    def allow(self, name: str):
+        """拒绝返回 None，放行返回探测票据 (见 CircuitBreaker.allow)"""
+        return self.get(name).allow() if self.enabled else 0
+
+    def release(self, name: str, probe: int):
+        if self.enabled:
+            self.get(name).release(probe)
+
+    def record(self, name: str, outcome: str, probe: int = 0):
+        if not self.enabled:
+            return
+        failed, timed_out = self.OUTCOME_FAILURE.get(outcome, (None, False))
+        self.get(name).record(failed, timed_out, probe)
+
+    def summary_lines(self) -> list:
+        if not self.enabled:
+            return ["❌ 禁用"]
+        return [b.describe() for b in self.breakers.values()] or ["暂无请求"]
+
+
+# ---------------- 核心：API Key 轮换 (令牌桶 + 429 冷却) ----------------
+def _mask_key(key: str) -> str:
+    return key[:4] + "***" + key[-4:] if len(key) > 8 else "***"
+
+
+def _parse_retry_after(value: str):
+    """Retry-After 可能是秒数或 HTTP 日期，解析失败返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiKey:
+    """单个 API Key 的令牌桶与冷却状态"""
+
+    def __init__(self, key: str, burst: float):
+        self.key = key
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+
+
+class KeyPool:
+    """
+    多 API Key 调度：每个 Key 一个令牌桶 (rate_per_minute 为 0 表示不限速)，
+    优先用剩余额度最多的 Key；收到 429/额度错误的 Key 按 Retry-After 冷却。
+    """
+
+    MIN_COOLDOWN = 1.0  # Retry-After: 0 或已过去的日期也至少冷却这么久，避免立即重发
+
+    def __init__(self, keys: list, rate_per_minute: float = 0, burst: float = 0):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst if burst > 0 else max(1.0, rate_per_minute)
+        self.keys = [ApiKey(key, self.burst) for key in keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _refill(self, api_key: ApiKey, now: float):
+        if self.rate <= 0:
+            return
+        api_key.tokens = min(self.burst, api_key.tokens + (now - api_key.updated) * self.rate)
+        api_key.updated = now
+
+    def has_available(self) -> bool:
+        now = time.monotonic()
+        return any(k.cooldown_until <= now for k in self.keys)
+
+    def acquire(self):
+        """返回 (ApiKey, 0) 或 (None, 需要等待的秒数)"""
+        if not self.keys:
+            return None, float("inf")
+        now = time.monotonic()
+        available = [k for k in self.keys if k.cooldown_until <= now]
+        if not available:
+            return None, min(k.cooldown_until for k in self.keys) - now
+
+        if self.rate <= 0:
+            best = min(available, key=lambda k: k.requests)
+        else:
+            for api_key in available:
+                self._refill(api_key, now)
+            best = max(available, key=lambda k: k.tokens)
+            if best.tokens < 1:
+                return None, (1 - best.tokens) / self.rate
+            best.tokens -= 1
+        best.requests += 1
+        return best, 0.0
+
+    def throttle(self, api_key: ApiKey, seconds: float):
+        seconds = max(self.MIN_COOLDOWN, seconds)
+        api_key.throttled += 1
+        api_key.tokens = 0
+        api_key.cooldown_until = time.monotonic() + seconds
+        logger.warning(f"🔑 API Key {_mask_key(api_key.key)} 触发限流，冷却 {seconds:.0f} 秒")
+
+    def summary_lines(self) -> list:
+        now = time.monotonic()
+        lines = []
+        for k in self.keys:
+            state = f"冷却中 ({k.cooldown_until - now:.0f}s)" if k.cooldown_until > now else "可用"
+            quota = f" | 剩余令牌 {k.tokens:.1f}" if self.rate > 0 else ""
+            lines.append(f"{_mask_key(k.key)} {state} | 请求 {k.requests} 限流 {k.throttled}{quota}")
+        return lines
+
+
+# ---------------- 核心：延迟直方图 ----------------
+class LatencyHistogram:
+    """
+    固定分桶的延迟直方图，只保留最近两个统计周期的数据，
+    分位数随最近的实际耗时自适应变化。
+    """
+
+    DEFAULT_BOUNDS = (0.5, 1, 2, 3, 5, 8, 10, 12, 15, 18, 20, 25, 30, 40, 50, 60, 80, 100, 120, 180, 240)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS, window: float = 600):
+        self.bounds = tuple(bounds)
+        self.window = window
+        self.current = [0] * (len(self.bounds) + 1)
+        self.previous = [0] * (len(self.bounds) + 1)
+        self.rotated_at = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.rotated_at >= self.window:
+            # 超过两个周期没有数据时旧数据一并丢弃
+            self.previous = self.current if now - self.rotated_at < 2 * self.window else [0] * len(self.current)
+            self.current = [0] * len(self.current)
+            self.rotated_at = now
+
+    def observe(self, value: float):
+        self._rotate()
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+        self.current[index] += 1
+
+    @property
+    def count(self) -> int:
+        self._rotate()
+        return sum(self.current) + sum(self.previous)
+
+    def percentile(self, q: float) -> float:
+        """返回 q 分位所在桶的上界；没有数据返回 0"""
+        total = self.count
+        if total == 0:
+            return 0.0
+        target = q * total
+        seen = 0
+        for i, (cur, prev) in enumerate(zip(self.current, self.previous)):
+            seen += cur + prev
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.bounds[-1] * 2
+        return self.bounds[-1] * 2
+
+
+# ---------------- 核心：分阶段耗时统计 ----------------
+# 当前请求所属的命令 (由各命令入口设置，随任务上下文传递到下载/生成等阶段)
+_current_command = contextvars.ContextVar("gemini_command", default="-")
+
+
+class Histogram:
+    """累计直方图 (与 Prometheus histogram 一致：各桶计数 + 总和 + 总数)"""
+
+    def __init__(self, bounds=LatencyHistogram.DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.bounds[-1] * 2
+        return self.bounds[-1] * 2
+
+
+def _prom_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        escaped.append(f'{k}="{v}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    按 (阶段, 模型, 命令) 统计耗时直方图，另有字节数/失败原因等计数器；
+    可输出为管理员命令里的摘要，也可输出为 Prometheus 文本格式。
+    """
+
+    # 下载/处理等阶段通常在 1 秒内，低端分桶更细
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 10, 15, 20, 25, 30, 45, 60, 90, 120, 180, 240)
+
+    STAGE_NAMES = OrderedDict([
+        ("extract", "提取图片"), ("download", "下载图片"), ("pillow", "图片处理"),
+        ("payload", "构建请求"), ("ttfb", "上游首字节"), ("stream", "流式接收"),
+        ("retry_wait", "重试等待"), ("generate", "生成总计"),
+    ])
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.started = time.time()
+        # 进行中与最近结束的阶段 (供卡顿检测判断卡顿时哪些阶段在跑)
+        self.active = {}
+        self.recent = deque(maxlen=256)
+        self._next_token = 0
+
+    def observe(self, stage: str, seconds: float, model: str = "-", command: str = None):
+        key = (stage, model or "-", command or _current_command.get())
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(self.BOUNDS)
+        hist.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, model: str = "-"):
+        started = time.monotonic()
+        command = _current_command.get()
+        self._next_token += 1
+        token = self._next_token
+        self.active[token] = (stage, command, started)
+        try:
+            yield
+        finally:
+            ended = time.monotonic()
+            del self.active[token]
+            self.recent.append((stage, command, started, ended))
+            self.observe(stage, ended - started, model, command)
+
+    def stages_between(self, start: float, end: float) -> list:
+        """[start, end] 时间段内在跑的阶段，按重叠时长从多到少返回 (阶段, 命令)"""
+        overlap = Counter()
+        for stage, command, started in list(self.active.values()):
+            overlap[(stage, command)] += end - max(start, started)
+        for stage, command, started, ended in list(self.recent):
+            if ended >= start and started <= end:
+                overlap[(stage, command)] += min(end, ended) - max(start, started)
+        return [key for key, _ in overlap.most_common()]
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def counter_total(self, name: str, **match) -> float:
+        return sum(
+            v for (n, labels), v in self.counters.items()
+            if n == name and all(dict(labels).get(k) == m for k, m in match.items())
+        )
+
+    def _merged(self, by: int) -> dict:
+        """按阶段 (by=0) 或 (阶段, 命令/模型) 合并直方图"""
+        merged = {}
+        for key, hist in self.histograms.items():
+            group = key[0] if by == 0 else (key[0], key[by])
+            target = merged.get(group)
+            if target is None:
+                target = merged[group] = Histogram(hist.bounds)
+            target.merge(hist)
+        return merged
+
+    def stage_lines(self) -> list:
+        merged = self._merged(0)
+        lines = []
+        for stage, name in self.STAGE_NAMES.items():
+            hist = merged.get(stage)
+            if hist is None or hist.count == 0:
+                continue
+            lines.append(
+                f"{name}: {hist.count} 次 | 平均 {hist.sum / hist.count:.2f}s | "
+                f"P50 {hist.percentile(0.5):g}s P95 {hist.percentile(0.95):g}s P99 {hist.percentile(0.99):g}s"
+            )
+        return lines
+
+    def breakdown_lines(self, stage: str = "generate", by: int = 2) -> list:
+        """某个阶段按命令 (by=2) 或模型 (by=1) 拆分"""
+        rows = [(group[1], hist) for group, hist in self._merged(by).items() if group[0] == stage and hist.count]
+        rows.sort(key=lambda row: row[1].sum, reverse=True)
+        return [
+            f"{label}: {hist.count} 次 | 平均 {hist.sum / hist.count:.2f}s | P95 {hist.percentile(0.95):g}s"
+            for label, hist in rows
+        ]
+
+    def render_prometheus(self, extra: list = ()) -> str:
+        """extra: 额外的 (指标名, 标签字典, 数值, 类型) 列表"""
+        out = ["# HELP gemini_stage_seconds Time spent in each request stage",
+               "# TYPE gemini_stage_seconds histogram"]
+        for (stage, model, command), hist in sorted(self.histograms.items()):
+            base = {"stage": stage, "model": model, "command": command}
+            cumulative = 0
+            for bound, count in zip(hist.bounds, hist.counts):
+                cumulative += count
+                out.append(f"gemini_stage_seconds_bucket{_prom_labels({**base, 'le': f'{bound:g}'})} {cumulative}")
+            out.append(f"gemini_stage_seconds_bucket{_prom_labels({**base, 'le': '+Inf'})} {hist.count}")
+            out.append(f"gemini_stage_seconds_sum{_prom_labels(base)} {hist.sum:.6f}")
+            out.append(f"gemini_stage_seconds_count{_prom_labels(base)} {hist.count}")
+
+        typed = set()
+        rows = [(name, dict(labels), value, "counter") for (name, labels), value in sorted(self.counters.items())]
+        for name, labels, value, kind in rows + list(extra):
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {name} {kind}")
+            value = int(value) if float(value).is_integer() else value
+            out.append(f"{name}{_prom_labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+
+# ---------------- 核心：事件循环卡顿检测 ----------------
+class LoopLagMonitor:
+    """
+    心跳任务每 interval 秒醒来一次，醒来晚了多少就是事件循环被阻塞了多久；
+    另有一个看门狗线程，心跳超时时抓取事件循环线程的调用栈，定位到具体卡住的代码。
+    超过阈值的卡顿按当时在跑的阶段归类，记录最严重的若干次。
+    """
+
+    def __init__(self, metrics: Metrics, interval: float = 0.1, threshold: float = 0.25, keep: int = 10):
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self.beat = time.monotonic()
+        self.loop_thread_id = None
+        self.by_stage = {}  # 阶段 -> [次数, 总卡顿, 最大卡顿]
+        self.worst = []  # (卡顿秒数, 时间, 阶段列表, 代码位置)
+        self.stalls = 0
+        self.total_lag = 0.0
+        self._captured = (None, "")  # (抓栈时的心跳时间, 代码位置)
+        self._stop = threading.Event()
+        self._thread = None
+        self._plugin_file = os.path.abspath(__file__)
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._watch, name="gemini-loop-watchdog", daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                last_beat, self.beat = self.beat, now
+                lag = now - expected
+                if lag >= self.threshold:
+                    self._report(lag, expected, now, last_beat)
+        finally:
+            self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        """看门狗线程：心跳停了就抓一次事件循环线程的栈 (每次卡顿只抓一次)"""
+        while not self._stop.wait(self.interval / 2):
+            beat = self.beat
+            if self._captured[0] == beat or time.monotonic() - beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            # 优先报插件自己的代码，没有则报最内层
+            own = [f for f in stack if os.path.abspath(f.filename) == self._plugin_file]
+            target = own[-1] if own else stack[-1]
+            where = f"{os.path.basename(target.filename)}:{target.lineno} {target.name}"
+            if own and own[-1] is not stack[-1]:
+                where += f" -> {os.path.basename(stack[-1].filename)}:{stack[-1].lineno} {stack[-1].name}"
+            self._captured = (beat, where)
+
+    def _report(self, lag: float, start: float, end: float, last_beat: float):
+        stages = self.metrics.stages_between(start, end)
+        # 只采用这次卡顿期间抓到的栈
+        captured_beat, where = self._captured
+        if captured_beat != last_beat:
+            where = ""
+        names = [f"{Metrics.STAGE_NAMES.get(stage, stage)}({command})" for stage, command in stages] or ["插件外/空闲"]
+        self.stalls += 1
+        self.total_lag += lag
+        for name in names:
+            entry = self.by_stage.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += lag
+            entry[2] = max(entry[2], lag)
+        self.worst.append((lag, datetime.now().strftime("%m-%d %H:%M:%S"), names, where))
+        self.worst.sort(key=lambda item: item[0], reverse=True)
+        del self.worst[self.keep:]
+        logger.warning(
+            f"🐢 事件循环卡顿 {lag * 1000:.0f}ms | 进行中: {', '.join(names)}"
+            + (f" | 位置: {where}" if where else "")
+        )
+
+    def summary(self) -> str:
+        return (
+            f"阈值 {self.threshold * 1000:.0f}ms | 卡顿 {self.stalls} 次，共 {self.total_lag:.1f}s"
+            + (f"，最长 {self.worst[0][0] * 1000:.0f}ms" if self.worst else "")
+        )
+
+    def stage_lines(self, top: int = 8) -> list:
+        rows = sorted(self.by_stage.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        return [f"{name}: {n} 次 | 共 {total:.2f}s | 最长 {peak * 1000:.0f}ms" for name, (n, total, peak) in rows]
+
+    def worst_lines(self) -> list:
+        return [
+            f"{when} {lag * 1000:.0f}ms | {', '.join(names)}" + (f" | {where}" if where else "")
+            for lag, when, names, where in self.worst
+        ]
+
+
+# ---------------- 核心：对冲请求 ----------------
+class HedgePolicy:
+    """
+    文生图对冲：超过最近耗时的某个分位仍未出图时再发一份请求，谁先出图用谁；
+    额外请求按预算比例积攒令牌，防止对冲把上游负载放大。
+    """
+
+    def __init__(self, enabled: bool = False, percentile: float = 0.9, initial_delay: float = 30,
+                 min_delay: float = 5, min_samples: int = 20, budget_percent: float = 10, model: str = ""):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget = budget_percent / 100
+        self.model = model
+        self.latency = LatencyHistogram()
+        self.tokens = 0.0
+        self.max_tokens = 5.0
+        self.stats = Counter()
+
+    def delay(self) -> float:
+        """本次请求多久没出图就发对冲请求"""
+        if self.latency.count < self.min_samples:
+            return self.initial_delay
+        return max(self.min_delay, self.latency.percentile(self.percentile))
+
+    def on_request(self):
+        self.stats["requests"] += 1
+        self.tokens = min(self.max_tokens, self.tokens + self.budget)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            self.stats["budget_denied"] += 1
+            return False
+        self.tokens -= 1
+        self.stats["hedged"] += 1
+        return True
+
+    def summary(self) -> str:
+        if not self.enabled:
+            return "❌ 禁用"
+        return (
+            f"触发 {self.delay():.0f}s (P{self.percentile * 100:.0f}，样本 {self.latency.count}) | "
+            f"请求 {self.stats['requests']} 对冲 {self.stats['hedged']} 对冲胜出 {self.stats['hedge_won']} "
+            f"预算不足 {self.stats['budget_denied']} 名额不足 {self.stats['admission_denied']}"
+        )
+
+
+# ---------------- 核心：重试策略 ----------------
+class RetryPolicy:
+    """
+    失败分类 + 指数退避 (全抖动) + 整体截止时间：
+    401/403/400 这类请求本身的问题不重试；超时、网络错误、5xx、限流才重试，
+    每次尝试的超时会收缩到剩余时间以内。
+    """
+
+    RETRYABLE_STATUS = {408, 413, 425, 429, 500, 502, 503, 504}
+    OUTCOME_NAMES = {
+        "ok": "成功", "no_url": "无图片链接", "timeout": "超时", "network": "网络错误",
+        "server_error": "服务端错误", "rate_limited": "限流", "auth_error": "鉴权失败",
+        "client_error": "请求被拒绝", "error": "其他异常", "deadline": "超出总时限",
+        "circuit_open": "熔断拦截",
+    }
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 10.0,
+                 attempt_timeout: float = 120, deadline: float = 240, min_attempt_timeout: float = 10):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.min_attempt_timeout = min_attempt_timeout
+        self.outcomes = Counter()
+
+    def classify_status(self, status: int, has_url: bool = True):
+        """返回 (结果分类, 是否值得重试)"""
+        if status == 200:
+            return ("ok", False) if has_url else ("no_url", True)
+        if status == 429:
+            return "rate_limited", True
+        if status in (401, 403):
+            return "auth_error", False
+        if status >= 500:
+            return "server_error", status in self.RETRYABLE_STATUS
+        return "client_error", status in self.RETRYABLE_STATUS
+
+    @staticmethod
+    def classify_exception(exc: BaseException):
+        if isinstance(exc, asyncio.TimeoutError):
+            return "timeout", True
+        if isinstance(exc, aiohttp.ClientError):
+            return "network", True
+        return "error", False
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次失败后的等待时间 (全抖动)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def attempt_timeout_for(self, remaining: float) -> float:
+        return min(self.attempt_timeout, remaining)
+
+    def start_deadline(self) -> float:
+        """从现在起算的截止时刻 (monotonic)；在指令入口创建，排队、对冲、重试共用同一个"""
+        return time.monotonic() + self.deadline
+
+    def record(self, outcome: str):
+        self.outcomes[outcome] += 1
+
+    def summary(self) -> str:
+        if not self.outcomes:
+            return "暂无"
+        return " | ".join(f"{self.OUTCOME_NAMES.get(k, k)} {v}" for k, v in self.outcomes.most_common())
+
+
+class ImageTooLarge(Exception):
+    """输入图片超过下载大小上限"""
+
+
+class ImagePoolBusy(Exception):
+    """图片处理队列已满"""
+
+
+class ImageWorkerPool:
+    """Pillow 任务池：在线程/进程池里执行，带有界队列、单任务超时和耗时统计"""
+
+    def __init__(self, mode: str = "thread", max_workers: int = 0, max_queue: int = 32, timeout: float = 30.0):
+        self.mode = "process" if str(mode).lower() == "process" else "thread"
+        self.max_workers = max_workers if max_workers > 0 else min(4, os.cpu_count() or 1)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._executor = None
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._pending = 0
+        self.stats = {"done": 0, "timeout": 0, "rejected": 0, "failed": 0, "wait_total": 0.0, "cost_total": 0.0}
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gemini-img")
+        return self._executor
+
+    async def run(self, label: str, func, *args):
+        """提交一个 Pillow 任务；队列满抛 ImagePoolBusy，超时抛 asyncio.TimeoutError"""
+        if self._pending >= self.max_workers + self.max_queue:
+            self.stats["rejected"] += 1
+            raise ImagePoolBusy(f"图片处理队列已满 ({self._pending})")
+
+        self._pending += 1
+        enqueued = time.perf_counter()
+        try:
+            async with self._slots:
+                waited = time.perf_counter() - enqueued
+                started = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self._get_executor(), functools.partial(func, *args))
+                try:
+                    result = await asyncio.wait_for(future, timeout=self.timeout)
+                except asyncio.TimeoutError:
+                    self.stats["timeout"] += 1
+                    logger.error(f"⏰ [{label}] 图片处理超时 ({self.timeout}秒)，排队 {waited * 1000:.0f}ms")
+                    raise
+                except Exception:
+                    self.stats["failed"] += 1
+                    raise
+
+                cost = time.perf_counter() - started
+                self.stats["done"] += 1
+                self.stats["wait_total"] += waited
+                self.stats["cost_total"] += cost
+                logger.info(f"🧵 [{label}] 排队 {waited * 1000:.0f}ms | 处理 {cost * 1000:.0f}ms")
+                return result
+        finally:
+            self._pending -= 1
+
+    def summary(self) -> str:
+        done = self.stats["done"]
+        avg_wait = self.stats["wait_total"] / done * 1000 if done else 0
+        avg_cost = self.stats["cost_total"] / done * 1000 if done else 0
+        return (
+            f"{self.mode} x{self.max_workers} | 完成 {done} | 平均排队 {avg_wait:.0f}ms | 平均处理 {avg_cost:.0f}ms | "
+            f"超时 {self.stats['timeout']} | 拒绝 {self.stats['rejected']}"
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# ---------------- 核心：输入图片获取策略 ----------------
+class InputFailure:
+    """输入图片获取失败的原因：回退/竞速/提示按原因分支，失败文字只用于展示"""
+
+    DOWNLOAD = "download"  # 下载不到 (HTTP 错误/网络异常)：内网或失效链接，不外发给转换API
+    DECODE = "decode"  # 下载成功但 Pillow 解码失败：本地路径里只有这种值得再试转换API
+    TOO_LARGE = "too_large"  # 超过下载大小上限：换条路也一样大
+    CONVERT = "convert"  # 转换API禁用/请求失败/超时，或返回的 base64 无法解码
+    CONVERT_DEBUG = "convert_debug"  # 转换API返回 200 但提取不到 base64，失败文字是调试信息
+    INVALID = "invalid"  # 消息里的 base64 图片数据无法解码
+
+
+class InputPathStats:
+    """某个图片域名上某条获取路径 (本地/转换API) 的成功率与耗时 (指数滑动平均)"""
+
+    __slots__ = ("attempts", "ok", "failed", "wins", "races", "latency", "success_rate", "win_rate")
+
+    def __init__(self):
+        self.attempts = 0
+        self.ok = 0
+        self.failed = 0
+        self.wins = 0
+        self.races = 0
+        self.latency = None  # 成功时的平均耗时
+        self.success_rate = 1.0
+        self.win_rate = 0.5
+
+
+class InputStrategy:
+    """
+    输入图片的获取策略：local=下载后本地 Pillow 处理，remote=第三方转换API，
+    sequential=先本地失败再转换，race=两条路同时跑、先拿到有效结果者胜，
+    auto=按每个图片域名的统计自动选择 (样本不足或定期探测时竞速，某条路明显更快更稳就只走它)。
+    race/auto 会把每个图片链接都发给第三方转换API，需要显式开启；默认 sequential 只在本地解码失败时才用转换API。
+    """
+
+    POLICIES = ("local", "remote", "sequential", "race", "auto")
+    PATH_NAMES = {"local": "本地处理", "remote": "转换API"}
+    ALPHA = 0.2
+
+    def __init__(self, policy: str = "sequential", min_samples: int = 5, explore_percent: float = 10,
+                 dominance: float = 0.8, max_hosts: int = 64):
+        self.policy = policy if policy in self.POLICIES else "sequential"
+        self.min_samples = max(1, min_samples)
+        self.explore = explore_percent / 100
+        self.dominance = dominance
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()  # host -> {"local": InputPathStats, "remote": InputPathStats}
+        self.plans = Counter()
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        return (urlparse(url).hostname or "-").lower()
+
+    def _paths(self, host: str) -> dict:
+        paths = self._hosts.get(host)
+        if paths is None:
+            paths = self._hosts[host] = {"local": InputPathStats(), "remote": InputPathStats()}
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        return paths
+
+    def plan(self, host: str, local_ok: bool = True, remote_ok: bool = True):
+        """返回本次的执行方式：("race",) 或按顺序尝试的路径元组，例如 ("local", "remote")"""
+        if not local_ok:
+            plan = ("remote",)
+        elif not remote_ok:
+            plan = ("local",)
+        elif self.policy == "local":
+            plan = ("local",)
+        elif self.policy == "remote":
+            plan = ("remote",)
+        elif self.policy == "sequential":
+            plan = ("local", "remote")
+        elif self.policy == "race":
+            plan = ("race",)
+        else:
+            plan = self._auto_plan(host)
+        self.plans["+".join(plan)] += 1
+        return plan
+
+    def _auto_plan(self, host: str):
+        paths = self._paths(host)
+        local, remote = paths["local"], paths["remote"]
+        if min(local.races, remote.races) < self.min_samples or random.random() < self.explore:
+            return ("race",)
+        for name, other in (("local", "remote"), ("remote", "local")):
+            stats = paths[name]
+            if stats.win_rate >= self.dominance and stats.success_rate >= 0.9:
+                return (name, other)
+        return ("race",)
+
+    def record(self, host: str, path: str, ok: bool, seconds: float):
+        stats = self._paths(host)[path]
+        stats.attempts += 1
+        if ok:
+            stats.ok += 1
+            stats.latency = seconds if stats.latency is None else (
+                stats.latency + self.ALPHA * (seconds - stats.latency))
+        else:
+            stats.failed += 1
+        stats.success_rate += self.ALPHA * ((1.0 if ok else 0.0) - stats.success_rate)
+
+    def record_race(self, host: str, winner: str):
+        """一次竞速结束；winner 为空表示两条路都失败"""
+        for name, stats in self._paths(host).items():
+            stats.races += 1
+            won = 1.0 if name == winner else 0.0
+            stats.wins += int(won)
+            stats.win_rate += self.ALPHA * (won - stats.win_rate)
+
+    def summary(self) -> str:
+        plans = " ".join(f"{k} {v}" for k, v in self.plans.most_common()) or "暂无"
+        return f"{self.policy} | {plans}"
+
+    def host_lines(self, limit: int = 10) -> list:
+        lines = []
+        hosts = sorted(self._hosts.items(), key=lambda kv: -(kv[1]["local"].attempts + kv[1]["remote"].attempts))
+        for host, paths in hosts[:limit]:
+            parts = []
+            for name, stats in paths.items():
+                if not stats.attempts:
+                    continue
+                latency = f"{stats.latency * 1000:.0f}ms" if stats.latency is not None else "-"
+                part = f"{self.PATH_NAMES[name]} {stats.ok}/{stats.attempts} 平均 {latency}"
+                if stats.races:
+                    part += f" 竞速胜 {stats.wins}/{stats.races}"
+                parts.append(part)
+            if parts:
+                lines.append(f"{host}: " + " | ".join(parts))
+        return lines
+
+    def iter_stats(self):
+        for host, paths in self._hosts.items():
+            for name, stats in paths.items():
+                yield host, name, stats
+
+
+# ---------------- 核心：SSE 增量解析器 ----------------
+# 生成结果里的图片链接 (按优先级：markdown 图片 > 括号包裹 > 裸链接)
+_MD_IMAGE_URL_RE = re.compile(r'!\[.*?\]\((https?://[^\s)]+)\)', re.IGNORECASE)
+_PAREN_URL_RE = re.compile(r'\((https?://[^\s)]+)\)', re.IGNORECASE)
+_BARE_URL_RE = re.compile(r'(https?://[^\s<>"]+)', re.IGNORECASE)
+_URL_SPLIT_RE = re.compile(r'[\s\n\r\t,.;:!?()\[\]{}]+')
+_URL_TAIL_RE = re.compile(r'[.,;:!?)\]]+$')
+
+
+class SSEStreamParser:
+    """
+    增量解析 OpenAI 兼容的 SSE 流：
+    1. 按字节缓冲，兼容一行被拆到多个 TCP 包里的情况
+    2. 空行结束一个事件，多行 data 会拼接后再解析
+    3. 拼接所有 delta.content，括号闭合的图片链接一出现即可提前返回
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data_lines = []
+        self.content = ""
+        self.done = False
+        self.bad_chunks = 0
+
+    def feed(self, chunk: bytes) -> str:
+        """喂入一段原始字节，返回本次新增的文本"""
+        self._buffer.extend(chunk)
+        added = []
+        while True:
+            idx = self._buffer.find(b"\n")
+            if idx < 0:
+                break
+            raw = bytes(self._buffer[:idx])
+            del self._buffer[:idx + 1]
+            text = self._handle_line(raw.rstrip(b"\r").decode("utf-8", errors="replace"))
+            if text:
+                added.append(text)
+        return "".join(added)
+
+    def close(self) -> str:
+        """流结束：处理残留的半行与未分发的事件"""
+        added = []
+        if self._buffer:
+            raw = bytes(self._buffer)
+            self._buffer.clear()
+            text = self._handle_line(raw.rstrip(b"\r").decode("utf-8", errors="replace"))
+            if text:
+                added.append(text)
+        text = self._dispatch()
+        if text:
+            added.append(text)
+        return "".join(added)
+
+    def _handle_line(self, line: str) -> str:
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return ""  # SSE 注释/心跳
+        if line.startswith("data:"):
+            value = line[5:]
+            if value.startswith(" "):
+                value = value[1:]
+            self._data_lines.append(value)
+        return ""
+
+    def _dispatch(self) -> str:
+        if not self._data_lines:
+            return ""
+        data_lines, self._data_lines = self._data_lines, []
+
+        # 标准多行事件先整体解析；不规范的服务端每行一个 JSON 且不空行分隔，逐行兜底
+        text = self._parse_data("\n".join(data_lines))
+        if text is None and len(data_lines) > 1:
+            text = "".join(self._parse_data(item) or "" for item in data_lines)
+        return text or ""
+
+    def _parse_data(self, data: str):
+        data = data.strip()
+        if not data:
+            return ""
+        if data == "[DONE]":
+            self.done = True
+            return ""
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            self.bad_chunks += 1
+            return None
+
+        if not isinstance(chunk, dict):
+            return ""
+        choices = chunk.get("choices")
+        if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+            return ""
+        delta = choices[0].get("delta") or {}
+        content_text = delta.get("content") if isinstance(delta, dict) else None
+        if not isinstance(content_text, str) or not content_text:
+            return ""
+        self.content += content_text
+        return content_text
+
+    def find_image_url(self, final: bool = False) -> str:
+        """提取图片链接；流未结束时只认括号已闭合的链接，避免截断"""
+        content = self.content
+        for pattern in (_MD_IMAGE_URL_RE, _PAREN_URL_RE):
+            match = pattern.search(content)
+            if match:
+                return match.group(1)
+        if not final:
+            return ""
+
+        match = _BARE_URL_RE.search(content)
+        if match:
+            return match.group(1)
+        if "http" in content.lower():
+            for word in _URL_SPLIT_RE.split(content):
+                if word.lower().startswith(('http://', 'https://')):
+                    return _URL_TAIL_RE.sub('', word)
+        return ""
+
+
+# ---------------- 核心：快捷指令路由 ----------------
+class PromptRouter:
+    """
+    快捷指令前缀树：每条消息只按字符走一遍树，首字符不是任何指令的开头就立刻放行，
+    不 strip/split 整条消息；指令名和别名编译进同一棵树，命中后返回规范指令名与剩余参数。
+    """
+
+    __slots__ = ("_root", "_lead", "size", "lookups", "matches", "rejected_first", "steps", "cost", "hits")
+
+    _END = ""  # 节点字典里保存规范指令名的键 (不会与单个字符冲突)
+
+    def __init__(self, names: dict = None):
+        self._root = {}
+        self._lead = frozenset()
+        self.size = 0
+        self.lookups = 0
+        self.matches = 0
+        self.rejected_first = 0  # 首字符即被排除的消息数
+        self.steps = 0
+        self.cost = 0.0
+        self.hits = Counter()
+        if names:
+            self.compile(names)
+
+    @classmethod
+    def build(cls, names: dict):
+        """
+        names: 指令名或别名 -> 规范指令名；含空白的名字无法作为指令，跳过。
+        返回编译结果 (可以在线程里构建，再用 load 一次性换上)
+        """
+        root = {}
+        size = 0
+        for name, target in names.items():
+            if not name or any(ch.isspace() for ch in name):
+                continue
+            node = root
+            for ch in name:
+                node = node.setdefault(ch, {})
+            node[cls._END] = target
+            size += 1
+        # 消息首字符不在这里面就一定不是指令 (前导空白和 / 会被跳过，所以也算在内)
+        lead = frozenset(root) | frozenset("/ \t\r\n\u3000")
+        return root, lead, size
+
+    def load(self, compiled):
+        """换上新的前缀树，统计数据保留"""
+        self._root, self._lead, self.size = compiled
+
+    def compile(self, names: dict):
+        self.load(self.build(names))
+
+    def match(self, text: str):
+        """返回 (规范指令名, 参数文本)；不是快捷指令返回 None"""
+        self.lookups += 1
+        if not text or text[0] not in self._lead:
+            self.rejected_first += 1
+            return None
+
+        started = time.perf_counter()
+        n = len(text)
+        i = 0
+        while i < n and text[i].isspace():
+            i += 1
+        while i < n and text[i] == "/":
+            i += 1
+        node = self._root
+        first = i
+        while i < n:
+            ch = text[i]
+            if ch.isspace():
+                break
+            node = node.get(ch)
+            if node is None:
+                break
+            i += 1
+        self.steps += i - first + 1
+        target = node.get(self._END) if node is not None and i > first else None
+        if target is None:
+            self.cost += time.perf_counter() - started
+            return None
+        self.matches += 1
+        self.hits[target] += 1
+        self.cost += time.perf_counter() - started
+        return target, text[i:].strip()
+
+    def summary(self) -> str:
+        walked = self.lookups - self.rejected_first
+        avg = self.cost / walked * 1e6 if walked else 0
+        steps = self.steps / walked if walked else 0
+        return (
+            f"{self.size} 个指令名 | 检查 {self.lookups} 条 命中 {self.matches} "
+            f"首字符排除 {self.rejected_first} | 查树平均 {avg:.2f}µs / {steps:.1f} 步"
+        )
+
+
+# ---------------- 核心：提示词库 ----------------
+class PromptEntry:
+    """一条快捷提示词：指令名、别名、分类、默认模型和对输入图片的要求"""
+
+    __slots__ = ("name", "prompt", "aliases", "category", "model", "image")
+
+    IMAGE_MODES = {"optional": "可选", "required": "需图", "none": "不用图"}
+
+    def __init__(self, name: str, prompt: str, aliases=(), category: str = "", model: str = "",
+                 image: str = "optional"):
+        self.name = name
+        self.prompt = prompt
+        self.aliases = tuple(a for a in aliases if a and a != name)
+        self.category = category or "未分类"
+        self.model = model
+        self.image = image if image in self.IMAGE_MODES else "optional"
+
+    @classmethod
+    def from_config_line(cls, item: str):
+        """配置里的 "指令名|别名1|别名2:描述"，格式不对返回 None"""
+        if not isinstance(item, str) or ":" not in item:
+            return None
+        names, value = item.split(":", 1)
+        name, *aliases = [n.strip() for n in names.split("|")]
+        if not name:
+            return None
+        return cls(name, value.strip(), aliases)
+
+    @classmethod
+    def from_dict(cls, data: dict, name: str = ""):
+        name = str(data.get("name") or name).strip()
+        prompt = str(data.get("prompt") or "").strip()
+        if not name or not prompt:
+            raise ValueError(f"提示词缺少 name/prompt: {name or data!r}")
+        aliases = data.get("aliases") or []
+        if isinstance(aliases, str):
+            aliases = aliases.split("|")
+        return cls(name, prompt, [str(a).strip() for a in aliases], str(data.get("category") or "").strip(),
+                   str(data.get("model") or "").strip(), str(data.get("image") or "optional").strip().lower())
+
+    def describe(self) -> str:
+        text = self.name
+        if self.aliases:
+            text += f" ({'/'.join(self.aliases)})"
+        if self.image != "optional":
+            text += f" [{self.IMAGE_MODES[self.image]}]"
+        return text
+
+
+class PromptLibrary:
+    """
+    提示词库快照：条目、别名、分类索引和编译好的路由前缀树一起构建，构建完成后整体替换，
+    处理中的指令拿到的始终是同一份完整数据。后出现的同名条目覆盖前面的 (文件覆盖配置)。
+    """
+
+    def __init__(self, entries: list, source: str = ""):
+        self.entries = OrderedDict()
+        for entry in entries:
+            self.entries.pop(entry.name, None)
+            self.entries[entry.name] = entry
+        self.aliases = {}
+        self.categories = OrderedDict()
+        for entry in self.entries.values():
+            for alias in entry.aliases:
+                self.aliases.setdefault(alias, entry.name)
+            self.categories.setdefault(entry.category, []).append(entry.name)
+        # 指令名优先于同名别名
+        self.compiled = PromptRouter.build({**self.aliases, **{name: name for name in self.entries}})
+        self.source = source
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name: str):
+        return self.entries.get(name)
+
+    @staticmethod
+    def parse_file(path: Path) -> list:
+        """
+        读取提示词文件 (.json / .yaml / .yml)，支持两种写法：
+        列表 [{"name", "prompt", "aliases", "category", "model", "image"}, ...] (也可以包在 {"prompts": [...]} 里)，
+        或字典 {指令名: 描述 或 {prompt, aliases, ...}}
+        """
+        text = path.read_text(encoding="utf-8")
+        if path.suffix.lower() in (".yaml", ".yml"):
+            if yaml is None:
+                raise RuntimeError("读取 YAML 提示词库需要安装 PyYAML")
+            data = yaml.safe_load(text)
+        else:
+            data = json.loads(text)
+        if isinstance(data, dict) and isinstance(data.get("prompts"), list):
+            data = data["prompts"]
+
+        entries = []
+        if isinstance(data, list):
+            for item in data:
+                if not isinstance(item, dict):
+                    raise ValueError(f"提示词条目格式不正确: {item!r}")
+                entries.append(PromptEntry.from_dict(item))
+        elif isinstance(data, dict):
+            for name, value in data.items():
+                value = {"prompt": value} if isinstance(value, str) else (value or {})
+                entries.append(PromptEntry.from_dict(value, str(name)))
+        elif data is not None:
+            raise ValueError("提示词文件顶层应为列表或字典")
+        return entries
+
+    def search(self, keyword: str = "") -> list:
+        """按分类 (完全匹配) 或指令名/别名 (包含) 筛选"""
+        if not keyword:
+            return list(self.entries.values())
+        if keyword in self.categories:
+            return [self.entries[name] for name in self.categories[keyword]]
+        return [e for e in self.entries.values()
+                if keyword in e.name or any(keyword in alias for alias in e.aliases)]
+
+
 @register("gemini-draw", "Flow2API", "谷歌绘图插件 (纯base64版)", "8.6")
 class GeminiDraw(Star):
     def __init__(self, context: Context, config: dict):
         super().__init__(context)
-        self.api_url = config.get("api_url", "http://172.17.0.1:8000/v1/chat/completions")
-        self.apikey = config.get("apikey", "")
+        # api_url 可填多个后端 (列表，或用逗号/换行分隔)
+        api_url = config.get("api_url", "http://172.17.0.1:8000/v1/chat/completions")
+        if isinstance(api_url, str):
+            api_urls = [u.strip() for u in re.split(r'[,\s]+', api_url) if u.strip()]
+        else:
+            api_urls = [str(u).strip() for u in api_url if str(u).strip()]
+        self.api_urls = api_urls or ["http://172.17.0.1:8000/v1/chat/completions"]
+        self.api_url = self.api_urls[0]
+        # apikey 可填多个 (逗号分隔)，按额度轮换
+        apikey = config.get("apikey", "")
+        if isinstance(apikey, str):
+            self.apikeys = [k.strip() for k in apikey.split(",") if k.strip()]
+        else:
+            self.apikeys = [str(k).strip() for k in apikey if str(k).strip()]
+        self.apikey = self.apikeys[0] if self.apikeys else ""
 
         # 定义所有可用模型（新增完整列表）
         self.available_models = [
@@ -50,150 +2234,860 @@ class GeminiDraw(Star):
         self.convert_api_url = config.get("convert_api_url", "https://api.s01s.cn/API/url_ba64/")
         self.enable_convert_api = config.get("enable_convert_api", True)
 
-        self.prompt_map: dict = {}
-        self._load_prompt_map(config)
+        # HTTP 连接池配置 (生成API 与 图片CDN 分池，长连接复用)
+        pool_cfg = config.get("http_pool", {}) or {}
+        self.http_pool_config = {
+            "api_limit": int(pool_cfg.get("api_limit", 32)),
+            "api_limit_per_host": int(pool_cfg.get("api_limit_per_host", 16)),
+            "cdn_limit": int(pool_cfg.get("cdn_limit", 64)),
+            "cdn_limit_per_host": int(pool_cfg.get("cdn_limit_per_host", 8)),
+            "keepalive_timeout": float(pool_cfg.get("keepalive_timeout", 60)),
+            "dns_cache_ttl": int(pool_cfg.get("dns_cache_ttl", 300)),
+        }
+        self._sessions: dict = {}
+
+        # Pillow 处理池 (避免解码/缩放/编码阻塞事件循环)
+        pool_cfg = config.get("image_pool", {}) or {}
+        self.image_pool = ImageWorkerPool(
+            mode=pool_cfg.get("mode", "thread"),
+            max_workers=int(pool_cfg.get("max_workers", 0)),
+            max_queue=int(pool_cfg.get("max_queue", 32)),
+            timeout=float(pool_cfg.get("timeout", 30)),
+        )
+
+        # 输入图片下载上限 (流式读取，超过立即中断)
+        self.max_image_bytes = int(float(config.get("max_image_mb", 20)) * 1024 * 1024)
+
+        # 图生图载荷预算 (按 base64 体积计算，重试时逐档缩小)
+        self.payload_budget_kb = int(config.get("payload_budget_kb", 1536))
+        self.retry_budget_ratio = float(config.get("retry_budget_ratio", 0.5))
+        self.model_payload_budgets: dict = {}
+        for item in config.get("model_payload_budgets", []) or []:
+            if ":" not in str(item):
+                continue
+            model, kb = str(item).rsplit(":", 1)
+            try:
+                self.model_payload_budgets[model.strip()] = int(kb.strip())
+            except ValueError:
+                logger.warning(f"⚠️ 无效的模型预算配置: {item}")
+
+        # 输入图片缓存：URL -> 内容哈希 -> 预处理结果 (同一张图不同链接也能复用)
+        cache_cfg = config.get("image_cache", {}) or {}
+        self.enable_image_cache = bool(cache_cfg.get("enable", True))
+        self.url_cache = LRUCache(
+            max_bytes=1024 * 1024,
+            ttl=float(cache_cfg.get("url_ttl", 600)),
+            max_items=int(cache_cfg.get("url_max_entries", 2048)),
+        )
+        self.content_cache = LRUCache(
+            max_bytes=int(float(cache_cfg.get("max_mb", 64)) * 1024 * 1024),
+            ttl=float(cache_cfg.get("content_ttl", 3600)),
+        )
+
+        # QQ 头像磁盘缓存 (ETag/Last-Modified 校验，过期先用旧图再后台刷新)
+        avatar_cfg = config.get("avatar_cache", {}) or {}
+        self.avatar_store = None
+        if avatar_cfg.get("enable", True):
+            try:
+                self.avatar_store = AvatarStore(
+                    self._get_data_dir() / "avatars",
+                    fresh_ttl=float(avatar_cfg.get("fresh_ttl", 21600)),
+                    memory_mb=float(avatar_cfg.get("memory_mb", 16)),
+                )
+            except (OSError, RuntimeError) as e:
+                logger.warning(f"⚠️ 头像缓存目录不可用，已禁用: {e}")
+        self._avatar_refreshing: set = set()
+        self._background_tasks: set = set()
+
+        # 相同请求合并 (模型+提示词+图片哈希相同且正在生成时，共享同一次上游调用)
+        # 列表里填指令名：文、图、具体快捷指令名，或 "快捷指令" 表示全部快捷指令
+        self.coalesce_commands = set(config.get("coalesce_commands", ["快捷指令"]) or [])
+        self._inflight: dict = {}
+        self.coalesce_stats = {"leader": 0, "joined": 0}
+
+        # 文生图结果缓存 (相同提示词+模型在有效期内直接返回上次的结果；指令后加 --new 强制重新生成)
+        result_cfg = config.get("result_cache", {}) or {}
+        self.result_cache = None
+        if result_cfg.get("enable", False):
+            db_path = None
+            if result_cfg.get("persist", False):
+                try:
+                    db_path = self._get_data_dir() / "result_cache.db"
+                except (OSError, RuntimeError) as e:
+                    logger.warning(f"⚠️ 结果缓存磁盘目录不可用，仅使用内存: {e}")
+            try:
+                self.result_cache = ResultCache(
+                    ttl=float(result_cfg.get("ttl", 3600)),
+                    max_entries=int(result_cfg.get("max_entries", 512)),
+                    db_path=db_path,
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ 结果缓存数据库初始化失败，仅使用内存: {e}")
+                self.result_cache = ResultCache(
+                    ttl=float(result_cfg.get("ttl", 3600)),
+                    max_entries=int(result_cfg.get("max_entries", 512)),
+                )
+
+        # 生成请求准入控制 (全局/每用户/每群并发上限 + 按群轮转的有界队列)
+        admission_cfg = config.get("admission", {}) or {}
+        self.admission = AdmissionController(
+            max_concurrent=int(admission_cfg.get("max_concurrent", 8)),
+            per_user=int(admission_cfg.get("per_user", 1)),
+            per_group=int(admission_cfg.get("per_group", 3)),
+            max_queue=int(admission_cfg.get("max_queue", 50)),
+            max_queue_per_user=int(admission_cfg.get("max_queue_per_user", 2)),
+            queue_timeout=float(admission_cfg.get("queue_timeout", 300)),
+        )
+
+        # 多后端调度 + 健康检查
+        lb_cfg = config.get("load_balance", {}) or {}
+        self.backends = BackendPool(
+            self.api_urls,
+            strategy=lb_cfg.get("strategy", "least_outstanding"),
+            eject_after=int(lb_cfg.get("eject_after", 3)),
+            eject_seconds=float(lb_cfg.get("eject_seconds", 30)),
+        )
+        self.health_check_interval = float(lb_cfg.get("health_check_interval", 30))
+        self._health_task = None
+
+        # 分阶段耗时/计数指标 (可选 Prometheus 端点或定期写文件)
+        metrics_cfg = config.get("metrics", {}) or {}
+        self.metrics = Metrics()
+        self.metrics_host = metrics_cfg.get("prometheus_host", "127.0.0.1") or "127.0.0.1"
+        self.metrics_port = int(metrics_cfg.get("prometheus_port", 0))
+        self.metrics_dump_file = metrics_cfg.get("dump_file", "").strip()
+        self.metrics_dump_interval = max(5.0, float(metrics_cfg.get("dump_interval", 60)))
+        self._metrics_runner = None
+
+        # 事件循环卡顿检测 (开销很小，默认开启)
+        lag_cfg = config.get("loop_monitor", {}) or {}
+        self.loop_monitor = None
+        if lag_cfg.get("enable", True):
+            self.loop_monitor = LoopLagMonitor(
+                self.metrics,
+                interval=max(10, int(lag_cfg.get("interval_ms", 100))) / 1000,
+                threshold=max(10, int(lag_cfg.get("threshold_ms", 250))) / 1000,
+            )
+
+        # SSE 录制 (默认关闭，供 bench/replay_sse.py 回放)
+        record_cfg = config.get("sse_record", {}) or {}
+        self.sse_recorder = None
+        if record_cfg.get("enable", False):
+            self.sse_recorder = SSERecorder(
+                self._get_data_dir() / "sse_records",
+                sample_percent=float(record_cfg.get("sample_percent", 100)),
+                max_files=int(record_cfg.get("max_files", 500)),
+            )
+
+        # 对冲请求 (仅文生图/无图快捷指令)
+        hedge_cfg = config.get("hedge", {}) or {}
+        self.hedge = HedgePolicy(
+            enabled=hedge_cfg.get("enable", False),
+            percentile=float(hedge_cfg.get("percentile", 90)) / 100,
+            initial_delay=float(hedge_cfg.get("initial_delay", 30)),
+            min_delay=float(hedge_cfg.get("min_delay", 5)),
+            budget_percent=float(hedge_cfg.get("budget_percent", 10)),
+            model=hedge_cfg.get("model", "").strip(),
+        )
+
+        # 熔断器 (每个后端、每个模型各一个，按滑动窗口错误率/超时率打开)
+        cb_cfg = config.get("circuit_breaker", {}) or {}
+        self.breakers = CircuitBreakerBoard(
+            enabled=cb_cfg.get("enable", True),
+            window=float(cb_cfg.get("window_seconds", 60)),
+            min_requests=int(cb_cfg.get("min_requests", 5)),
+            error_rate=float(cb_cfg.get("error_rate", 0.5)),
+            timeout_rate=float(cb_cfg.get("timeout_rate", 0.5)),
+            open_seconds=float(cb_cfg.get("open_seconds", 30)),
+            probes=int(cb_cfg.get("half_open_probes", 1)),
+        )
+
+        # 输入图片获取策略 (本地处理 / 转换API / 先后 / 竞速 / 按域名自动选择)
+        input_cfg = config.get("input_strategy", {}) or {}
+        self.input_strategy = InputStrategy(
+            policy=str(input_cfg.get("policy", "sequential")).lower(),
+            min_samples=int(input_cfg.get("min_samples", 5)),
+            explore_percent=float(input_cfg.get("explore_percent", 10)),
+        )
+
+        # 后台任务模式：/文 /图 和快捷指令立即返回任务号，生成完成后主动推送结果
+        jobs_cfg = config.get("jobs", {}) or {}
+        self.job_store = None
+        self.job_workers = max(1, int(jobs_cfg.get("workers", 2)))
+        self.job_max_per_user = max(1, int(jobs_cfg.get("max_per_user", 5)))
+        self.job_max_queue = max(1, int(jobs_cfg.get("max_queue", 200)))
+        self.job_stats = Counter()
+        self._job_wakeup = asyncio.Event()
+        self._running_jobs: dict = {}  # 任务号 -> (Task, 用户)
+        self._cancelled_jobs: set = set()
+        if jobs_cfg.get("enable", False):
+            try:
+                self.job_store = JobStore(
+                    self._get_data_dir() / "jobs.db",
+                    max_attempts=int(jobs_cfg.get("max_attempts", 2)),
+                    keep_hours=float(jobs_cfg.get("keep_hours", 24)),
+                )
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                logger.error(f"❌ 后台任务数据库初始化失败，改为直接生成: {e}")
+
+        # 批量生成 (/批量)：一条指令出多张图，可同时用多个模型
+        batch_cfg = config.get("batch", {}) or {}
+        self.batch_max_count = max(1, int(batch_cfg.get("max_count", 4)))
+        self.batch_concurrency = max(1, int(batch_cfg.get("concurrency", 2)))
+        self.batch_merge = bool(batch_cfg.get("merge", False))
+
+        # API Key 池 (每个 Key 独立令牌桶，429 按 Retry-After 冷却)
+        key_cfg = config.get("key_pool", {}) or {}
+        self.api_keys = KeyPool(
+            self.apikeys,
+            rate_per_minute=float(key_cfg.get("rate_per_minute", 0)),
+            burst=float(key_cfg.get("burst", 0)),
+        )
+        self.key_default_cooldown = float(key_cfg.get("default_cooldown", 60))
+        self.key_max_wait = float(key_cfg.get("max_wait", 30))
+
+        # 重试策略 (失败分类 + 指数退避 + 整体时限)
+        retry_cfg = config.get("retry", {}) or {}
+        self.retry_policy = RetryPolicy(
+            max_attempts=int(retry_cfg.get("max_attempts", 4)),
+            base_delay=float(retry_cfg.get("base_delay", 1)),
+            max_delay=float(retry_cfg.get("max_delay", 10)),
+            attempt_timeout=float(retry_cfg.get("attempt_timeout", 120)),
+            deadline=float(retry_cfg.get("deadline", 240)),
+        )
+
+        # 快捷提示词：配置里的 prompt_list + 可选的外部提示词库文件 (修改后后台自动热加载)
+        store_cfg = config.get("prompt_store", {}) or {}
+        self.prompt_list = config.get("prompt_list", []) or []
+        self.prompt_file = None
+        prompt_file = str(store_cfg.get("file", "") or "").strip()
+        if prompt_file:
+            path = Path(prompt_file)
+            self.prompt_file = path if path.is_absolute() else self._get_data_dir() / path
+        self.prompt_reload_interval = float(store_cfg.get("reload_interval", 5))
+        self.prompt_page_size = max(5, int(store_cfg.get("page_size", 30)))
+        self._prompt_file_sig = None
+        self.prompt_router = PromptRouter()
+        self.prompts = PromptLibrary([])
+        try:
+            self._install_prompt_library(*self._build_prompt_library())
+        except Exception as e:
+            logger.error(f"❌ 提示词库文件加载失败，只使用配置里的提示词: {e}")
+            # 记下坏文件的签名，文件改动后由热加载重试
+            library, _ = self._build_prompt_library(include_file=False)
+            self._install_prompt_library(library, self._prompt_file_signature())
         logger.info(f"GeminiDraw 初始化完成，当前模型: {self.current_model}")
         logger.info(f"可用模型数: {len(self.available_models)}")
         logger.info(f"转换API状态: {'启用' if self.enable_convert_api else '禁用'}")
-
-    def _load_prompt_map(self, config: dict):
-        """加载自定义提示词映射"""
-        self.prompt_map.clear()
-        prompt_list = config.get("prompt_list", [])
-        if not prompt_list:
+        self._start_metrics_exporter()
+        self._start_loop_monitor()
+        self._start_prompt_watcher()
+        self._start_job_workers()
+
+    # ---------------- 核心：提示词库加载与热更新 ----------------
+    def _prompt_file_signature(self):
+        """提示词文件的 (修改时间, 大小)；文件不存在返回 None"""
+        try:
+            stat = self.prompt_file.stat()
+        except (OSError, AttributeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _build_prompt_library(self, include_file: bool = True):
+        """解析配置 + 提示词文件，构建完整的新快照 (会在线程里调用，不碰当前快照)"""
+        entries = [e for e in map(PromptEntry.from_config_line, self.prompt_list) if e is not None]
+        source = "配置"
+        sig = self._prompt_file_signature() if include_file else None
+        if sig is not None:
+            entries += PromptLibrary.parse_file(self.prompt_file)
+            source = f"配置 + {self.prompt_file.name}"
+        return PromptLibrary(entries, source), sig
+
+    def _install_prompt_library(self, library: PromptLibrary, sig):
+        """
+        整体换上新快照：条目和路由在同一时刻切换，进行中的指令继续用旧条目。
+        sig 是构建时看到的文件签名，文件被删除时为 None，同样要记下，否则每轮检查都会判定为有变化
+        """
+        self.prompts = library
+        self.prompt_router.load(library.compiled)
+        self._prompt_file_sig = sig
+        if library:
+            logger.info(f"已加载 {len(library)} 个自定义提示词 ({len(library.aliases)} 个别名，来源: {library.source})")
+
+    async def _reload_prompts(self):
+        """后台线程重新解析提示词库，成功才替换；返回 (是否成功, 说明)"""
+        try:
+            library, sig = await asyncio.to_thread(self._build_prompt_library)
+        except Exception as e:
+            # 记下坏文件的签名，同一个坏文件只报一次，修好后再加载
+            self._prompt_file_sig = self._prompt_file_signature()
+            logger.error(f"❌ 提示词库重新加载失败，继续使用旧版本: {e}")
+            return False, str(e)
+        old_count = len(self.prompts)
+        self._install_prompt_library(library, sig)
+        return True, f"{old_count} -> {len(library)} 个提示词 ({library.source})"
+
+    async def _watch_prompt_file(self):
+        """定期检查提示词文件的修改时间/大小，有变化就热加载"""
+        while True:
+            await asyncio.sleep(self.prompt_reload_interval)
+            if self._prompt_file_signature() != self._prompt_file_sig:
+                ok, detail = await self._reload_prompts()
+                if ok:
+                    logger.info(f"🔄 提示词库已热加载: {detail}")
+
+    def _start_prompt_watcher(self):
+        if self.prompt_file is None or self.prompt_reload_interval <= 0:
             return
-        for item in prompt_list:
+        try:
+            self._spawn_background(self._watch_prompt_file())
+        except RuntimeError:
+            logger.warning("⚠️ 当前没有运行中的事件循环，提示词库热加载未启动")
+
+    def _get_data_dir(self) -> Path:
+        """插件数据目录 (data/plugin_data/astrbot_plugin_gemini)"""
+        if StarTools is not None:
+            return Path(StarTools.get_data_dir("astrbot_plugin_gemini"))
+        data_dir = Path("data") / "plugin_data" / "astrbot_plugin_gemini"
+        data_dir.mkdir(parents=True, exist_ok=True)
+        return data_dir
+
+    def _spawn_background(self, coro):
+        """启动后台任务并保留引用，卸载时统一取消"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    # ---------------- 核心：后台任务 ----------------
+    def _start_job_workers(self):
+        if self.job_store is None:
+            return
+        try:
+            self._spawn_background(self._run_job_supervisor())
+        except RuntimeError:
+            logger.warning("⚠️ 当前没有运行中的事件循环，后台任务未启动")
+
+    async def _run_job_supervisor(self):
+        """恢复上次未完成的任务、启动工作协程，之后定期补投未送达的结果、清理过期任务"""
+        store = self.job_store
+        try:
+            requeued, failed = await asyncio.to_thread(store.recover)
+            if requeued or failed:
+                logger.info(f"🧾 恢复后台任务: 重新排队 {requeued} 个，放弃 {failed} 个")
+        except sqlite3.Error as e:
+            logger.error(f"❌ 恢复后台任务失败: {e}")
+        for i in range(self.job_workers):
+            self._spawn_background(self._run_job_worker(i))
+
+        while True:
             try:
-                if ":" in item:
-                    key, value = item.split(":", 1)
-                    self.prompt_map[key.strip()] = value.strip()
-            except ValueError:
-                continue
-        logger.info(f"已加载 {len(self.prompt_map)} 个自定义提示词")
+                for job in await asyncio.to_thread(store.undelivered):
+                    success = job["status"] == "done"
+                    await self._deliver_job(job["id"], job["umo"], success, job["result"] if success else job["error"],
+                                            (job["finished_at"] or time.time()) - job["created_at"])
+                pruned = await asyncio.to_thread(store.prune)
+                if pruned:
+                    logger.info(f"🧹 已清理 {pruned} 个过期后台任务")
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ 后台任务维护失败: {e}")
+            await asyncio.sleep(60)
+
+    async def _run_job_worker(self, index: int):
+        """工作协程：领取任务并执行；没有任务时等待提交通知 (或定期轮询)。意外错误只记录，协程不退出"""
+        while True:
+            try:
+                await self._run_job_worker_once(index)
+            except Exception as e:
+                logger.error(f"❌ [任务工作协程 {index}] 异常，1 秒后继续: {e}")
+                await asyncio.sleep(1)
+
+    async def _run_job_worker_once(self, index: int):
+        self._job_wakeup.clear()
+        exclude = [user for _, user in self._running_jobs.values()]
+        try:
+            job = await asyncio.to_thread(self.job_store.claim, exclude)
+        except sqlite3.Error as e:
+            logger.error(f"❌ [任务工作协程 {index}] 领取任务失败: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(self._job_wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        task = asyncio.create_task(self._execute_job(job))
+        self._running_jobs[job["id"]] = (task, job["user"])
+        try:
+            await task
+        except asyncio.CancelledError:
+            # 用户取消只结束这个任务；插件卸载时工作协程本身被取消，任务留在 running，重启后重新排队
+            if job["id"] not in self._cancelled_jobs:
+                raise
+            self._cancelled_jobs.discard(job["id"])
+        except Exception as e:
+            # 执行流程本身出错：任务记为失败，不留在 running 里占着队列
+            logger.error(f"❌ [任务工作协程 {index}] 任务 #{job['id']} 执行失败: {e}")
+            await self._finish_job(job["id"], "failed", "", f"处理异常: {e}")
+            self.job_stats["failed"] += 1
+        finally:
+            self._running_jobs.pop(job["id"], None)
+        # 有用户的任务刚结束，唤醒其他空闲的工作协程重新领取
+        self._job_wakeup.set()
+
+    async def _finish_job(self, job_id: str, status: str, result: str = "", error: str = "") -> bool:
+        """记录任务结束状态；数据库写入失败只记日志 (任务留在 running，重启后按 recover 规则处理)"""
+        try:
+            await asyncio.to_thread(self.job_store.finish, job_id, status, result, error)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"❌ 记录后台任务 #{job_id} 结果失败: {e}")
+            return False
+
+    async def _execute_job(self, job: dict):
+        job_id = job["id"]
+        _current_command.set(job["command"])
+        image = None
+        if job["image"] is not None:
+            image = EncodedImage(bytes(job["image"]), job["image_width"], job["image_height"], job["image_format"])
+        logger.info(f"🧾 开始执行后台任务 #{job_id} [{job['command']}] (第 {job['attempts'] + 1} 次)")
+        # 后台任务的总时限从开始执行算起 (在任务队列里等待不计入)
+        deadline = self.retry_policy.start_deadline()
+
+        try:
+            success, result = await self._generate_image_shared(
+                job["command"], job["prompt"], image, is_image_to_image=image is not None, fresh=bool(job["fresh"]),
+                event=JobOrigin(job["user"], job["grp"]), model=job["model"] or None, deadline=deadline,
+            )
+        except asyncio.CancelledError:
+            if job_id in self._cancelled_jobs:
+                await self._finish_job(job_id, "cancelled", "", "用户取消")
+                self.job_stats["cancelled"] += 1
+            raise
+        except Exception as e:
+            logger.error(f"❌ 后台任务 #{job_id} 异常: {e}")
+            success, result = False, f"处理异常: {e}"
+
+        status = "done" if success else "failed"
+        # 结果写不进数据库也照常推送，用户不必等到重启后重跑
+        await self._finish_job(job_id, status, result if success else "", "" if success else result)
+        self.job_stats[status] += 1
+        await self._deliver_job(job_id, job["umo"], success, result, time.time() - job["created_at"])
+
+    async def _deliver_job(self, job_id: str, umo: str, success: bool, result: str, elapsed: float):
+        """把结果推送回提交任务的会话 (先占用投递，已被占用则跳过)；失败的留给维护循环稍后重试"""
+        try:
+            if not await asyncio.to_thread(self.job_store.claim_delivery, job_id):
+                return
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ 任务 #{job_id} 占用投递失败，留给维护循环重试: {e}")
+            return
+        if success:
+            chain = MessageChain([Plain(f"✅ 任务 #{job_id} 完成！\n⏱️ 总耗时: {elapsed:.2f}秒\n"), Image.fromURL(result)])
+        else:
+            chain = MessageChain([Plain(f"❌ 任务 #{job_id} 失败 (耗时: {elapsed:.2f}秒)\n\n错误详情:\n{result}")])
+        try:
+            ok = await self.context.send_message(umo, chain)
+        except Exception as e:
+            logger.warning(f"⚠️ 任务 #{job_id} 结果推送失败: {e}")
+            ok = False
+        self.job_stats["delivered" if ok else "delivery_failed"] += 1
+        try:
+            await asyncio.to_thread(self.job_store.mark_delivered, job_id, bool(ok))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ 记录任务 #{job_id} 投递状态失败: {e}")
+
+    async def _submit_job(self, event: AstrMessageEvent, command: str, prompt: str, image: EncodedImage = None,
+                          model: str = None, fresh: bool = False) -> str:
+        """登记一个后台任务，返回给用户的回复 (任务号 + 排队位置，或拒绝原因)"""
+        user, group = self._requester_of(event)
+        try:
+            total, mine = await asyncio.to_thread(self.job_store.pending_counts, user)
+            if total >= self.job_max_queue:
+                return f"🚦 后台任务过多 ({total})，请稍后再试"
+            if mine >= self.job_max_per_user:
+                return f"🚦 你已有 {mine} 个任务未完成，请等待完成后再提交 (/任务 查看)"
+
+            job_id = uuid.uuid4().hex[:8]
+            created_at = time.time()
+            await asyncio.to_thread(self.job_store.add, {
+                "id": job_id, "status": "queued", "command": command, "prompt": prompt, "model": model or "",
+                "fresh": int(fresh), "image": image.data if image is not None else None,
+                "image_format": image.format if image is not None else "",
+                "image_width": image.width if image is not None else 0,
+                "image_height": image.height if image is not None else 0,
+                "umo": event.unified_msg_origin, "user": user, "grp": group, "created_at": created_at,
+            })
+            ahead = await asyncio.to_thread(self.job_store.position, created_at)
+        except sqlite3.Error as e:
+            logger.error(f"❌ 提交后台任务失败: {e}")
+            return f"❌ 提交后台任务失败: {e}"
+
+        self.job_stats["submitted"] += 1
+        self._job_wakeup.set()
+        logger.info(f"🧾 已提交后台任务 #{job_id} [{command}] ({user}@{group})")
+        return (
+            f"🧾 已提交后台任务 #{job_id}" + (f" (前面还有 {ahead} 个)" if ahead else "") + "\n"
+            f"完成后会自动发到这里，发送 /任务 {job_id} 查看进度"
+        )
+
+    def _jobs_summary(self) -> str:
+        if self.job_store is None:
+            return "❌ 禁用"
+        stats = self.job_stats
+        return (
+            f"工作协程 {self.job_workers} | 执行中 {len(self._running_jobs)} | 提交 {stats['submitted']} "
+            f"完成 {stats['done']} 失败 {stats['failed']} 取消 {stats['cancelled']} | "
+            f"推送 {stats['delivered']} 推送失败 {stats['delivery_failed']}"
+        )
+
+    # ---------------- 核心：共享 HTTP 连接池 ----------------
+    def _get_session(self, pool: str = "api") -> aiohttp.ClientSession:
+        """获取长连接会话 (懒加载；api=生成接口，cdn=图片下载/转换接口)"""
+        session = self._sessions.get(pool)
+        if session is not None and not session.closed:
+            return session
+
+        cfg = self.http_pool_config
+        connector = aiohttp.TCPConnector(
+            limit=cfg[f"{pool}_limit"],
+            limit_per_host=cfg[f"{pool}_limit_per_host"],
+            keepalive_timeout=cfg["keepalive_timeout"],
+            ttl_dns_cache=cfg["dns_cache_ttl"],
+            use_dns_cache=True,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        self._sessions[pool] = session
+        logger.info(f"🔌 已创建 HTTP 连接池 [{pool}]: 总上限 {cfg[f'{pool}_limit']}，单主机 {cfg[f'{pool}_limit_per_host']}")
+        return session
+
+    async def _close_sessions(self):
+        """关闭所有连接池"""
+        for pool, session in list(self._sessions.items()):
+            if session is not None and not session.closed:
+                await session.close()
+                logger.info(f"🔌 已关闭 HTTP 连接池 [{pool}]")
+        self._sessions.clear()
 
         # ---------------- 新增：智能图片处理逻辑 ----------------
         # ---------------- 核心：智能图片处理 (GIF裁切+压缩) ----------------
-    async def _process_image_url(self, img_url: str) -> str:
+    async def _process_image_url(self, img_url: str, model: str = None):
         """
         逻辑：
-        1. 下载图片二进制数据
-        2. 使用 Pillow 读取
-        3. 如果是 GIF -> 取第一帧 -> 转 RGB -> 压缩 -> 转 Base64
-        4. 如果是普通图片 -> 同样压缩以提高成功率
+        1. data URL / QQ 头像缓存 / 链接缓存命中直接返回
+        2. 按获取策略 (input_strategy) 选择：本地下载 + Pillow 处理、第三方转换API、
+           先本地后转换、或两者竞速 (先拿到有效结果者胜，另一条取消)
+        model 只用于指标标签 (本次指令实际使用的模型，为空时用当前模型)
+        返回 (EncodedImage 或 None, 失败文字/调试信息, 失败原因 InputFailure.*；成功时为空)
         """
         if img_url.startswith("data:image/"):
-            return img_url
+            try:
+                return EncodedImage.from_data_url(img_url), "", ""
+            except ValueError as e:
+                logger.warning(f"⚠️ base64 图片数据无法解码: {e}")
+                return None, "图片数据无法解码 (base64 格式错误)", InputFailure.INVALID
 
-        # 如果没有安装 Pillow，回退到旧逻辑（防止报错）
+        # 如果没有安装 Pillow，只能走转换API（防止报错）
         if PyImage is None:
             logger.warning("❌ 未安装 Pillow 库，无法裁切 GIF，正在使用原图模式")
-            return await self._convert_url_to_base64_via_api(img_url)
 
+        # QQ 头像走磁盘缓存
+        avatar_match = _AVATAR_URL_RE.match(img_url)
+        if avatar_match and self.avatar_store is not None and PyImage is not None:
+            image = await self._get_avatar(avatar_match.group(1), img_url, model)
+            if image is not None:
+                return image, "", ""
+
+        # 一级缓存：同一链接直接复用
+        if self.enable_image_cache:
+            digest = self.url_cache.get(img_url)
+            image = self.content_cache.get(digest) if digest else None
+            if image is not None:
+                logger.info(f"♻️ 图片缓存命中 (URL): {img_url[:50]}...")
+                return image, "", ""
+
+        host = InputStrategy.host_of(img_url)
+        plan = self.input_strategy.plan(host, local_ok=PyImage is not None, remote_ok=self.enable_convert_api)
+        if plan == ("race",):
+            return await self._acquire_input_race(img_url, host, model)
+
+        image, error, reason = None, "", ""
+        for path in plan:
+            image, path_error, path_reason = await self._acquire_input(path, img_url, host, model)
+            if image is not None:
+                return image, "", ""
+            # 转换API失败时返回的调试信息更有用；两条路都没有信息时保留本地的原因
+            if path_error or not error:
+                error, reason = path_error, path_reason
+            # 只有本地能下载但 Pillow 解码失败时才交给转换API；下载不到的链接 (内网/失效) 不外发
+            if path == "local" and path_reason != InputFailure.DECODE:
+                break
+        return image, error, reason
+
+    async def _acquire_input_race(self, img_url: str, host: str, model: str = None):
+        """本地处理与转换API同时进行，先拿到有效图片的胜出，另一条立即取消"""
+        tasks = {asyncio.create_task(self._acquire_input(path, img_url, host, model)): path for path in ("local", "remote")}
+        errors = {}
+        winner = ""
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    image, error, reason = task.result()
+                    if image is not None:
+                        winner = tasks[task]
+                        logger.info(f"🏁 输入图片竞速: {InputStrategy.PATH_NAMES[winner]} 胜出 ({host})")
+                        return image, "", ""
+                    errors[tasks[task]] = (error, reason)
+                    if reason == InputFailure.TOO_LARGE:
+                        return None, error, reason
+            error, reason = errors.get("remote", ("", ""))
+            if not error:
+                error, reason = errors.get("local", (error, reason))
+            return None, error, reason
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.input_strategy.record_race(host, winner)
+
+    async def _acquire_input(self, path: str, img_url: str, host: str, model: str = None):
+        """执行一条获取路径并记录成功率/耗时；转换API的结果也放进链接缓存"""
+        started = time.monotonic()
+        if path == "local":
+            image, error, reason = await self._acquire_input_local(img_url, model)
+        else:
+            image, error, reason = await self._convert_url_via_api_to_image(img_url)
+            if image is not None and self.enable_image_cache:
+                self.content_cache.put(image.digest, image, image.nbytes)
+                self.url_cache.put(img_url, image.digest, len(img_url) + len(image.digest))
+        ok = image is not None
+        self.input_strategy.record(host, path, ok, time.monotonic() - started)
+        self.metrics.inc("gemini_input_acquire_total", path=path, result="ok" if ok else "failed")
+        return image, error, reason
+
+    async def _acquire_input_local(self, img_url: str, model: str = None):
+        """
+        本地路径：
+        1. 下载图片二进制数据
+        2. 使用 Pillow 读取
+        3. 如果是 GIF -> 取第一帧 -> 转 RGB -> 压缩
+        4. 如果是普通图片 -> 同样压缩以提高成功率
+        """
         logger.info(f"⬇️ 正在下载并裁切图片: {img_url[:50]}...")
 
         try:
-            async with aiohttp.ClientSession() as session:
+            session = self._get_session("cdn")
+            with self.metrics.timer("download", model or self.current_model):
                 async with session.get(img_url, timeout=30) as resp:
                     if resp.status != 200:
-                        return f"下载失败: {resp.status}"
-
-                    img_data = await resp.read()
-
-                    # === 使用 Pillow 处理图片 (核心修改) ===
-                    try:
-                        # 1. 读取图片
-                        img = PyImage.open(io.BytesIO(img_data))
-
-                        # 2. 如果是动图，seek到第一帧
-                        img.seek(0)
-
-                        # 3. 转换为 RGB (去除透明通道/GIF索引颜色，防止JPG保存失败)
-                        img = img.convert("RGB")
-
-                        # 4. 尺寸限制 (防止图片过大导致API超时，限制最大边长1536)
-                        max_size = 1536
-                        if img.width > max_size or img.height > max_size:
-                            img.thumbnail((max_size, max_size))
-                            logger.info(f"📉 图片尺寸已缩放至: {img.size}")
-
-                        # 5. 保存为 JPG 并输出 Base64
-                        buffer = io.BytesIO()
-                        img.save(buffer, format="JPEG", quality=85)  # 85质量通常足够且体积小
-                        b64_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-                        # 强制返回 jpeg 头部，模型最容易识别
-                        final_data = f"data:image/jpeg;base64,{b64_data}"
-
-                        logger.info(f"✅ 图片处理成功: 原大小{len(img_data)} -> 新Base64长{len(b64_data)}")
-                        return final_data
+                        self.metrics.inc("gemini_input_failures_total", cause=f"http_{resp.status}")
+                        return None, f"下载失败: {resp.status}", InputFailure.DOWNLOAD
+
+                    img_data = await self._read_image_body(resp)
+            self.metrics.inc("gemini_bytes_received_total", len(img_data), source="download")
+
+            # 二级缓存：内容相同 (不同链接) 复用同一份预处理结果
+            digest = hashlib.sha1(img_data).hexdigest()
+            if self.enable_image_cache:
+                image = self.content_cache.get(digest)
+                if image is not None:
+                    self.url_cache.put(img_url, digest, len(img_url) + len(digest))
+                    logger.info(f"♻️ 图片缓存命中 (内容): {digest[:12]}")
+                    return image, "", ""
+
+            # === 使用 Pillow 处理图片 (在处理池中执行，不阻塞事件循环) ===
+            try:
+                # 首帧 → RGB → 限制最大边长1536 → JPG(85质量通常足够且体积小)
+                with self.metrics.timer("pillow", model or self.current_model):
+                    jpeg_data, original_size, new_size = await self.image_pool.run(
+                        "预处理", _pil_preprocess, img_data, 1536, 85
+                    )
+                if new_size != original_size:
+                    logger.info(f"📉 图片尺寸已缩放至: {new_size}")
+
+                # 统一为 jpeg，模型最容易识别
+                image = EncodedImage(jpeg_data, new_size[0], new_size[1], "jpeg")
+                logger.info(f"✅ 图片处理成功: 原大小{len(img_data)} -> {image.describe()}")
+                if self.enable_image_cache:
+                    self.content_cache.put(digest, image, image.nbytes)
+                    self.url_cache.put(img_url, digest, len(img_url) + len(digest))
+                return image, "", ""
+
+            except Exception as pil_err:
+                self.metrics.inc("gemini_input_failures_total", cause="decode")
+                logger.error(f"❌ Pillow 处理失败: {pil_err}")
+                return None, f"图片处理失败: {pil_err}", InputFailure.DECODE
+
+        except ImageTooLarge as e:
+            self.metrics.inc("gemini_input_failures_total", cause="too_large")
+            logger.warning(f"⚠️ {e}: {img_url[:50]}...")
+            return None, str(e), InputFailure.TOO_LARGE
+        except Exception as e:
+            self.metrics.inc("gemini_input_failures_total", cause=type(e).__name__)
+            logger.error(f"❌ 图片下载流程异常: {e}")
+            return None, f"处理异常: {str(e)}", InputFailure.DOWNLOAD
+
+    async def _read_image_body(self, resp: aiohttp.ClientResponse) -> bytes:
+        """流式读取图片：Content-Length 超限直接拒绝，没有长度的边读边计数，超限立即中断"""
+        limit = self.max_image_bytes
+        if limit and resp.content_length is not None and resp.content_length > limit:
+            raise ImageTooLarge(f"图片过大 ({resp.content_length / 1024 / 1024:.1f} MB，上限 {limit / 1024 / 1024:.0f} MB)")
+        chunks = []
+        total = 0
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            total += len(chunk)
+            if limit and total > limit:
+                resp.close()
+                raise ImageTooLarge(f"图片过大 (超过 {limit / 1024 / 1024:.0f} MB 上限)")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    # ---------------- 核心：QQ 头像缓存 ----------------
+    async def _get_avatar(self, qq: str, avatar_url: str, model: str = None):
+        """新鲜直接用；过期先返回旧图并后台校验；没有缓存则同步下载"""
+        image, meta = await self.avatar_store.load(qq)
+        if image is not None:
+            if self.avatar_store.is_fresh(meta):
+                self.avatar_store.stats["fresh"] += 1
+                logger.info(f"♻️ 头像缓存命中: {qq}")
+                return image
+
+            self.avatar_store.stats["stale"] += 1
+            if qq not in self._avatar_refreshing:
+                self._avatar_refreshing.add(qq)
+                self._spawn_background(self._refresh_avatar(qq, avatar_url, image, meta, model))
+            logger.info(f"♻️ 头像缓存已过期，先使用旧图并后台刷新: {qq}")
+            return image
+
+        self.avatar_store.stats["miss"] += 1
+        return await self._fetch_avatar(qq, avatar_url, model=model)
+
+    async def _refresh_avatar(self, qq: str, avatar_url: str, image: EncodedImage, meta: dict, model: str = None):
+        try:
+            await self._fetch_avatar(qq, avatar_url, image, meta, model)
+        finally:
+            self._avatar_refreshing.discard(qq)
+
+    async def _fetch_avatar(self, qq: str, avatar_url: str, cached: EncodedImage = None, meta: dict = None,
+                            model: str = None):
+        """下载头像 (带条件请求头)，预处理后写入磁盘缓存；失败返回 None"""
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
 
-                    except Exception as pil_err:
-                        logger.error(f"❌ Pillow 处理失败: {pil_err}")
-                        # 如果 Pillow 处理失败，回退到 API
-                        return await self._convert_url_to_base64_via_api(img_url)
+        try:
+            session = self._get_session("cdn")
+            async with session.get(avatar_url, headers=headers, timeout=30) as resp:
+                if resp.status == 304 and cached is not None:
+                    self.avatar_store.stats["not_modified"] += 1
+                    await self.avatar_store.touch(qq, cached, meta)
+                    logger.info(f"✅ 头像未变化 (304): {qq}")
+                    return cached
+                if resp.status != 200:
+                    logger.warning(f"⚠️ 头像下载失败 ({resp.status}): {qq}")
+                    return None
+                img_data = await self._read_image_body(resp)
+                self.metrics.inc("gemini_bytes_received_total", len(img_data), source="avatar")
+                new_meta = {
+                    "etag": resp.headers.get("ETag", ""),
+                    "last_modified": resp.headers.get("Last-Modified", ""),
+                    "fetched_at": time.time(),
+                    "digest": hashlib.sha1(img_data).hexdigest(),
+                }
+
+            # 服务端不支持条件请求时按内容哈希判断，没变就不再跑 Pillow
+            if cached is not None and meta and meta.get("digest") == new_meta["digest"]:
+                self.avatar_store.stats["not_modified"] += 1
+                await self.avatar_store.save(qq, cached, new_meta)
+                return cached
+
+            with self.metrics.timer("pillow", model or self.current_model):
+                jpeg_data, _, new_size = await self.image_pool.run("头像预处理", _pil_preprocess, img_data, 1536, 85)
+            image = EncodedImage(jpeg_data, new_size[0], new_size[1], "jpeg")
+            await self.avatar_store.save(qq, image, new_meta)
+            self.avatar_store.stats["updated"] += 1
+            logger.info(f"✅ 头像已缓存: {qq} -> {image.describe()}")
+            return image
 
         except Exception as e:
-            logger.error(f"❌ 图片下载流程异常: {e}")
-            return f"处理异常: {str(e)}"
+            logger.error(f"❌ 头像缓存流程异常 ({qq}): {e}")
+            return None
+
+    async def _convert_url_via_api_to_image(self, img_url: str):
+        """调用转换API，成功则解码为 EncodedImage，失败原样返回调试信息"""
+        result, reason = await self._convert_url_to_base64_via_api(img_url)
+        if reason:
+            return None, result, reason
+        try:
+            return EncodedImage.from_data_url(result), "", ""
+        except ValueError as e:
+            logger.error(f"❌ 转换API返回的base64无法解码: {e}")
+            return None, f"返回数据预览: {result[:300]}...", InputFailure.CONVERT
+
     # ---------------- 核心：第三方API转换函数 ----------------
-    async def _convert_url_to_base64_via_api(self, img_url: str) -> str:
-        """调用第三方API将URL转换为Base64 - 简化版本"""
+    async def _convert_url_to_base64_via_api(self, img_url: str):
+        """调用第三方API将URL转换为Base64 - 简化版本，返回 (data URL 或调试信息, 失败原因)"""
         if not self.enable_convert_api:
             logger.error("❌ 转换API已禁用，无法处理外部图片")
-            return ""
+            return "", InputFailure.CONVERT
 
         logger.info(f"🔄 调用第三方API转换图片URL: {img_url[:100]}...")
 
         try:
             params = {"url": img_url}
 
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.get(self.convert_api_url, params=params, timeout=timeout) as response:
-                    response_text = await response.text()
-                    logger.info(f"🔍 API返回状态: {response.status}")
-                    logger.info(f"🔍 API返回预览: {response_text[:200]}...")
-
-                    if response.status == 200:
-                        full_content = response_text.strip()
-
-                        # 方法1：使用正则表达式提取base64（最可靠）
-                        import re
-                        base64_match = re.search(r'"base64"\s*:\s*"([^"]+)"', full_content)
-                        if base64_match:
-                            b64_data = base64_match.group(1)
-                            logger.info(f"✅ 正则提取base64成功，长度: {len(b64_data)}")
-
-                            # 清理base64数据
-                            b64_clean = b64_data.replace("data:image/jpeg;base64,", "") \
-                                .replace("data:image/png;base64,", "") \
-                                .replace("data:image/webp;base64,", "") \
-                                .replace("data:image/gif;base64,", "")
-
-                            if len(b64_clean) > 100:
-                                logger.info(f"✅ 转换成功！Base64长度: {len(b64_clean)}")
-                                return f"data:image/jpeg;base64,{b64_clean}"
-                            else:
-                                logger.warning(f"❌ 获取的Base64太短: {len(b64_clean)}")
-                                return f"data:image/jpeg;base64,{b64_clean}"
-
-                        # 方法2：尝试JSON解析
-                        try:
-                            json_data = json.loads(full_content)
-                            if isinstance(json_data, dict):
-                                if "base64" in json_data and json_data["base64"]:
-                                    b64_data = json_data["base64"]
-                                    logger.info(f"✅ JSON提取base64成功，长度: {len(b64_data)}")
-                                    return f"data:image/jpeg;base64,{b64_data}"
-                                elif "data" in json_data and json_data["data"]:
-                                    b64_data = json_data["data"]
-                                    logger.info(f"✅ JSON提取data字段成功，长度: {len(b64_data)}")
-                                    return f"data:image/jpeg;base64,{b64_data}"
-                        except json.JSONDecodeError:
-                            logger.warning("❌ JSON解析失败，但已通过正则提取")
-
-                        # 如果以上方法都失败，返回调试信息
-                        debug_info = f"""
+            session = self._get_session("cdn")
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with session.get(self.convert_api_url, params=params, timeout=timeout) as response:
+                response_text = await response.text()
+                logger.info(f"🔍 API返回状态: {response.status}")
+                logger.info(f"🔍 API返回预览: {response_text[:200]}...")
+
+                if response.status == 200:
+                    full_content = response_text.strip()
+
+                    # 方法1：使用正则表达式提取base64（最可靠）
+                    import re
+                    base64_match = re.search(r'"base64"\s*:\s*"([^"]+)"', full_content)
+                    if base64_match:
+                        b64_data = base64_match.group(1)
+                        logger.info(f"✅ 正则提取base64成功，长度: {len(b64_data)}")
+
+                        # 清理base64数据
+                        b64_clean = b64_data.replace("data:image/jpeg;base64,", "") \
+                            .replace("data:image/png;base64,", "") \
+                            .replace("data:image/webp;base64,", "") \
+                            .replace("data:image/gif;base64,", "")
+
+                        if len(b64_clean) > 100:
+                            logger.info(f"✅ 转换成功！Base64长度: {len(b64_clean)}")
+                            return f"data:image/jpeg;base64,{b64_clean}", ""
+                        else:
+                            logger.warning(f"❌ 获取的Base64太短: {len(b64_clean)}")
+                            return f"data:image/jpeg;base64,{b64_clean}", ""
+
+                    # 方法2：尝试JSON解析
+                    try:
+                        json_data = json.loads(full_content)
+                        if isinstance(json_data, dict):
+                            if "base64" in json_data and json_data["base64"]:
+                                b64_data = json_data["base64"]
+                                logger.info(f"✅ JSON提取base64成功，长度: {len(b64_data)}")
+                                return f"data:image/jpeg;base64,{b64_data}", ""
+                            elif "data" in json_data and json_data["data"]:
+                                b64_data = json_data["data"]
+                                logger.info(f"✅ JSON提取data字段成功，长度: {len(b64_data)}")
+                                return f"data:image/jpeg;base64,{b64_data}", ""
+                    except json.JSONDecodeError:
+                        logger.warning("❌ JSON解析失败，但已通过正则提取")
+
+                    # 如果以上方法都失败，返回调试信息
+                    debug_info = f"""
 ============== 转换API返回数据 (调试用) ==============
 URL: {img_url}
 状态码: {response.status}
@@ -204,11 +3098,11 @@ API地址: {self.convert_api_url}
 原始返回内容:
 {full_content[:1000]}...
 """
-                        return debug_info
-                    else:
-                        logger.error(f"❌ 转换API请求失败: {response.status}")
-                        error_text = await response.text()
-                        debug_info = f"""
+                    return debug_info, InputFailure.CONVERT_DEBUG
+                else:
+                    logger.error(f"❌ 转换API请求失败: {response.status}")
+                    error_text = await response.text()
+                    debug_info = f"""
 ============== 转换API请求失败 ==============
 URL: {img_url}
 状态码: {response.status}
@@ -217,7 +3111,7 @@ API地址: {self.convert_api_url}
 错误响应:
 {error_text[:500]}...
 """
-                        return debug_info
+                    return debug_info, InputFailure.CONVERT
 
         except asyncio.TimeoutError:
             logger.error("❌ 转换API请求超时")
@@ -229,7 +3123,7 @@ API地址: {self.convert_api_url}
 
 ⚠️ 请求超时，请检查网络连接或API服务状态
 """
-            return debug_info
+            return debug_info, InputFailure.CONVERT
         except Exception as e:
             logger.error(f"❌ 转换过程异常: {str(e)}")
             debug_info = f"""
@@ -239,7 +3133,7 @@ API地址: {self.convert_api_url}
 
 异常信息: {str(e)}
 """
-            return debug_info
+            return debug_info, InputFailure.CONVERT
 
     # ---------------- 核心：只提取图片URL ----------------
     async def _extract_image_url_from_event(self, event: AstrMessageEvent) -> str:
@@ -292,177 +3186,630 @@ API地址: {self.convert_api_url}
         logger.info("❌ 未找到任何图片数据")
         return ""
 
-        # ---------------- 新增：Base64图片压缩辅助函数 (用于重试) ----------------
-        # ---------------- 辅助：Base64图片压缩 (带大小监控) ----------------
-    def _resize_base64_image(self, b64_string: str, scale: float = 0.7) -> str:
-        """将 Base64 图片按比例缩小，并打印大小变化"""
-        if not b64_string or PyImage is None:
-            return b64_string
-
-        try:
-            # 计算原始大小 (粗略估算 KB)
-            original_kb = len(b64_string) / 1024
-
-            # 1. 分离头部和数据
-            if "base64," in b64_string:
-                header, data = b64_string.split("base64,", 1)
-                header = header + "base64,"
-            else:
-                header = "data:image/jpeg;base64,"
-                data = b64_string
+    # ---------------- 辅助：按字节预算生成多档图片 (用于重试) ----------------
+    def _get_payload_budgets(self, attempts: int, model: str = None) -> list:
+        """指定模型 (为空时用当前模型) 每次尝试的图片字节预算 (原始 JPEG 字节)"""
+        budget_kb = self.model_payload_budgets.get(model or self.current_model, self.payload_budget_kb)
+        # 配置按 base64 体积填写，换算成原始字节
+        budget = int(budget_kb * 1024 * 3 / 4)
+        return [max(16 * 1024, int(budget * self.retry_budget_ratio ** i)) for i in range(attempts)]
 
-            # 2. 解码并处理
-            img_bytes = base64.b64decode(data)
-            img = PyImage.open(io.BytesIO(img_bytes)).convert("RGB")
+    async def _build_image_ladder(self, image: EncodedImage, attempts: int, model: str = None) -> list:
+        """一次性从原图生成每次尝试要用的图片档位 (按预算放进内容缓存)，失败时退回原图"""
+        if PyImage is None:
+            return [image]
 
-            old_w, old_h = img.width, img.height
-            new_w, new_h = int(old_w * scale), int(old_h * scale)
+        budgets = tuple(self._get_payload_budgets(attempts, model))
+        cache_key = ("ladder", image.digest, budgets)
+        if self.enable_image_cache:
+            cached = self.content_cache.get(cache_key)
+            if cached is not None:
+                return cached
 
-            # 限制最小尺寸，太小就不缩了
-            if new_w < 128 or new_h < 128:
-                logger.warning(f"⚠️ 图片已过小 ({new_w}x{new_h})，跳过压缩")
-                return b64_string
+        try:
+            with self.metrics.timer("pillow", model or self.current_model):
+                ladder = await self.image_pool.run("预算编码", _pil_encode_ladder, image.data, list(budgets))
+        except Exception as e:
+            logger.error(f"❌ 图片档位生成异常: {e}")
+            return [image]
+
+        variants = []
+        for i, (data, (w, h), quality) in enumerate(ladder):
+            if quality == 0:
+                # 原图已在预算内，复用同一个对象 (连同已缓存的 data URL)
+                image.width, image.height = w, h
+                variant = image
+            else:
+                variant = EncodedImage(data, w, h, "jpeg")
+            quality_info = "原图" if quality == 0 else f"质量 {quality}"
+            logger.info(f"📐 档位 {i + 1}: {w}x{h} | {quality_info} | base64 {variant.b64_size / 1024:.2f} KB")
+            variants.append(variant)
+        if self.enable_image_cache:
+            # 档位作为独立条目按实际字节计费，不挂在原图对象上 (否则缓存上限会漏算)；复用的原图不重复计费
+            self.content_cache.put(cache_key, variants, sum(v.nbytes for v in variants if v is not image))
+        return variants
+
+    # ---------------- 核心：构建请求体 ----------------
+    def _build_payload(self, prompt: str, image: EncodedImage = None, detail: str = "high", model: str = None) -> dict:
+        """构建 OpenAI 兼容的流式请求体"""
+        content = [{"type": "text", "text": prompt}]
+        if image is not None:
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": image.data_url,
+                    "detail": detail
+                }
+            })
+        return {
+            "model": model or self.current_model,
+            "messages": [{"role": "user", "content": content}],
+            "stream": True
+        }
 
-            # 3. 执行缩放
-            img = img.resize((new_w, new_h), PyImage.LANCZOS)
+    # ---------------- 核心：单次上游请求 ----------------
+    async def _post_generation(self, backend: Backend, body: bytes, headers: dict, timeout: float,
+                               model: str = "-", fingerprint: dict = None):
+        """向单个后端发一次流式生成请求 (body 为已序列化的 JSON)，返回 (状态码, 图片链接, 错误信息, Retry-After秒数)"""
+        session = self._get_session("api")
+        sent_at = time.monotonic()
+        self.metrics.inc("gemini_bytes_sent_total", len(body), model=model)
+        # 开启录制时保存 (相对发送时刻的到达时间, 原始字节)
+        transcript = [] if self.sse_recorder is not None and self.sse_recorder.should_record() else None
+        async with session.post(backend.url, data=body, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status != 200:
+                self.metrics.observe("ttfb", time.monotonic() - sent_at, model)
+                retry_after = _parse_retry_after(response.headers.get("Retry-After", ""))
+                err_text = await response.text()
+                self.metrics.inc("gemini_bytes_received_total", len(err_text), source="upstream")
+                return response.status, "", err_text, retry_after
+
+            # 解析流式 (边收边解析，看到完整图片链接立即返回)
+            parser = SSEStreamParser()
+            first_at = None
+            received = 0
+            url = ""
+            try:
+                async for chunk in response.content.iter_any():
+                    now = time.monotonic()
+                    if first_at is None:
+                        first_at = now
+                        self.metrics.observe("ttfb", first_at - sent_at, model)
+                    if transcript is not None:
+                        transcript.append((now - sent_at, chunk))
+                    received += len(chunk)
+                    added = parser.feed(chunk)
+                    if ")" in added:
+                        url = parser.find_image_url()
+                        if url:
+                            logger.info(f"✅ 生成成功 (流式提前返回) [{backend.name}]: {url[:50]}...")
+                            response.close()
+                            return 200, url, "", None
+                    if parser.done:
+                        break
+
+                parser.close()
+                if parser.bad_chunks:
+                    logger.warning(f"⚠️ 跳过 {parser.bad_chunks} 个无法解析的数据块")
+
+                url = parser.find_image_url(final=True)
+                if url:
+                    logger.info(f"✅ 生成成功 [{backend.name}]: {url[:50]}...")
+                return 200, url, "", None
+            finally:
+                self.metrics.inc("gemini_bytes_received_total", received, source="upstream")
+                if first_at is not None:
+                    self.metrics.observe("stream", time.monotonic() - first_at, model)
+                if transcript is not None:
+                    self._spawn_background(self.sse_recorder.save({
+                        "version": 1,
+                        "recorded_at": time.time(),
+                        "model": model,
+                        "backend": backend.name,
+                        "request_bytes": len(body),
+                        "image": fingerprint,
+                        "ttfb": (first_at - sent_at) if first_at is not None else None,
+                        "duration": time.monotonic() - sent_at,
+                        "done": parser.done,
+                        "url": url,
+                        "chunks": [[round(t, 4), base64.b64encode(c).decode("ascii")] for t, c in transcript],
+                    }))
+
+    @staticmethod
+    def _is_quota_error(err_text: str) -> bool:
+        text = err_text.lower()
+        return "quota" in text or "resource_exhausted" in text or "rate limit" in text
+
+    # ---------------- 核心：后端健康检查 ----------------
+    def _ensure_health_checker(self):
+        """多后端时在第一次请求时启动后台健康检查"""
+        if len(self.backends) < 2 or self.health_check_interval <= 0:
+            return
+        if self._health_task is None or self._health_task.done():
+            self._health_task = self._spawn_background(self._health_check_loop())
+
+    async def _health_check_loop(self):
+        headers = {'Authorization': f'Bearer {self.apikey}'}
+        while True:
+            for backend in self.backends.backends:
+                try:
+                    session = self._get_session("api")
+                    async with session.get(backend.models_url, headers=headers,
+                                           timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                        self.backends.mark_health(backend, resp.status < 500, f"HTTP {resp.status}")
+                except Exception as e:
+                    self.backends.mark_health(backend, False, str(e) or type(e).__name__)
+            await asyncio.sleep(self.health_check_interval)
+
+    # ---------------- 核心：指标导出 ----------------
+    def _start_metrics_exporter(self):
+        if not (self.metrics_port or self.metrics_dump_file):
+            return
+        try:
+            self._spawn_background(self._run_metrics_exporter())
+        except RuntimeError:
+            logger.warning("⚠️ 当前没有运行中的事件循环，指标导出未启动")
 
-            # 4. 转回 Base64
-            buffer = io.BytesIO()
-            img.save(buffer, format="JPEG", quality=80)
-            new_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    def _start_loop_monitor(self):
+        if self.loop_monitor is None:
+            return
+        try:
+            self._spawn_background(self.loop_monitor.run())
+        except RuntimeError:
+            logger.warning("⚠️ 当前没有运行中的事件循环，卡顿检测未启动")
 
-            final_b64 = f"{header}{new_data}"
-            new_kb = len(final_b64) / 1024
+    async def _run_metrics_exporter(self):
+        """Prometheus 文本指标：可选 HTTP 端点 (/metrics) + 定期写文件"""
+        if self.metrics_port:
+            try:
+                app = web.Application()
+                app.router.add_get("/metrics", self._handle_metrics)
+                runner = web.AppRunner(app, access_log=None)
+                await runner.setup()
+                await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+                self._metrics_runner = runner
+                logger.info(f"📈 指标端点已启动: http://{self.metrics_host}:{self.metrics_port}/metrics")
+            except Exception as e:
+                logger.error(f"❌ 指标端点启动失败: {e}")
 
-            logger.info(
-                f"📉 [压缩成功] 尺寸: {old_w}x{old_h} -> {new_w}x{new_h} | "
-                f"大小: {original_kb:.2f}KB -> {new_kb:.2f}KB"
-            )
-            return final_b64
+        if not self.metrics_dump_file:
+            return
+        path = Path(self.metrics_dump_file)
+        if not path.is_absolute():
+            path = self._get_data_dir() / path
+        while True:
+            await asyncio.sleep(self.metrics_dump_interval)
+            text = self._render_metrics()
+            try:
+                await asyncio.to_thread(self._write_metrics_file, path, text)
+            except OSError as e:
+                logger.warning(f"⚠️ 指标文件写入失败: {e}")
+
+    @staticmethod
+    def _write_metrics_file(path: Path, text: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self._render_metrics(), content_type="text/plain", charset="utf-8")
+
+    def _render_metrics(self) -> str:
+        """阶段直方图/计数器 + 缓存、队列、后端等现有统计"""
+        extra = []
+        caches = [("url", self.url_cache), ("content", self.content_cache)] if self.enable_image_cache else []
+        if self.result_cache:
+            caches.append(("result", self.result_cache))
+        for name, cache in caches:
+            extra.append(("gemini_cache_requests_total", {"cache": name, "result": "hit"}, cache.hits, "counter"))
+            extra.append(("gemini_cache_requests_total", {"cache": name, "result": "miss"}, cache.misses, "counter"))
+        if self.avatar_store is not None:
+            for result, value in self.avatar_store.stats.items():
+                extra.append(("gemini_avatar_cache_total", {"result": result}, value, "counter"))
+        for role, value in self.coalesce_stats.items():
+            extra.append(("gemini_coalesce_total", {"role": role}, value, "counter"))
+        extra.append(("gemini_admission_running", {}, self.admission.running, "gauge"))
+        extra.append(("gemini_admission_queued", {}, self.admission.queued, "gauge"))
+        for b in self.backends.backends:
+            extra.append(("gemini_backend_outstanding", {"backend": b.name}, b.outstanding, "gauge"))
+        for name, breaker in self.breakers.breakers.items():
+            extra.append(("gemini_circuit_open", {"breaker": name}, int(not breaker.available()), "gauge"))
+        if self.job_store is not None:
+            for result, value in self.job_stats.items():
+                extra.append(("gemini_jobs_total", {"result": result}, value, "counter"))
+            extra.append(("gemini_jobs_running", {}, len(self._running_jobs), "gauge"))
+        router = self.prompt_router
+        extra.append(("gemini_router_lookups_total", {"result": "match"}, router.matches, "counter"))
+        extra.append(("gemini_router_lookups_total", {"result": "reject"}, router.lookups - router.matches, "counter"))
+        extra.append(("gemini_router_lookup_seconds_total", {}, router.cost, "counter"))
+        extra.append(("gemini_router_steps_total", {}, router.steps, "counter"))
+        for command, value in router.hits.items():
+            extra.append(("gemini_router_matches_total", {"command": command}, value, "counter"))
+        for host, path, stats in self.input_strategy.iter_stats():
+            if stats.latency is not None:
+                extra.append(("gemini_input_path_latency_seconds", {"host": host, "path": path}, stats.latency, "gauge"))
+            if stats.races:
+                extra.append(("gemini_input_path_win_rate", {"host": host, "path": path}, stats.win_rate, "gauge"))
+        return self.metrics.render_prometheus(extra)
 
-        except Exception as e:
-            logger.error(f"❌ 图片压缩异常: {e}")
-            return b64_string  # 出错返回原图，保证不丢数据
     # ---------------- 核心：生成逻辑 (带3次自动降质重试机制) ----------------
         # ---------------- 核心：生成逻辑 (逻辑修复版) ----------------
         # ---------------- 核心：生成逻辑 (带实时大小显示) ----------------
-    async def _generate_image(self, prompt: str, image_base64: str = None, is_image_to_image: bool = False):
-        """调用 Flow2API 生成图片 (包含自动降质重试机制)"""
+    def _record_outcome(self, outcome: str, model: str):
+        """记录一次上游请求结果 (重试策略统计 + 按模型/命令的计数器)"""
+        self.retry_policy.record(outcome)
+        self.metrics.inc("gemini_upstream_outcomes_total", model=model, command=_current_command.get(), outcome=outcome)
 
-        current_image_b64 = image_base64
+    def _claim_backend(self, failed_backend: Backend = None):
+        """
+        选择本次尝试的后端并通过它的熔断器放行：熔断中的后端不选，重试时优先避开上次失败的后端，
+        放行被拒 (探测名额被占) 就换下一个。返回 (后端, 探测票据)，没有后端可用时返回 (None, None)
+        """
+        exclude = [b for b in self.backends.backends if not self.breakers.available(f"后端 {b.name}")]
+        while len(exclude) < len(self.backends):
+            avoid = []
+            if failed_backend is not None and failed_backend not in exclude and len(exclude) + 1 < len(self.backends):
+                avoid.append(failed_backend)
+            backend = self.backends.pick(exclude=exclude + avoid)
+            probe = self.breakers.allow(f"后端 {backend.name}")
+            if probe is not None:
+                return backend, probe
+            exclude.append(backend)
+        return None, None
+
+    def _circuit_block_message(self, model: str) -> str:
+        """模型或全部后端处于熔断状态时返回提示语，否则返回空串"""
+        name = f"模型 {model}"
+        if not self.breakers.available(name):
+            breaker = self.breakers.get(name)
+            breaker.rejected += 1
+            wait = breaker.retry_after()
+            return f"⚡ 模型 {model} 近期失败率过高，已暂停调用，约 {wait:.0f} 秒后自动恢复探测"
+        if not any(self.breakers.available(f"后端 {b.name}") for b in self.backends.backends):
+            breakers = [self.breakers.get(f"后端 {b.name}") for b in self.backends.backends]
+            for breaker in breakers:
+                breaker.rejected += 1
+            wait = min(breaker.retry_after() for breaker in breakers)
+            return f"⚡ 生成服务暂时不可用 (所有后端熔断中)，约 {wait:.0f} 秒后自动恢复探测"
+        return ""
 
-        # 初始日志
-        if is_image_to_image and current_image_b64:
-            logger.info(f"🚀 [图生图] 初始图片大小: {len(current_image_b64) / 1024:.2f} KB")
+    async def _generate_image(self, prompt: str, image: EncodedImage = None, is_image_to_image: bool = False,
+                              model: str = None, deadline: float = None):
+        """
+        调用 Flow2API 生成图片 (失败分类重试 + 自动降质 + 整体时限)；model 为空时使用当前模型。
+        deadline 是指令入口创建的截止时刻，为空时从现在起算
+        """
 
-        headers = {
-            'Authorization': f'Bearer {self.apikey}',
-            'Content-Type': 'application/json'
-        }
+        policy = self.retry_policy
+        max_attempts = policy.max_attempts
+        if deadline is None:
+            deadline = policy.start_deadline()
+        model = model or self.current_model
+        current_image = image
+        image_ladder = []
+
+        if is_image_to_image and image is None:
+            logger.error("❌ 图生图模式下图片数据丢失")
+            return False, "❌ 图片数据丢失"
+
+        # 初始日志 + 按模型预算生成各次尝试的图片档位
+        # (预处理后的 JPEG 已在首档预算内时直接发送，重试档位等真正需要时再一次性生成)
+        if is_image_to_image:
+            logger.info(f"🚀 [图生图] 初始图片: {image.describe()}")
+            first_budget = self._get_payload_budgets(1, model)[0]
+            if image.format == "jpeg" and 0 < max(image.width, image.height) <= 1536 and len(image.data) <= first_budget:
+                image_ladder = [image]
+            else:
+                image_ladder = await self._build_image_ladder(image, max_attempts, model)
 
-        for attempt in range(4):
-            is_retry = attempt > 0
+        self._ensure_health_checker()
+        failed_backend = None
+        last_error = ""
 
-            # === 1. 重试时的压缩逻辑 ===
-            if is_retry and is_image_to_image and current_image_b64:
-                logger.warning(f"🔄 第 {attempt} 次重试，正在压缩图片...")
-                resized_b64 = self._resize_base64_image(current_image_b64, 0.7)
-                if resized_b64:
-                    current_image_b64 = resized_b64
-                else:
-                    logger.warning("⚠️ 压缩返回空数据，保持原图重试")
+        attempt = 0
+        key_switches = 0
+        while attempt < max_attempts:
+            is_retry = attempt > 0
+            remaining = deadline - time.monotonic()
+            if remaining < policy.min_attempt_timeout:
+                self._record_outcome("deadline", model)
+                logger.error(f"⏰ 已超出整体时限 ({policy.deadline:.0f}秒)，停止重试")
+                return False, f"❌ 生成超时 (总时限 {policy.deadline:.0f} 秒)\n最后错误: {last_error or '无'}"
+
+            # === 0. 选择 API Key (剩余额度最多的；全部冷却时短暂等待或直接放弃) ===
+            api_key, wait = self.api_keys.acquire()
+            if api_key is None:
+                if wait > min(self.key_max_wait, remaining - policy.min_attempt_timeout):
+                    logger.error(f"🔑 所有 API Key 均在冷却中 (还需 {wait:.0f} 秒)")
+                    return False, "❌ 所有 API Key 额度暂时用尽，请稍后再试"
+                logger.info(f"🔑 API Key 额度不足，等待 {wait:.1f} 秒")
+                await asyncio.sleep(wait)
+                continue
+            headers = {
+                'Authorization': f'Bearer {api_key.key}',
+                'Content-Type': 'application/json'
+            }
 
-            # === 2. 构建消息内容 ===
-            content = [{"type": "text", "text": prompt}]
+            # === 1. 选择本次尝试的图片档位 (预先生成，重试不再重新压缩) ===
+            if is_image_to_image and image_ladder:
+                if is_retry and len(image_ladder) == 1:
+                    image_ladder = await self._build_image_ladder(image, max_attempts, model)
+                current_image = image_ladder[min(attempt, len(image_ladder) - 1)]
+                if is_retry:
+                    logger.warning(f"🔄 第 {attempt} 次重试，使用更小的图片档位")
+
+            # === 2. 构建 Payload (data URL 每个档位只编码一次) ===
+            with self.metrics.timer("payload", model):
+                payload = self._build_payload(
+                    prompt,
+                    current_image if is_image_to_image else None,
+                    "low" if is_retry else "high",
+                    model
+                )
+                body = json.dumps(payload).encode()
 
+            # === 3. 发送请求 (超时收缩到剩余时间以内) ===
+            attempt_timeout = policy.attempt_timeout_for(remaining)
+            size_info = ""
             if is_image_to_image:
-                if current_image_b64:
-                    # 修复 Header
-                    if not current_image_b64.startswith("data:"):
-                        if "base64," in current_image_b64:
-                            current_image_b64 = f"data:image/jpeg;base64,{current_image_b64.split('base64,')[1]}"
-                        else:
-                            current_image_b64 = f"data:image/jpeg;base64,{current_image_b64}"
-
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": current_image_b64,
-                            "detail": "low" if is_retry else "high"
-                        }
-                    })
+                size_info = f" | 当前图片: {current_image.b64_size / 1024:.2f} KB"
+
+            logger.info(f"📦 发送请求到 API (尝试 {attempt + 1}，超时 {attempt_timeout:.0f}秒){size_info}")
+
+            # 熔断中的模型/后端直接快速失败；重试时优先换一个后端
+            blocked = self._circuit_block_message(model)
+            if blocked:
+                self._record_outcome("circuit_open", model)
+                logger.warning(blocked)
+                return False, blocked
+            # 半开时探测名额可能刚被并发请求占满：模型被拒直接快速失败，后端被拒换下一个
+            model_probe = self.breakers.allow(f"模型 {model}")
+            if model_probe is None:
+                self._record_outcome("circuit_open", model)
+                return False, f"⚡ 模型 {model} 正在探测恢复中，请稍后再试"
+            backend, backend_probe = self._claim_backend(failed_backend)
+            if backend is None:
+                self.breakers.release(f"模型 {model}", model_probe)
+                self._record_outcome("circuit_open", model)
+                return False, "⚡ 生成服务正在探测恢复中 (所有后端的探测名额已占满)，请稍后再试"
+            self.backends.acquire(backend)
+            started = time.monotonic()
+            backend_ok, backend_error = False, ""
+            outcome, retryable = "error", False
+            cancelled = False
+            try:
+                status, url, err_text, retry_after = await self._post_generation(
+                    backend, body, headers, attempt_timeout, model,
+                    current_image.fingerprint() if is_image_to_image else None
+                )
+                # 4xx 是请求本身的问题，不算后端故障
+                backend_ok = status < 500
+                outcome, retryable = policy.classify_status(status, bool(url))
+                if outcome != "rate_limited" and status != 200 and self._is_quota_error(err_text):
+                    outcome, retryable = "rate_limited", True
+
+                if outcome == "ok":
+                    self._record_outcome(outcome, model)
+                    return True, url
+                if outcome == "rate_limited":
+                    # Key 限流/额度用尽：冷却该 Key
+                    self.api_keys.throttle(api_key, retry_after if retry_after is not None else self.key_default_cooldown)
+                    last_error = f"限流 (HTTP {status})"
+                    logger.warning(f"⚠️ API 限流 ({status}) [{backend.name}]: {err_text[:100]}")
+                elif outcome == "no_url":
+                    last_error = "返回内容中没有图片链接"
+                    logger.warning(f"⚠️ 返回内容中没有图片链接 [{backend.name}]")
                 else:
-                    logger.error("❌ 图生图模式下图片数据丢失")
-                    return False, "❌ 图片数据丢失"
-
-            # === 3. 最终 Payload ===
-            payload = {
-                "model": self.current_model,
-                "messages": [{"role": "user", "content": content}],
-                "stream": True
-            }
-
-            # === 4. 发送请求 (新增：显示当前图片大小) ===
-            size_info = ""
-            if is_image_to_image and current_image_b64:
-                kb_size = len(current_image_b64) / 1024
-                size_info = f" | 当前图片: {kb_size:.2f} KB"
+                    backend_error = f"HTTP {status}"
+                    last_error = f"HTTP {status}: {err_text[:200]}"
+                    logger.warning(f"⚠️ API 报错 ({status}) [{backend.name}]: {err_text[:100]}")
+
+            except asyncio.CancelledError:
+                # 对冲请求的输家被取消，不算后端故障
+                backend_ok, outcome, cancelled = None, "cancelled", True
+                raise
+            except Exception as e:
+                outcome, retryable = policy.classify_exception(e)
+                backend_error = last_error = "请求超时" if outcome == "timeout" else (str(e) or type(e).__name__)
+                if outcome == "timeout":
+                    logger.error(f"❌ 请求超时 (尝试 {attempt + 1}) [{backend.name}]")
+                else:
+                    logger.error(f"❌ 请求异常 [{backend.name}]: {last_error}")
+            finally:
+                self.backends.release(backend, backend_ok, time.monotonic() - started, backend_error)
+                if cancelled:
+                    logger.info(f"🏁 请求已取消 [{backend.name}]")
+                self.breakers.record(f"模型 {model}", outcome, model_probe)
+                self.breakers.record(f"后端 {backend.name}", outcome, backend_probe)
+                failed_backend = backend
+
+            self._record_outcome(outcome, model)
+            if not retryable:
+                logger.error(f"❌ 不可重试的错误 ({RetryPolicy.OUTCOME_NAMES.get(outcome, outcome)})，停止重试")
+                return False, f"❌ {RetryPolicy.OUTCOME_NAMES.get(outcome, outcome)}: {last_error}"
+
+            # 还有可用 Key 时立即换 Key 重发，不占用重试次数 (每个 Key 最多换一次，防止空转)
+            if outcome == "rate_limited" and key_switches < len(self.api_keys) and self.api_keys.has_available():
+                key_switches += 1
+                logger.info("🔑 切换到其他 API Key 重新发送")
+                continue
 
-            logger.info(f"📦 发送请求到 API (尝试 {attempt + 1}){size_info}")
+            attempt += 1
+            if attempt < max_attempts:
+                delay = min(policy.backoff(attempt), max(0.0, deadline - time.monotonic() - policy.min_attempt_timeout))
+                logger.info(f"⏳ {delay:.1f} 秒后重试")
+                with self.metrics.timer("retry_wait", model):
+                    await asyncio.sleep(delay)
+
+        return False, f"❌ 多次重试均失败。\n最后错误: {last_error or '无'}"
+
+    # ---------------- 核心：相同请求合并 ----------------
+    def _should_coalesce(self, command: str) -> bool:
+        if command in self.coalesce_commands:
+            return True
+        return "快捷指令" in self.coalesce_commands and command in self.prompts
+
+    async def _generate_image_shared(self, command: str, prompt: str, image: EncodedImage = None,
+                                     is_image_to_image: bool = False, fresh: bool = False,
+                                     event: AstrMessageEvent = None, model: str = None, deadline: float = None):
+        """文生图先查结果缓存；同一时刻完全相同的请求只调用一次上游，所有人拿同一个结果"""
+        model = model or self.current_model
+        cache_key = None
+        if not is_image_to_image and self.result_cache is not None:
+            cache_key = ResultCache.make_key(model, prompt)
+            if not fresh:
+                cached_url = await self.result_cache.get(cache_key)
+                if cached_url:
+                    logger.info(f"♻️ [{command}] 结果缓存命中: {cached_url[:50]}...")
+                    return True, cached_url
+
+        success, result = await self._generate_image_coalesced(
+            command, prompt, image, is_image_to_image, event, model, deadline
+        )
+        if success and cache_key is not None:
+            await self.result_cache.put(cache_key, result)
+        return success, result
+
+    async def _generate_image_coalesced(self, command: str, prompt: str, image: EncodedImage = None,
+                                        is_image_to_image: bool = False, event: AstrMessageEvent = None,
+                                        model: str = None, deadline: float = None):
+        model = model or self.current_model
+        if not self._should_coalesce(command):
+            return await self._generate_image_admitted(
+                prompt, image, is_image_to_image, event, model=model, deadline=deadline
+            )
 
-            try:
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=120)
-                    async with session.post(self.api_url, json=payload, headers=headers,
-                                            timeout=timeout) as response:
-
-                        if response.status != 200:
-                            err_text = await response.text()
-                            logger.warning(f"⚠️ API 报错 ({response.status}): {err_text[:100]}")
-
-                        if response.status == 200:
-                            response_text = await response.text()
-
-                            # 解析流式
-                            full_content = ""
-                            lines = response_text.strip().split('\n')
-                            for line in lines:
-                                line = line.strip()
-                                if line.startswith("data: ") and line != "data: [DONE]":
-                                    try:
-                                        chunk = json.loads(line[6:])
-                                        if chunk and "choices" in chunk and chunk["choices"]:
-                                            delta = chunk["choices"][0].get("delta", {})
-                                            content_text = delta.get("content", "")
-                                            if content_text: full_content += content_text
-                                    except:
-                                        pass
-
-                            # 提取 URL
-                            url_patterns = [r'!\[.*?\]\((https?://[^\s)]+)\)', r'\((https?://[^\s)]+)\)',
-                                            r'(https?://[^\s<>"]+)']
-                            for pattern in url_patterns:
-                                urls = re.findall(pattern, full_content, re.IGNORECASE)
-                                if urls:
-                                    logger.info(f"✅ 生成成功: {urls[0][:50]}...")
-                                    return True, urls[0]
-
-                            if "http" in full_content.lower():
-                                words = re.split(r'[\s\n\r\t,.;:!?()\[\]{}]+', full_content)
-                                for word in words:
-                                    if word.lower().startswith(('http://', 'https://')):
-                                        cleaned = re.sub(r'[.,;:!?)\]]+$', '', word)
-                                        return True, cleaned
+        key = (model, prompt, image.digest if is_image_to_image and image is not None else "")
+        task = self._inflight.get(key)
+        if task is None:
+            self.coalesce_stats["leader"] += 1
+            # 合并进来的请求比发起者晚到，沿用发起者的截止时刻不会超出它们自己的时限
+            task = asyncio.create_task(
+                self._generate_image_admitted(prompt, image, is_image_to_image, event, model=model, deadline=deadline)
+            )
+            self._inflight[key] = task
 
-            except asyncio.TimeoutError:
-                logger.error(f"❌ 请求超时 (尝试 {attempt + 1})")
-            except Exception as e:
-                logger.error(f"❌ 请求异常: {str(e)}")
+            def _forget(done_task):
+                if self._inflight.get(key) is done_task:
+                    del self._inflight[key]
 
-            if attempt < 3:
-                await asyncio.sleep(1)
+            task.add_done_callback(_forget)
+        else:
+            self.coalesce_stats["joined"] += 1
+            logger.info(f"🔗 [{command}] 合并到正在进行的相同请求 (当前共享 {self.coalesce_stats['joined']} 次)")
+
+        # shield：某个用户的处理被取消不影响其他等待者
+        return await asyncio.shield(task)
+
+    # ---------------- 核心：准入控制 (排队) ----------------
+    @staticmethod
+    def _requester_of(event: AstrMessageEvent = None):
+        """(用户, 群) 标识；私聊按用户单独成组"""
+        if event is None:
+            return "system", "system"
+        user = str(event.get_sender_id())
+        group = str(event.get_group_id() or "") or f"private:{user}"
+        return user, group
+
+    async def _generate_image_admitted(self, prompt: str, image: EncodedImage = None,
+                                       is_image_to_image: bool = False, event: AstrMessageEvent = None,
+                                       model: str = None, user_limit: int = 0, deadline: float = None):
+        """拿到执行名额后再调用上游；排队时告知用户位置，队列满或排队超时直接返回失败 (排队时间计入总时限)"""
+        model = model or self.current_model
+        if deadline is None:
+            deadline = self.retry_policy.start_deadline()
+        # 熔断中不占用排队名额，直接告知用户
+        blocked = self._circuit_block_message(model)
+        if blocked:
+            self._record_outcome("circuit_open", model)
+            return False, blocked
+
+        user, group = self._requester_of(event)
+        try:
+            ticket = self.admission.submit(user, group, user_limit)
+        except AdmissionRejected as e:
+            logger.warning(f"🚦 请求被拒绝 ({user}@{group}): {e}")
+            return False, f"🚦 {e}"
 
-        return False, "❌ 多次重试均失败。"
+        try:
+            if not ticket.granted:
+                position = self.admission.position(ticket)
+                logger.info(f"⏳ 请求排队 ({user}@{group})，第 {position} 位")
+                if event is not None:
+                    await event.send(event.plain_result(f"⏳ 当前生成请求较多，已排队，第 {position} 位，请稍候..."))
+                remaining = deadline - time.monotonic()
+                try:
+                    await asyncio.wait_for(ticket.wait(), timeout=min(self.admission.queue_timeout, remaining))
+                except asyncio.TimeoutError:
+                    self.admission.stats["timeout"] += 1
+                    if remaining < self.admission.queue_timeout:
+                        self._record_outcome("deadline", model)
+                        return False, f"❌ 生成超时 (总时限 {self.retry_policy.deadline:.0f} 秒)，排队期间已用完"
+                    return False, "🚦 排队超时，当前请求过多，请稍后再试"
+            with self.metrics.timer("generate", model):
+                if not is_image_to_image and self.hedge.enabled:
+                    return await self._generate_image_hedged(prompt, model, deadline, ticket)
+                return await self._generate_image(prompt, image, is_image_to_image, model, deadline)
+        finally:
+            self.admission.release(ticket)
+
+    async def _generate_image_hedged(self, prompt: str, model: str = None, deadline: float = None,
+                                     ticket: AdmissionTicket = None):
+        """
+        文生图对冲：超过自适应等待时间仍未出图时再发一份 (与主请求共用截止时刻)，先出图者胜，另一份取消。
+        对冲请求同样占用准入名额 (同一请求的个人上限额外 +1)，拿不到名额就不对冲，不排队
+        """
+        hedge = self.hedge
+        hedge_ticket = None
+        hedge.on_request()
+        started = time.monotonic()
+        if deadline is None:
+            deadline = self.retry_policy.start_deadline()
+        primary = asyncio.create_task(self._generate_image(prompt, model=model, deadline=deadline))
+        pending = {primary}
+        try:
+            delay = hedge.delay()
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            # 剩余时间不够一次完整尝试时不再对冲
+            enough_time = deadline - time.monotonic() >= self.retry_policy.min_attempt_timeout
+            if not done and enough_time and ticket is not None:
+                hedge_ticket = self.admission.try_acquire(ticket.user, ticket.group, ticket.limit + 1)
+                if hedge_ticket is None:
+                    hedge.stats["admission_denied"] += 1
+                elif not hedge.try_spend():
+                    self.admission.release(hedge_ticket)
+                    hedge_ticket = None
+            if hedge_ticket is not None:
+                logger.info(f"🏁 {delay:.0f} 秒内未出图，发送对冲请求{f' ({hedge.model})' if hedge.model else ''}")
+                pending.add(asyncio.create_task(
+                    self._generate_image(prompt, model=hedge.model or model, deadline=deadline)
+                ))
+
+            result = (False, "❌ 多次重试均失败。")
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result[0]:
+                        if task is not primary:
+                            hedge.stats["hedge_won"] += 1
+                        hedge.latency.observe(time.monotonic() - started)
+                        return result
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+            if hedge_ticket is not None:
+                self.admission.release(hedge_ticket)
+
+    @staticmethod
+    def _pop_fresh_flag(prompt: str):
+        """去掉描述开头的 --new 标记，返回 (描述, 是否强制重新生成)"""
+        if prompt == "--new" or prompt.startswith("--new "):
+            return prompt[5:].strip(), True
+        return prompt, False
 
     # ---------------- 图生图命令 ----------------
 
@@ -486,12 +3833,15 @@ API地址: {self.convert_api_url}
             return
 
         logger.info(f"执行图生图命令: {prompt}")
+        _current_command.set("图")
 
-        # 记录开始时间
+        # 记录开始时间；总时限从这里算起 (取图、排队、重试都计入)
         start_time = time.time()
+        deadline = self.retry_policy.start_deadline()
 
         # 1. 提取图片URL
-        image_data = await self._extract_image_url_from_event(event)
+        with self.metrics.timer("extract", self.current_model):
+            image_data = await self._extract_image_url_from_event(event)
 
         if not image_data:
             yield event.plain_result(
@@ -504,55 +3854,63 @@ API地址: {self.convert_api_url}
 
         logger.info(f"✅ 提取到图片数据: {image_data[:100]}...")
 
-        # 2. 统一转换为base64格式
-        image_base64 = None
-
-        if image_data.startswith("data:image/jpeg;base64,"):
-            # 已经是base64格式，直接使用
-            image_base64 = image_data
-            b64_len = len(image_data.split("base64,")[1]) if "base64," in image_data else len(image_data)
-            logger.info(f"✅ 图片已经是base64格式，长度: {b64_len}")
-            yield event.plain_result(f"✅ 检测到base64图片 (长度: {b64_len})")
+        # 2. 统一转换为图片对象 (原始字节，只在发送时编码一次)
+        if image_data.startswith("data:image/"):
+            # 已经是base64格式，直接解码使用
+            try:
+                image = EncodedImage.from_data_url(image_data)
+            except ValueError as e:
+                logger.warning(f"⚠️ base64 图片数据无法解码: {e}")
+                yield event.plain_result("❌ 图片数据无法解码 (base64 格式错误)，请重新发送图片")
+                return
+            logger.info(f"✅ 图片已经是base64格式，长度: {image.b64_size}")
+            yield event.plain_result(f"✅ 检测到base64图片 (长度: {image.b64_size})")
         else:
             # 是URL格式，智能处理 (GIF本地转，其他API转)
-            image_base64 = await self._process_image_url(image_data)
+            image, error, reason = await self._process_image_url(image_data)
 
             # 检查返回结果是否是调试信息
-            if not image_base64:
+            if image is None and not error:
                 yield event.plain_result(
                     f"❌ 图片转换失败\n"
                     f"原因: 第三方API转换失败\n"
                     f"原始URL: {image_data[:200]}..."
                 )
                 return
-            elif "==============" in image_base64 and "调试用" in image_base64:
+            elif image is None and reason == InputFailure.CONVERT_DEBUG:
                 # 返回的是调试信息，直接展示给用户
                 yield event.plain_result(
                     f"❌ 图片转换失败，以下是调试信息:\n"
-                    f"{image_base64}"
+                    f"{error}"
                 )
                 return
-            elif not image_base64.startswith("data:image/jpeg;base64,"):
+            elif image is None and reason == InputFailure.TOO_LARGE:
+                yield event.plain_result(f"❌ {error}，请换一张小一点的图片")
+                return
+            elif image is None:
                 # 格式不正确
                 yield event.plain_result(
                     f"❌ 图片转换失败，返回格式不正确\n"
-                    f"返回数据预览: {image_base64[:300]}..."
+                    f"返回数据预览: {error[:300]}..."
                 )
                 return
 
+        # 后台任务模式：图片已处理好，连同描述一起入队，立即返回任务号
+        if self.job_store is not None:
+            yield event.plain_result(await self._submit_job(event, "图", prompt, image))
+            return
+
         # 3. 显示转换信息
-        if "base64," in image_base64:
-            b64_len = len(image_base64.split("base64,")[1])
-            image_info = f"✅ 图片准备完成 (base64长度: {b64_len})"
-        else:
-            image_info = f"✅ 图片数据准备完成"
+        image_info = f"✅ 图片准备完成 (base64长度: {image.b64_size})"
 
         logger.info(f"{image_info}")
 
         yield event.plain_result(f"{image_info}\n🎨 正在基于图片生成: {prompt[:50]}...")
 
-        # 4. 调用API（传递base64格式），标记为图生图模式
-        success, result = await self._generate_image(prompt, image_base64, is_image_to_image=True)
+        # 4. 调用API（传递图片对象），标记为图生图模式
+        success, result = await self._generate_image_shared(
+            "图", prompt, image, is_image_to_image=True, event=event, deadline=deadline
+        )
 
         # 计算总耗时
         end_time = time.time()
@@ -571,10 +3929,10 @@ API地址: {self.convert_api_url}
         else:
             # === 👇 改了这里：失败时把 Base64 信息发出来 👇 ===
 
-            # 截取 Base64 头部前 100 个字符
-            b64_preview = image_base64[:100] + "..." if image_base64 else "无数据"
+            # 截取 Base64 头部前 100 个字符 (data URL 发送时已缓存，不会重复编码)
+            b64_preview = image.data_url[:100] + "..."
             # 获取总长度
-            b64_len = len(image_base64) if image_base64 else 0
+            b64_len = len(image.data_url)
 
             debug_msg = (
                 f"❌ 图片生成失败 (耗时: {total_time:.2f}秒)\n"
@@ -601,21 +3959,32 @@ API地址: {self.convert_api_url}
             yield event.plain_result("⚠️ 请输入描述")
             return
 
-        prompt = parts[1].strip()
+        prompt, fresh = self._pop_fresh_flag(parts[1].strip())
+        if not prompt:
+            yield event.plain_result("⚠️ 请输入描述")
+            return
 
         if not self.apikey:
             yield event.plain_result("❌ 请先配置 API Key")
             return
 
         logger.info(f"执行文生图命令: {prompt}")
+        _current_command.set("文")
 
-        # 记录开始时间
+        if self.job_store is not None:
+            yield event.plain_result(await self._submit_job(event, "文", prompt, fresh=fresh))
+            return
+
+        # 记录开始时间；总时限从这里算起 (排队、对冲、重试都计入)
         start_time = time.time()
+        deadline = self.retry_policy.start_deadline()
 
         yield event.plain_result(f"🎨 正在生成: {prompt[:50]}...")
 
         # 文生图不需要图片数据
-        success, result = await self._generate_image(prompt, None, is_image_to_image=False)
+        success, result = await self._generate_image_shared(
+            "文", prompt, None, is_image_to_image=False, fresh=fresh, event=event, deadline=deadline
+        )
 
         # 计算总耗时
         end_time = time.time()
@@ -635,138 +4004,233 @@ API地址: {self.convert_api_url}
             # 失败时也显示耗时
             yield event.plain_result(f"❌ 图片生成失败 (耗时: {total_time:.2f}秒)\n\n错误详情:\n{result}")
 
-    # ---------------- 自定义快捷指令 ----------------
-    @filter.event_message_type(filter.EventMessageType.ALL, priority=10)
-    async def on_prompt_command(self, event: AstrMessageEvent):
-        """处理自定义提示词"""
-        text = event.message_str.strip()
-        if not text:
+    # ---------------- 批量生成命令 ----------------
+    def _parse_batch_args(self, text: str):
+        """
+        解析 "/批量 [数量|-n 数量] [-m 模型,...] 描述"，返回 (数量, 模型列表, 描述, 错误)。
+        开头的裸数字只有在 1-batch_max_count 之内才当作数量 ("/批量 2024 新年" 里的 2024 属于描述)；
+        -n 明确指定数量 (只能指定一次，和开头的裸数字同时出现视为错误)。模型可以写 /模型列表 里的编号或完整模型名，多个用英文逗号分隔；不写就用当前模型
+        """
+        tokens = text.split()
+        count, models = 0, []
+        while tokens:
+            token = tokens[0]
+            if not count and token.isdigit() and 1 <= int(token) <= self.batch_max_count:
+                count = int(token)
+            elif token in ("-n", "--count"):
+                if count:
+                    return 0, [], "", "数量只能指定一次 (开头的数字和 -n 不能同时使用)"
+                if len(tokens) < 2:
+                    return 0, [], "", f"{token} 后面需要写数量"
+                if not tokens[1].isdigit() or int(tokens[1]) < 1:
+                    return 0, [], "", f"数量必须是正整数: {tokens[1]}"
+                count = int(tokens[1])
+                tokens = tokens[1:]
+            elif token in ("-m", "--model") and len(tokens) > 1:
+                for ref in tokens[1].split(","):
+                    ref = ref.strip()
+                    if not ref:
+                        continue
+                    if ref.isdigit():
+                        index = int(ref)
+                        if index < 1 or index > len(self.available_models):
+                            return 0, [], "", f"模型编号 {ref} 不存在，请输入 1-{len(self.available_models)}"
+                        ref = self.available_models[index - 1]
+                    if ref not in models:
+                        models.append(ref)
+                tokens = tokens[1:]
+            else:
+                break
+            tokens = tokens[1:]
+        return count or 1, models or [self.current_model], " ".join(tokens), ""
+
+    async def _prepare_batch_image(self, event: AstrMessageEvent, model: str = None):
+        """批量生成的输入图只提取、下载、处理一次，所有变体共用；返回 (图片, 错误)，无图时两者都为空"""
+        with self.metrics.timer("extract", model or self.current_model):
+            image_data = await self._extract_image_url_from_event(event)
+        if not image_data:
+            return None, ""
+        image, error, _ = await self._process_image_url(image_data, model)
+        if image is None:
+            return None, error or "第三方API转换失败"
+        return image, ""
+
+    @filter.command("批量")
+    async def cmd_batch(self, event: AstrMessageEvent):
+        """使用方法: /批量 [数量|-n 数量] [-m 模型编号,...] 描述 (附带图片则为图生图)"""
+        raw_text = event.message_str.strip()
+        parts = raw_text.split(maxsplit=1)
+        if len(parts) < 2:
+            yield event.plain_result(
+                "⚠️ 用法: /批量 [数量|-n 数量] [-m 模型编号,...] 描述\n"
+                "例如: /批量 3 一只猫  或  /批量 2 -m 1,3 一只猫\n"
+                "描述以数字开头时用 -n 指定数量: /批量 -n 2 2024 新年"
+            )
             return
 
-        parts = text.split()
-        if not parts:
+        count, models, prompt, error = self._parse_batch_args(parts[1].strip())
+        if error:
+            yield event.plain_result(f"❌ {error}")
             return
-
-        cmd = parts[0].strip().lstrip("/")
-        if cmd not in self.prompt_map:
+        if not prompt:
+            yield event.plain_result("⚠️ 请输入描述")
             return
-
         if not self.apikey:
             yield event.plain_result("❌ 请先配置 API Key")
             return
 
-        actual_prompt = self.prompt_map[cmd]
+        # 每个模型各出 count 张，总数不超过上限
+        variants = [model for model in models for _ in range(count)]
+        if len(variants) > self.batch_max_count:
+            yield event.plain_result(f"⚠️ 一次最多生成 {self.batch_max_count} 张，已按前 {self.batch_max_count} 张处理")
+            variants = variants[:self.batch_max_count]
 
-        # 记录开始时间
+        logger.info(f"执行批量生成命令: {len(variants)} 张, 模型 {models}, 描述: {prompt}")
+        _current_command.set("批量")
         start_time = time.time()
 
-        # 提取图片数据
-        image_data = await self._extract_image_url_from_event(event)
-
-        image_base64 = None
-        is_image_mode = False
-
-        if image_data:
-            logger.info(f"自定义指令: {cmd}, 找到图片数据")
-
-            # 统一转换为base64格式
-            if image_data.startswith("data:image/jpeg;base64,"):
-                image_base64 = image_data
-                is_image_mode = True
-            else:
-                # 智能处理 (GIF本地转，其他API转)
-                image_base64 = await self._process_image_url(image_data)
-                is_image_mode = bool(image_base64) and "失败" not in image_base64
-
-            if is_image_mode:
-                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (图生图模式)")
-                success, result = await self._generate_image(actual_prompt, image_base64, is_image_to_image=True)
-            else:
-                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式，图片转换失败)")
-                success, result = await self._generate_image(actual_prompt, None, is_image_to_image=False)
-        else:
-            logger.info(f"自定义指令: {cmd}, 无图片数据")
-            yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式)")
-            success, result = await self._generate_image(actual_prompt, None, is_image_to_image=False)
-
-        # 计算总耗时
-        end_time = time.time()
-        total_time = end_time - start_time
-
-        if success:
-            # 获取当前时间
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        image, error = await self._prepare_batch_image(event, models[0])
+        if error:
+            yield event.plain_result(f"❌ 图片转换失败: {error[:300]}")
+            return
+        is_image_to_image = image is not None
+
+        mode = "图生图" if is_image_to_image else "文生图"
+        yield event.plain_result(f"🎨 正在批量{mode} {len(variants)} 张: {prompt[:50]}...")
+
+        # 不走请求合并/结果缓存 (否则相同的变体会被合成一张)；
+        # 本批最多 batch_concurrency 张同时占用排队名额，全局/每群上限照常生效
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+        user_limit = min(self.batch_concurrency, len(variants))
+
+        async def one_variant(index: int, model: str):
+            async with semaphore:
+                # 每张各有完整的总时限，从轮到它时算起 (本批内的先后顺序不占用时限，全局排队照常计入)
+                variant_start = time.time()
+                success, result = await self._generate_image_admitted(
+                    prompt, image, is_image_to_image, event, model=model, user_limit=user_limit,
+                    deadline=self.retry_policy.start_deadline()
+                )
+                return index, model, success, result, time.time() - variant_start
 
-            success_text = f"✅ 图片生成完成！\n⏱️ 总耗时: {total_time:.2f}秒\n"
-            chain = [
-                Plain(success_text),
-                Image.fromURL(result),
-            ]
+        tasks = [asyncio.create_task(one_variant(i, model)) for i, model in enumerate(variants)]
+        results, failures = [], []
+        try:
+            for future in asyncio.as_completed(tasks):
+                index, model, success, result, elapsed = await future
+                label = f"#{index + 1}" + (f" [{model}]" if len(models) > 1 else "")
+                if not success:
+                    failures.append(f"{label}: {str(result).splitlines()[0][:80]}")
+                    continue
+                if self.batch_merge:
+                    results.append((index, label, result))
+                else:
+                    # 出一张发一张，不等最慢的那张
+                    yield event.chain_result([Plain(f"✅ {label} 完成 ({elapsed:.2f}秒)\n"), Image.fromURL(result)])
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        total_time = time.time() - start_time
+        succeeded = len(variants) - len(failures)
+        summary = f"📦 批量生成结束: 成功 {succeeded}/{len(variants)} | ⏱️ 总耗时: {total_time:.2f}秒"
+        if failures:
+            summary += "\n❌ 失败:\n" + "\n".join(failures)
+
+        if self.batch_merge and results:
+            chain = [Plain(summary + "\n")]
+            for _, label, url in sorted(results):
+                chain += [Plain(f"{label}\n"), Image.fromURL(url)]
             yield event.chain_result(chain)
         else:
-            # 失败时也显示耗时
-            yield event.plain_result(f"❌ 图片生成失败 (耗时: {total_time:.2f}秒)\n\n错误详情:\n{result}")
-
-        event.stop_event()
+            yield event.plain_result(summary)
 
     # ---------------- 自定义快捷指令 ----------------
     @filter.event_message_type(filter.EventMessageType.ALL, priority=10)
     async def on_prompt_command(self, event: AstrMessageEvent):
-        """处理自定义提示词"""
-        text = event.message_str.strip()
-        if not text:
-            return
-
-        parts = text.split()
-        if not parts:
-            return
-
-        cmd = parts[0].strip().lstrip("/")
-        if cmd not in self.prompt_map:
+        """处理自定义提示词 (每条消息都会经过这里，先用前缀树判断是不是快捷指令)"""
+        routed = self.prompt_router.match(event.message_str)
+        if routed is None:
             return
+        cmd, args = routed
 
         if not self.apikey:
             yield event.plain_result("❌ 请先配置 API Key")
             return
 
-        actual_prompt = self.prompt_map[cmd]
+        # 取当前快照里的条目；热加载换库不影响这条指令
+        entry = self.prompts.get(cmd)
+        if entry is None:
+            return
+        actual_prompt = entry.prompt
+        model = entry.model or None
+        _current_command.set(cmd)
+        fresh = "--new" in args.split()
+
+        # 记录开始时间；总时限从这里算起 (取图、排队、重试都计入)
+        start_time = time.time()
+        deadline = self.retry_policy.start_deadline()
 
-        # 提取图片数据
-        image_data = await self._extract_image_url_from_event(event)
+        # 提取图片数据 (条目声明不用图时跳过)
+        image_data = None
+        if entry.image != "none":
+            with self.metrics.timer("extract", model or self.current_model):
+                image_data = await self._extract_image_url_from_event(event)
 
-        image_base64 = None
-        is_image_mode = False
+        image = None
 
         if image_data:
             logger.info(f"自定义指令: {cmd}, 找到图片数据")
 
-            # 统一转换为base64格式
-            if image_data.startswith("data:image/jpeg;base64,"):
-                image_base64 = image_data
-                is_image_mode = True
-            else:
-                image_base64 = await self._convert_url_to_base64_via_api(image_data)
-                is_image_mode = bool(image_base64)
+            # 统一转换为图片对象 (data URL 直接解码，URL 智能处理：GIF本地转，其他API转)
+            image, _, _ = await self._process_image_url(image_data, model)
 
-            if is_image_mode:
-                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (图生图模式)")
-                success, result = await self._generate_image(actual_prompt, image_base64, is_image_to_image=True)
-            else:
-                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式，图片转换失败)")
-                success, result = await self._generate_image(actual_prompt, None, is_image_to_image=False)
+        if image is None and entry.image == "required":
+            yield event.plain_result(
+                f"❌ 快捷指令 [{cmd}] 需要附带图片" + ("，图片转换失败" if image_data else "") +
+                "\n发送图片/引用图片/@用户 + 指令名 即可"
+            )
+            event.stop_event()
+            return
+
+        if self.job_store is not None:
+            yield event.plain_result(await self._submit_job(event, cmd, actual_prompt, image, model=model, fresh=fresh))
+            event.stop_event()
+            return
+
+        if image is not None:
+            yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (图生图模式)")
+            success, result = await self._generate_image_shared(
+                cmd, actual_prompt, image, is_image_to_image=True, event=event, model=model, deadline=deadline
+            )
         else:
-            logger.info(f"自定义指令: {cmd}, 无图片数据")
-            yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式)")
-            success, result = await self._generate_image(actual_prompt, None, is_image_to_image=False)
+            if image_data:
+                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式，图片转换失败)")
+            else:
+                logger.info(f"自定义指令: {cmd}, 无图片数据")
+                yield event.plain_result(f"🎨 执行快捷指令 [{cmd}]... (文生图模式)")
+            success, result = await self._generate_image_shared(
+                cmd, actual_prompt, None, is_image_to_image=False, fresh=fresh, event=event, model=model,
+                deadline=deadline
+            )
+
+        # 计算总耗时
+        end_time = time.time()
+        total_time = end_time - start_time
 
         if success:
+            # 获取当前时间
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            success_text = f"✅ 图片生成完成！\n⏱️ 总耗时: {total_time:.2f}秒\n"
             chain = [
-                Plain("✅ 图片生成完成！\n"),
+                Plain(success_text),
                 Image.fromURL(result),
             ]
             yield event.chain_result(chain)
         else:
-            yield event.plain_result(result)
+            # 失败时也显示耗时
+            yield event.plain_result(f"❌ 图片生成失败 (耗时: {total_time:.2f}秒)\n\n错误详情:\n{result}")
 
         event.stop_event()
 
@@ -902,54 +4366,243 @@ API地址: {self.convert_api_url}
         # ---------------- 新增：列出所有提示词指令 ----------------
     @filter.command("提示词")
     async def list_all_prompts(self, event: AstrMessageEvent):
-        """列出所有自定义提示词的快捷指令名（不显示内容）"""
-        if not self.prompt_map:
+        """分页列出快捷指令名（不显示内容）: /提示词 [分类或关键词] [页码]"""
+        library = self.prompts
+        if not library:
             yield event.plain_result("📂 当前未配置任何自定义提示词。")
             return
 
-        # 获取所有的键（即指令名），不获取值（内容）
-        keys = list(self.prompt_map.keys())
+        # 参数：页码 和/或 分类名/关键词，顺序随意
+        keyword, page = "", 1
+        for arg in event.message_str.split()[1:]:
+            if arg.isdigit():
+                page = int(arg)
+            else:
+                keyword = arg
 
-        # 构造回复消息
-        msg = (
-            f"📂 当前已加载 {len(keys)} 个快捷提示词：\n"
-            f"━━━━━━━━━━━━━━\n"
-        )
+        entries = library.search(keyword)
+        if not entries:
+            yield event.plain_result(f"📂 没有找到与「{keyword}」相关的提示词")
+            return
+
+        size = self.prompt_page_size
+        pages = (len(entries) + size - 1) // size
+        page = min(max(1, page), pages)
+        shown = entries[(page - 1) * size:page * size]
+
+        title = f"「{keyword}」" if keyword else "全部"
+        lines = [
+            f"📂 快捷提示词 {title} 共 {len(entries)} 个 (第 {page}/{pages} 页)",
+            "━━━━━━━━━━━━━━",
+        ]
+        if not keyword and len(library.categories) > 1:
+            lines.append("🗂️ 分类: " + " | ".join(f"{c} ({len(n)})" for c, n in library.categories.items()))
+        lines += [f"• {entry.describe()}" for entry in shown]
+        lines.append("━━━━━━━━━━━━━━")
+        if pages > 1:
+            lines.append(f"📄 翻页: /提示词 {keyword + ' ' if keyword else ''}{page % pages + 1}")
+        lines.append(f"💡 使用方法: 直接发送指令名 (例如: /{shown[0].name})，/提示词 分类名 按分类查看")
+
+        yield event.plain_result("\n".join(lines))
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("重载提示词")
+    async def reload_prompts(self, event: AstrMessageEvent):
+        """立即重新加载提示词库文件 (仅管理员；平时修改文件会自动热加载)"""
+        if self.prompt_file is None:
+            yield event.plain_result("❌ 未配置提示词库文件 (prompt_store.file)")
+            return
+        ok, detail = await self._reload_prompts()
+        yield event.plain_result(f"✅ 提示词库已重新加载: {detail}" if ok else f"❌ 重新加载失败，继续使用旧版本:\n{detail}")
+
+    # ---------------- 后台任务命令 ----------------
+    @filter.command("任务")
+    async def show_jobs(self, event: AstrMessageEvent):
+        """后台任务: /任务 查看我的任务，/任务 <任务号> 查看详情，/任务 取消 <任务号>"""
+        if self.job_store is None:
+            yield event.plain_result("❌ 后台任务模式未开启 (配置 jobs.enable)")
+            return
+
+        args = event.message_str.split()[1:]
+        user, _ = self._requester_of(event)
+        try:
+            if not args:
+                jobs = await asyncio.to_thread(self.job_store.recent, user)
+                counts = await asyncio.to_thread(self.job_store.counts)
+                lines = [f"🧾 后台任务: 排队 {counts.get('queued', 0)} | 执行中 {counts.get('running', 0)}"]
+                if not jobs:
+                    lines.append("你还没有提交过任务")
+                for job in jobs:
+                    lines.append(
+                        f"• #{job['id']} {JobStore.STATUS_NAMES.get(job['status'], job['status'])} | "
+                        f"[{job['command']}] {job['prompt'][:20]} | "
+                        f"{datetime.fromtimestamp(job['created_at']).strftime('%m-%d %H:%M')}"
+                    )
+                lines.append("💡 /任务 <任务号> 查看详情，/任务 取消 <任务号> 取消排队中的任务")
+                yield event.plain_result("\n".join(lines))
+                return
+
+            cancel = args[0] in ("取消", "cancel")
+            job_id = (args[1] if cancel and len(args) > 1 else args[0]).lstrip("#")
+            job = await asyncio.to_thread(self.job_store.get, job_id)
+            if job is None:
+                yield event.plain_result(f"❌ 没有找到任务 #{job_id}")
+                return
+            # 查看详情和取消一样，只限提交者本人或管理员
+            if job["user"] != user and not event.is_admin():
+                yield event.plain_result("❌ 只能取消自己提交的任务" if cancel else "❌ 只能查看自己提交的任务")
+                return
 
-        # 循环拼接，每个指令换一行显示
-        for key in keys:
-            msg += f"• {key}  "
+            if cancel:
+                if await asyncio.to_thread(self.job_store.cancel, job_id):
+                    self.job_stats["cancelled"] += 1
+                    yield event.plain_result(f"✅ 已取消任务 #{job_id}")
+                elif job_id in self._running_jobs:
+                    self._cancelled_jobs.add(job_id)
+                    self._running_jobs[job_id][0].cancel()
+                    yield event.plain_result(f"✅ 已停止正在生成的任务 #{job_id}")
+                else:
+                    yield event.plain_result(f"⚠️ 任务 #{job_id} 已{JobStore.STATUS_NAMES.get(job['status'], job['status'])}，无法取消")
+                return
 
-        msg += f"━━━━━━━━━━━━━━\n💡 使用方法: 直接发送指令名 (例如: /{keys[0] if keys else '指令名'})"
+            now = time.time()
+            lines = [
+                f"🧾 任务 #{job_id} [{job['command']}] {JobStore.STATUS_NAMES.get(job['status'], job['status'])}",
+                f"• 描述: {job['prompt'][:50]}",
+                f"• 提交于: {datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M:%S')}",
+            ]
+            if job["model"]:
+                lines.append(f"• 模型: {job['model']}")
+            if job["status"] == "queued":
+                ahead = await asyncio.to_thread(self.job_store.position, job["created_at"])
+                lines.append(f"• 排队: 前面还有 {ahead} 个，已等待 {now - job['created_at']:.0f} 秒")
+            elif job["status"] == "running":
+                lines.append(f"• 已生成 {now - (job['started_at'] or now):.0f} 秒 (第 {job['attempts']} 次执行)")
+            elif job["finished_at"]:
+                lines.append(f"• 总耗时: {job['finished_at'] - job['created_at']:.2f} 秒")
+            if job["status"] == "done":
+                lines.append(f"• 结果: {job['result']}" + ("" if job["delivered"] else " (尚未推送成功)"))
+            elif job["error"]:
+                lines.append(f"• 错误: {job['error'][:200]}")
+            yield event.plain_result("\n".join(lines))
+        except sqlite3.Error as e:
+            yield event.plain_result(f"❌ 读取任务失败: {e}")
 
-        yield event.plain_result(msg)
     # ---------------- 配置显示命令 ----------------
     @filter.command("gemini设置")
     async def show_settings(self, event: AstrMessageEvent):
         """显示当前设置"""
         key_mask = self.apikey[:4] + "***" + self.apikey[-4:] if len(self.apikey) > 8 else "未配置"
+        if len(self.apikeys) > 1:
+            key_mask += f" 等 {len(self.apikeys)} 个"
 
         model_info = self._get_model_info(self.current_model)
+        backend_info = "\n".join(f"• {line}" for line in self.backends.summary_lines())
+        key_info = "\n".join(f"• {line}" for line in self.api_keys.summary_lines()) or "• 未配置"
+        breaker_info = "\n".join(f"• {line}" for line in self.breakers.summary_lines())
 
         info = (
             f"🎨 Gemini 绘图插件 (纯base64版) v8.6\n\n"
             f"📊 基本设置：\n"
-            f"• API地址: {self.api_url}\n"
+            f"• API地址: {self.api_url}{f' 等 {len(self.api_urls)} 个后端' if len(self.api_urls) > 1 else ''}\n"
             f"• API Key: {key_mask}\n"
             f"• 当前模型: {self.current_model}\n"
             f"• 模型名称: {model_info['name']}\n"
             f"• 图像方向: {model_info['orientation']}\n"
-            f"• 自定义指令: {len(self.prompt_map)} 个\n\n"
+            f"• 自定义指令: {len(self.prompts)} 个 (来源: {self.prompts.source}，"
+            f"加载于 {datetime.fromtimestamp(self.prompts.loaded_at).strftime('%H:%M:%S')})\n"
+            f"• 指令路由: {self.prompt_router.summary()}\n\n"
             f"🔄 图片处理流程：\n"
             f"• 转换API: {'✅ 启用' if self.enable_convert_api else '❌ 禁用'}\n"
             f"• 转换地址: {self.convert_api_url}\n"
-            f"• 处理流程: URL → 转换API → base64 → 谷歌API\n\n"
+            f"• 处理流程: URL → 本地处理/转换API → base64 → 谷歌API\n"
+            f"• 获取策略: {self.input_strategy.summary()}\n"
+            f"• 图片处理池: {self.image_pool.summary()}\n"
+            f"• 链接缓存: {self.url_cache.summary()}\n"
+            f"• 内容缓存: {self.content_cache.summary()}\n"
+            f"• 头像缓存: {self.avatar_store.summary() if self.avatar_store else '❌ 禁用'}\n"
+            f"• 请求合并: 上游调用 {self.coalesce_stats['leader']} 次，合并 {self.coalesce_stats['joined']} 次\n"
+            f"• 结果缓存: {self.result_cache.summary() if self.result_cache else '❌ 禁用'}\n"
+            f"• 请求队列: {self.admission.summary()}\n"
+            f"• 请求结果: {self.retry_policy.summary()}\n"
+            f"• 对冲请求: {self.hedge.summary()}\n"
+            f"• SSE 录制: {self.sse_recorder.summary() if self.sse_recorder else '❌ 禁用'}\n"
+            f"• 卡顿检测: {self.loop_monitor.summary() if self.loop_monitor else '❌ 禁用'}\n"
+            f"• 后台任务: {self._jobs_summary()}\n\n"
+            f"🖥️ 后端状态 ({self.backends.strategy})：\n"
+            f"{backend_info}\n\n"
+            f"🔑 API Key 状态：\n"
+            f"{key_info}\n\n"
+            f"⚡ 熔断器：\n"
+            f"{breaker_info}\n\n"
             f"🎨 绘图命令：\n"
-            f"• /文生图 <描述词>\n"
+            f"• /文生图 <描述词> (开头加 --new 跳过结果缓存)\n"
             f"• /图生图 <描述词>"
         )
         yield event.plain_result(info)
 
+    # ---------------- 指标统计命令 ----------------
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("gemini统计")
+    async def show_metrics(self, event: AstrMessageEvent):
+        """各阶段耗时分布、流量与失败原因 (仅管理员)"""
+        m = self.metrics
+        uptime = time.time() - m.started
+        stage_info = "\n".join(f"• {line}" for line in m.stage_lines()) or "• 暂无数据"
+        command_info = "\n".join(f"• {line}" for line in m.breakdown_lines("generate", 2)) or "• 暂无数据"
+        model_info = "\n".join(f"• {line}" for line in m.breakdown_lines("generate", 1)) or "• 暂无数据"
+        failures = Counter()
+        for (name, labels), value in m.counters.items():
+            if name == "gemini_input_failures_total":
+                failures[f"输入 {dict(labels)['cause']}"] += value
+            elif name == "gemini_upstream_outcomes_total" and dict(labels)["outcome"] != "ok":
+                outcome = dict(labels)["outcome"]
+                failures[RetryPolicy.OUTCOME_NAMES.get(outcome, outcome)] += value
+        failure_info = " | ".join(f"{k} {v:g}" for k, v in failures.most_common()) or "无"
+
+        info = (
+            f"📈 Gemini 绘图统计 (运行 {uptime / 3600:.1f} 小时)\n\n"
+            f"⏱️ 各阶段耗时：\n{stage_info}\n\n"
+            f"🧩 按命令：\n{command_info}\n\n"
+            f"🤖 按模型：\n{model_info}\n\n"
+            f"📦 流量: 发送 {m.counter_total('gemini_bytes_sent_total') / 1024 / 1024:.2f} MB | "
+            f"接收上游 {m.counter_total('gemini_bytes_received_total', source='upstream') / 1024:.1f} KB | "
+            f"下载图片 {m.counter_total('gemini_bytes_received_total', source='download') / 1024 / 1024:.2f} MB\n"
+            f"❌ 失败原因: {failure_info}"
+        )
+        input_lines = self.input_strategy.host_lines()
+        if input_lines:
+            info += "\n\n🖼️ 输入图片获取 (按域名)：\n" + "\n".join(f"• {line}" for line in input_lines)
+        if self.metrics_port:
+            info += f"\n📡 Prometheus: http://{self.metrics_host}:{self.metrics_port}/metrics"
+        yield event.plain_result(info)
+
+    # ---------------- 卡顿检测命令 ----------------
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("gemini卡顿")
+    async def show_loop_lag(self, event: AstrMessageEvent):
+        """事件循环卡顿最严重的阶段与代码位置 (仅管理员)"""
+        monitor = self.loop_monitor
+        if monitor is None:
+            yield event.plain_result("❌ 卡顿检测未开启 (配置 loop_monitor.enable)")
+            return
+        stage_info = "\n".join(f"• {line}" for line in monitor.stage_lines()) or "• 暂无卡顿"
+        worst_info = "\n".join(f"• {line}" for line in monitor.worst_lines()) or "• 暂无卡顿"
+        yield event.plain_result(
+            f"🐢 事件循环卡顿检测\n"
+            f"{monitor.summary()}\n\n"
+            f"📊 按阶段 (卡顿时正在进行的阶段)：\n{stage_info}\n\n"
+            f"🔝 最严重的卡顿：\n{worst_info}"
+        )
+
     async def terminate(self):
         """插件卸载时调用"""
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+        for task in list(self._background_tasks):
+            task.cancel()
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+        await self._close_sessions()
+        self.image_pool.shutdown()
         logger.info("Gemini图像生成插件已安全卸载")
\ No newline at end of file
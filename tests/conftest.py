@@ -0,0 +1,64 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+class FakeClock:
+    """可手动拨动的 time.monotonic，测试冷却/过期/熔断时间窗口用"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    return fake
+
+
+class FakeContext:
+    """插件上下文替身：记录主动推送的消息"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, umo, chain):
+        self.sent.append((umo, chain))
+        return True
+
+
+@pytest.fixture
+def run_plugin(tmp_path, monkeypatch):
+    """在事件循环里创建插件 (数据目录放在临时目录)，执行 scenario(plugin) 后卸载"""
+    monkeypatch.chdir(tmp_path)
+
+    def run(scenario, **config):
+        async def main_coro():
+            base = {
+                "api_url": "http://127.0.0.1:9/v1/chat/completions",
+                "apikey": "test-key",
+                "loop_monitor": {"enable": False},
+            }
+            base.update(config)
+            plugin = main.GeminiDraw(FakeContext(), base)
+            try:
+                return await scenario(plugin)
+            finally:
+                await plugin.terminate()
+
+        return asyncio.run(main_coro())
+
+    return run
@@ -0,0 +1,92 @@
+import pytest
+
+from main import AdmissionController, AdmissionRejected
+
+
+def test_grants_up_to_per_user_limit_then_queues():
+    admission = AdmissionController(max_concurrent=4, per_user=1, per_group=3)
+    first = admission.submit("u1", "g1")
+    second = admission.submit("u1", "g1")
+    assert first.granted and not second.granted
+    assert admission.running == 1 and admission.queued == 1
+
+    admission.release(first)
+    assert second.granted
+    assert admission.running == 1 and admission.queued == 0
+
+
+def test_global_queue_cap_rejects_waiting_requests():
+    admission = AdmissionController(max_concurrent=1, per_user=1, max_queue=2, max_queue_per_user=5)
+    admission.submit("u1", "g1")
+    admission.submit("u2", "g2")
+    admission.submit("u3", "g3")
+    with pytest.raises(AdmissionRejected):
+        admission.submit("u4", "g4")
+    assert admission.queued == 2
+    assert admission.stats["rejected"] == 1
+
+
+def test_per_user_queue_cap():
+    admission = AdmissionController(max_concurrent=8, per_user=1, max_queue=50, max_queue_per_user=1)
+    admission.submit("u1", "g1")
+    admission.submit("u1", "g1")
+    with pytest.raises(AdmissionRejected):
+        admission.submit("u1", "g1")
+    # 其他用户不受影响
+    assert admission.submit("u2", "g1").granted
+
+
+def test_request_that_can_start_is_not_blocked_by_full_queue():
+    admission = AdmissionController(max_concurrent=2, per_user=1, max_queue=1)
+    admission.submit("u1", "g1")
+    admission.submit("u1", "g1")  # 排队，队列已满
+    assert admission.submit("u2", "g2").granted
+
+
+def test_batch_user_limit_widens_personal_caps_only():
+    admission = AdmissionController(max_concurrent=8, per_user=1, per_group=2, max_queue_per_user=0)
+    tickets = [admission.submit("u1", "g1", user_limit=3) for _ in range(3)]
+    # 个人上限放宽到 3，但每群上限 2 照常生效；排队额度按放宽的部分增加
+    assert [t.granted for t in tickets] == [True, True, False]
+    assert not admission.submit("u1", "g1", user_limit=3).granted
+    with pytest.raises(AdmissionRejected):
+        admission.submit("u1", "g1", user_limit=3)
+
+
+def test_round_robin_between_groups():
+    admission = AdmissionController(max_concurrent=1, per_user=5, per_group=5, max_queue=10, max_queue_per_user=10)
+    running = admission.submit("a1", "big")
+    big = [admission.submit(f"a{i}", "big") for i in range(2, 5)]
+    small = admission.submit("b1", "small")
+    assert admission.position(small) == 2
+
+    admission.release(running)
+    assert big[0].granted
+    admission.release(big[0])
+    assert small.granted
+
+
+def test_release_of_queued_ticket_frees_its_slot():
+    admission = AdmissionController(max_concurrent=1, per_user=1, max_queue=1)
+    running = admission.submit("u1", "g1")
+    waiting = admission.submit("u2", "g2")
+    admission.release(waiting)  # 排队超时/取消
+    assert admission.queued == 0
+    admission.release(running)
+    assert admission.running == 0
+    assert admission.submit("u3", "g3").granted
+
+
+def test_bookkeeping_is_pruned_when_idle():
+    admission = AdmissionController(max_concurrent=1, per_user=1, max_queue=10, max_queue_per_user=10)
+    tickets = [admission.submit(f"u{i}", f"g{i}") for i in range(5)]
+    for ticket in tickets[::-1]:  # 先取消排队的，再结束运行中的
+        admission.release(ticket)
+    assert admission.running == 0 and admission.queued == 0
+    assert not admission._user_running and not admission._group_running
+    assert not admission._user_queued and not admission._queues and not admission._order
+
+    # 只是判断能否放行不应留下条目
+    assert admission.submit("u9", "g9").granted
+    admission.release(admission.submit("u9", "g9"))
+    assert set(admission._user_running) == {"u9"} and set(admission._group_running) == {"g9"}
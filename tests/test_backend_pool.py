@@ -0,0 +1,101 @@
+from main import BackendPool
+
+URLS = ["http://a.example/v1/chat/completions", "http://b.example/v1/chat/completions"]
+
+
+def fail(pool, backend, times):
+    for _ in range(times):
+        pool.acquire(backend)
+        pool.release(backend, False, 1.0, "timeout")
+
+
+def test_least_outstanding_spreads_requests(clock):
+    pool = BackendPool(URLS)
+    first = pool.pick()
+    pool.acquire(first)
+    second = pool.pick()
+    assert second is not first
+
+
+def test_consecutive_failures_eject_until_cooldown_ends(clock):
+    pool = BackendPool(URLS, eject_after=3, eject_seconds=30)
+    a, b = pool.backends
+    fail(pool, a, 2)
+    assert pool.is_available(a)
+    fail(pool, a, 1)
+    assert not pool.is_available(a)
+    assert all(pool.pick() is b for _ in range(3))
+
+    clock.advance(30)
+    assert pool.is_available(a)
+    assert a.consecutive_failures == 0
+
+
+def test_success_resets_failure_streak(clock):
+    pool = BackendPool(URLS, eject_after=3)
+    a = pool.backends[0]
+    fail(pool, a, 2)
+    pool.acquire(a)
+    pool.release(a, True, 2.0)
+    fail(pool, a, 2)
+    assert pool.is_available(a)
+
+
+def test_repeated_ejection_backs_off_and_recovery_resets_it(clock):
+    pool = BackendPool(URLS, eject_after=1, eject_seconds=30)
+    a = pool.backends[0]
+    fail(pool, a, 1)
+    clock.advance(30)
+    fail(pool, a, 1)  # 刚恢复又失败：冷却翻倍
+    clock.advance(30)
+    assert not pool.is_available(a)
+    clock.advance(30)
+    assert pool.is_available(a)
+
+    pool.acquire(a)
+    pool.release(a, True, 1.0)
+    fail(pool, a, 1)
+    assert a.ejected_until - clock.now == 30
+
+
+def test_cancelled_request_is_not_a_failure(clock):
+    pool = BackendPool(URLS, eject_after=1)
+    a = pool.backends[0]
+    pool.acquire(a)
+    pool.release(a, None, 0.0)
+    assert a.outstanding == 0 and a.errors == 0 and pool.is_available(a)
+
+
+def test_all_unavailable_picks_earliest_recovery(clock):
+    pool = BackendPool(URLS, eject_after=1, eject_seconds=30)
+    a, b = pool.backends
+    fail(pool, a, 1)
+    clock.advance(10)
+    fail(pool, b, 1)
+    assert pool.pick() is a
+
+    pool.mark_health(a, False, "connection refused")
+    assert pool.pick() is b  # 健康检查失败的排在被摘除的后面
+    clock.advance(40)
+    assert pool.pick() is b
+    pool.mark_health(a, True)
+    assert pool.is_available(a)
+
+
+def test_pick_excludes_backend_already_tried(clock):
+    pool = BackendPool(URLS)
+    a, b = pool.backends
+    assert pool.pick(exclude=(a,)) is b
+    assert pool.pick(exclude=(a, b)) in (a, b)  # 都试过时仍要返回一个
+
+
+def test_latency_strategy_prefers_faster_backend(clock):
+    pool = BackendPool(URLS, strategy="latency")
+    a, b = pool.backends
+    for backend, latency in ((a, 10.0), (b, 2.0)):
+        pool.acquire(backend)
+        pool.release(backend, True, latency)
+    assert pool.pick() is b
+    for _ in range(5):
+        pool.acquire(b)
+    assert pool.pick() is a  # 在途请求多了，加权后慢的反而更合适
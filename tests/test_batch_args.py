@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def parse():
+    plugin = SimpleNamespace(batch_max_count=4, available_models=["model-a", "model-b", "model-c"],
+                             current_model="model-a")
+    return lambda text: main.GeminiDraw._parse_batch_args(plugin, text)
+
+
+def test_count_flag_after_bare_count_is_rejected(parse):
+    count, _, prompt, error = parse("3 -n 2 猫")
+    assert error and not prompt
+
+
+@pytest.mark.parametrize("text", ["-n", "-n 0 猫", "-n x 猫", "--count -1 猫"])
+def test_invalid_count_flag(parse, text):
+    assert parse(text)[3]
+
+
+def test_defaults_to_one_image_with_current_model(parse):
+    assert parse("一只猫") == (1, ["model-a"], "一只猫", "")
+
+
+def test_bare_count_within_limit(parse):
+    assert parse("3 一只猫") == (3, ["model-a"], "一只猫", "")
+
+
+def test_number_outside_limit_belongs_to_prompt(parse):
+    assert parse("2024 新年") == (1, ["model-a"], "2024 新年", "")
+    assert parse("0 猫")[2] == "0 猫"
+
+
+def test_count_flag_lets_prompt_start_with_number(parse):
+    assert parse("-n 2 2024 新年") == (2, ["model-a"], "2024 新年", "")
+    assert parse("--count 3 3 只猫")[:3] == (3, ["model-a"], "3 只猫")
+
+
+def test_models_by_index_and_name_are_deduplicated(parse):
+    count, models, prompt, error = parse("2 -m 1,model-c,3, 猫")
+    assert (count, models, prompt, error) == (2, ["model-a", "model-c"], "猫", "")
+
+
+def test_options_in_any_order(parse):
+    assert parse("-m 2 -n 2 猫") == (2, ["model-b"], "猫", "")
+    assert parse("-m 2 --model 3 猫")[1] == ["model-b", "model-c"]
+
+
+def test_unknown_model_index_is_rejected(parse):
+    assert "不存在" in parse("-m 9 猫")[3]
+
+
+def test_options_after_prompt_are_prompt_text(parse):
+    assert parse("猫 -n 2") == (1, ["model-a"], "猫 -n 2", "")
@@ -0,0 +1,133 @@
+from main import CircuitBreaker, CircuitBreakerBoard
+
+
+def tripped(clock, **params) -> CircuitBreaker:
+    """连续失败直到打开的熔断器"""
+    breaker = CircuitBreaker("后端 test", min_requests=2, error_rate=0.5, open_seconds=10, **params)
+    for _ in range(2):
+        breaker.record(True, probe=breaker.allow())
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def test_closed_passes_without_probe_ticket(clock):
+    breaker = CircuitBreaker("x")
+    assert breaker.allow() == 0
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_on_error_rate_and_rejects(clock):
+    breaker = tripped(clock)
+    assert breaker.allow() is None
+    assert breaker.rejected == 1
+    assert breaker.retry_after() == 10
+
+
+def test_opens_on_timeout_rate(clock):
+    breaker = CircuitBreaker("x", min_requests=4, error_rate=1.0, timeout_rate=0.5)
+    for timed_out in (False, False, True, True):
+        breaker.record(timed_out, timed_out)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert "超时率" in breaker.last_reason
+
+
+def test_neutral_outcomes_do_not_count(clock):
+    breaker = CircuitBreaker("x", min_requests=2)
+    for _ in range(5):
+        breaker.record(None)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not breaker.events
+
+
+def test_old_failures_leave_the_window(clock):
+    breaker = CircuitBreaker("x", window=60, min_requests=3)
+    breaker.record(True)
+    breaker.record(True)
+    clock.advance(61)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert len(breaker.events) == 1
+
+
+def test_half_open_admits_limited_probes(clock):
+    breaker = tripped(clock, probes=1)
+    clock.advance(10)
+    probe = breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN and probe > 0
+    assert breaker.allow() is None
+
+    breaker.record(False, probe=probe)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_with_longer_cooldown(clock):
+    breaker = tripped(clock)
+    clock.advance(10)
+    breaker.record(True, probe=breaker.allow())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_after() == 20
+
+
+def test_request_started_while_closed_does_not_settle_half_open(clock):
+    breaker = CircuitBreaker("x", min_requests=2, open_seconds=10)
+    slow = breaker.allow()  # 熔断前发出的慢请求
+    breaker.record(True)
+    breaker.record(True)
+    clock.advance(10)
+    probe = breaker.allow()
+
+    breaker.record(True, probe=slow)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.probing == 1
+
+    breaker.record(False, probe=probe)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_probe_from_previous_round_is_ignored(clock):
+    breaker = tripped(clock, probes=2)
+    clock.advance(10)
+    stale = breaker.allow()
+    breaker.record(True, probe=breaker.allow())  # 同一轮的另一个探测失败，重新打开
+    clock.advance(20)
+    current = breaker.allow()
+    assert current != stale
+
+    breaker.release(stale)
+    breaker.record(False, probe=stale)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.probing == 1 and breaker.probe_successes == 0
+
+    breaker.record(False, probe=current)
+    breaker.record(False, probe=breaker.allow())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_release_returns_probe_slot(clock):
+    breaker = tripped(clock)
+    clock.advance(10)
+    probe = breaker.allow()
+    breaker.release(probe)
+    assert breaker.probing == 0
+    assert breaker.allow() == probe
+
+
+def test_neutral_probe_result_returns_slot(clock):
+    breaker = tripped(clock)
+    clock.advance(10)
+    breaker.record(None, probe=breaker.allow())
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() is not None
+
+
+def test_board_maps_outcomes_and_can_be_disabled(clock):
+    board = CircuitBreakerBoard(min_requests=2, open_seconds=10)
+    for outcome in ("rate_limited", "client_error", "server_error", "timeout"):
+        board.record("模型 m", outcome, board.allow("模型 m"))
+    assert not board.available("模型 m")
+
+    disabled = CircuitBreakerBoard(enabled=False)
+    for _ in range(10):
+        disabled.record("模型 m", "server_error", disabled.allow("模型 m"))
+    assert disabled.allow("模型 m") == 0
+    assert disabled.summary_lines() == ["❌ 禁用"]
@@ -0,0 +1,76 @@
+import asyncio
+
+from main import EncodedImage
+
+
+def gated_upstream(plugin):
+    """替换上游调用：记录调用次数，直到 gate 放行才返回"""
+    calls = []
+    gate = asyncio.Event()
+
+    async def generate(prompt, image=None, is_image_to_image=False, event=None, model=None, deadline=None):
+        calls.append(prompt)
+        await gate.wait()
+        return True, f"https://cdn.example.com/{len(calls)}.png"
+
+    plugin._generate_image_admitted = generate
+    return calls, gate
+
+
+def test_identical_requests_share_one_call(run_plugin):
+    async def scenario(plugin):
+        calls, gate = gated_upstream(plugin)
+        waiters = [asyncio.create_task(plugin._generate_image_coalesced("文", "cat")) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.gather(*waiters)
+        assert calls == ["cat"]
+        assert results == [(True, "https://cdn.example.com/1.png")] * 3
+        assert plugin.coalesce_stats == {"leader": 1, "joined": 2}
+        assert not plugin._inflight
+
+        # 完成后再来的相同请求重新调用上游
+        await plugin._generate_image_coalesced("文", "cat")
+        assert calls == ["cat", "cat"]
+
+    run_plugin(scenario, coalesce_commands=["文"])
+
+
+def test_different_prompts_and_images_are_not_merged(run_plugin):
+    async def scenario(plugin):
+        calls, gate = gated_upstream(plugin)
+        gate.set()
+        await asyncio.gather(
+            plugin._generate_image_coalesced("文", "cat"),
+            plugin._generate_image_coalesced("文", "dog"),
+            plugin._generate_image_coalesced("图", "cat", EncodedImage(b"a"), True),
+            plugin._generate_image_coalesced("图", "cat", EncodedImage(b"b"), True),
+        )
+        assert len(calls) == 4
+
+    run_plugin(scenario, coalesce_commands=["文", "图"])
+
+
+def test_commands_outside_the_list_are_not_merged(run_plugin):
+    async def scenario(plugin):
+        calls, gate = gated_upstream(plugin)
+        gate.set()
+        await asyncio.gather(*(plugin._generate_image_coalesced("文", "cat") for _ in range(2)))
+        assert len(calls) == 2 and plugin.coalesce_stats["joined"] == 0
+
+    run_plugin(scenario, coalesce_commands=["快捷指令"])
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call(run_plugin):
+    async def scenario(plugin):
+        calls, gate = gated_upstream(plugin)
+        leader = asyncio.create_task(plugin._generate_image_coalesced("文", "cat"))
+        follower = asyncio.create_task(plugin._generate_image_coalesced("文", "cat"))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        assert await follower == (True, "https://cdn.example.com/1.png")
+        assert calls == ["cat"]
+
+    run_plugin(scenario, coalesce_commands=["文"])
@@ -0,0 +1,26 @@
+import base64
+
+import pytest
+
+from main import EncodedImage, InputFailure
+
+
+def test_data_url_round_trip():
+    raw = b"\x89PNG fake bytes"
+    image = EncodedImage.from_data_url("data:image/png;base64," + base64.b64encode(raw).decode())
+    assert image.data == raw and image.format == "png"
+    assert EncodedImage.from_data_url(image.data_url).data == raw
+
+
+def test_malformed_base64_raises_value_error():
+    with pytest.raises(ValueError):
+        EncodedImage.from_data_url("data:image/jpeg;base64,abc")
+
+
+def test_malformed_data_url_is_reported_as_failure(run_plugin):
+    async def scenario(plugin):
+        image, error, reason = await plugin._process_image_url("data:image/jpeg;base64,abc")
+        assert image is None
+        assert reason == InputFailure.INVALID and error
+
+    run_plugin(scenario)
@@ -0,0 +1,86 @@
+import asyncio
+
+from main import HedgePolicy
+
+
+def slow_generate(calls):
+    async def generate(prompt, image=None, is_image_to_image=False, model=None, deadline=None):
+        calls.append(model)
+        await asyncio.sleep(0.2 if len(calls) == 1 else 0.01)
+        return True, f"https://cdn.example.com/{len(calls)}.png"
+    return generate
+
+
+def prepare(plugin, calls):
+    plugin._generate_image = slow_generate(calls)
+    plugin.hedge.initial_delay = 0.02
+    plugin.hedge.tokens = plugin.hedge.max_tokens
+
+
+def test_hedge_takes_its_own_admission_slot(run_plugin):
+    async def scenario(plugin):
+        calls = []
+        prepare(plugin, calls)
+        ok, _ = await plugin._generate_image_admitted("cat")
+        assert ok and len(calls) == 2
+        assert plugin.hedge.stats["hedged"] == 1
+        assert plugin.admission.running == 0
+
+    run_plugin(scenario, hedge={"enable": True}, admission={"max_concurrent": 2})
+
+
+def test_hedge_is_skipped_when_no_slot_is_free(run_plugin):
+    async def scenario(plugin):
+        calls = []
+        prepare(plugin, calls)
+        ok, _ = await plugin._generate_image_admitted("cat")
+        assert ok and len(calls) == 1
+        assert plugin.hedge.stats["admission_denied"] == 1
+        assert plugin.hedge.tokens == plugin.hedge.max_tokens  # 没拿到名额不消耗对冲预算
+
+    run_plugin(scenario, hedge={"enable": True}, admission={"max_concurrent": 1})
+
+
+def test_delay_uses_initial_value_until_enough_samples(clock):
+    hedge = HedgePolicy(initial_delay=30, min_samples=20)
+    for _ in range(19):
+        hedge.latency.observe(12)
+    assert hedge.delay() == 30
+    hedge.latency.observe(12)
+    assert hedge.delay() == 12
+
+
+def test_delay_follows_percentile_with_floor(clock):
+    hedge = HedgePolicy(percentile=0.9, min_delay=5, min_samples=10)
+    for _ in range(10):
+        hedge.latency.observe(0.3)
+    assert hedge.delay() == 5
+    for _ in range(90):
+        hedge.latency.observe(18)
+    assert hedge.delay() == 18
+
+
+def test_old_samples_expire(clock):
+    hedge = HedgePolicy(initial_delay=30, min_samples=5)
+    for _ in range(5):
+        hedge.latency.observe(12)
+    clock.advance(hedge.latency.window * 2)
+    assert hedge.delay() == 30
+
+
+def test_budget_limits_extra_requests():
+    hedge = HedgePolicy(budget_percent=25)
+    for _ in range(3):
+        hedge.on_request()
+    assert not hedge.try_spend()
+    hedge.on_request()
+    assert hedge.try_spend()
+    assert not hedge.try_spend()
+    assert hedge.stats["hedged"] == 1 and hedge.stats["budget_denied"] == 2
+
+
+def test_budget_tokens_are_capped():
+    hedge = HedgePolicy(budget_percent=100)
+    for _ in range(20):
+        hedge.on_request()
+    assert sum(hedge.try_spend() for _ in range(10)) == hedge.max_tokens
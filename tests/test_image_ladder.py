@@ -0,0 +1,67 @@
+import io
+import random
+
+import pytest
+
+PyImage = pytest.importorskip("PIL.Image")
+
+from main import _pil_encode_ladder, _pil_fit_budget
+
+SCALES = [1.0, 0.85, 0.7, 0.55, 0.4, 0.3, 0.2]
+
+
+def noisy_image(width=400, height=300):
+    # 随机像素几乎不可压缩，预算能明显区分不同的缩放/质量
+    return PyImage.frombytes("RGB", (width, height), random.Random(0).randbytes(width * height * 3))
+
+
+def encode(img, fmt="JPEG", quality=95) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=quality)
+    return buf.getvalue()
+
+
+def test_fit_budget_prefers_full_size():
+    img = noisy_image()
+    data, size, quality, scale = _pil_fit_budget(img, 10 ** 7, SCALES, 55, 90)
+    assert scale == 1.0 and size == img.size
+    assert quality >= 85
+
+
+def test_fit_budget_stays_within_budget():
+    img = noisy_image()
+    budget = len(encode(img, quality=55)) // 3
+    data, size, quality, scale = _pil_fit_budget(img, budget, SCALES, 55, 90)
+    assert len(data) <= budget
+    assert scale < 1.0 and size[0] < img.width
+
+
+def test_fit_budget_returns_smallest_when_nothing_fits():
+    img = noisy_image()
+    data, size, quality, scale = _pil_fit_budget(img, 10, SCALES, 55, 90)
+    assert scale == SCALES[-1] and quality == 55
+    assert size == (int(img.width * 0.2), int(img.height * 0.2))
+
+
+def test_ladder_reuses_small_jpeg_bytes():
+    raw = encode(noisy_image())
+    ladder = _pil_encode_ladder(raw, [len(raw) + 1, len(raw) // 4])
+    assert ladder[0] == (raw, (400, 300), 0)
+    assert len(ladder[1][0]) <= len(raw) // 4
+
+
+def test_ladder_re_encodes_png_and_shrinks_per_step():
+    raw = encode(noisy_image(), fmt="PNG")
+    budgets = [len(raw), len(raw) // 4, len(raw) // 16]
+    ladder = _pil_encode_ladder(raw, budgets)
+    assert all(quality > 0 for _, _, quality in ladder)
+    for (data, _, _), budget in zip(ladder, budgets):
+        assert len(data) <= budget
+    widths = [size[0] for _, size, _ in ladder]
+    assert widths == sorted(widths, reverse=True)
+
+
+def test_ladder_downscales_to_max_size():
+    raw = encode(noisy_image(800, 600))
+    data, size, quality = _pil_encode_ladder(raw, [10 ** 7], max_size=400)[0]
+    assert max(size) <= 400 and quality > 0
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import main
+from main import EncodedImage, InputFailure, InputStrategy
+
+URL = "https://cdn.example.com/a.png"
+
+
+@pytest.mark.parametrize("policy, expected", [
+    ("local", ("local",)),
+    ("remote", ("remote",)),
+    ("sequential", ("local", "remote")),
+    ("race", ("race",)),
+    ("bogus", ("local", "remote")),
+])
+def test_fixed_policies(policy, expected):
+    assert InputStrategy(policy).plan("h") == expected
+
+
+def test_unavailable_path_overrides_policy():
+    strategy = InputStrategy("race")
+    assert strategy.plan("h", local_ok=False) == ("remote",)
+    assert strategy.plan("h", remote_ok=False) == ("local",)
+    assert strategy.plans == {"remote": 1, "local": 1}
+
+
+def test_auto_races_until_enough_samples_then_prefers_winner(monkeypatch):
+    monkeypatch.setattr(main.random, "random", lambda: 0.99)
+    strategy = InputStrategy("auto", min_samples=5, explore_percent=10)
+    for _ in range(5):
+        assert strategy.plan("h") == ("race",)
+        strategy.record("h", "local", True, 0.1)
+        strategy.record_race("h", "local")
+    assert strategy.plan("h") == ("local", "remote")
+    assert strategy.plan("other") == ("race",)  # 统计按域名分开
+
+    monkeypatch.setattr(main.random, "random", lambda: 0.0)
+    assert strategy.plan("h") == ("race",)  # 定期探测
+
+
+def test_auto_keeps_racing_when_winner_is_unreliable(monkeypatch):
+    monkeypatch.setattr(main.random, "random", lambda: 0.99)
+    strategy = InputStrategy("auto", min_samples=3)
+    for _ in range(5):
+        strategy.record("h", "remote", False, 1.0)
+        strategy.record("h", "remote", True, 0.1)
+        strategy.record_race("h", "remote")
+    assert strategy.plan("h") == ("race",)
+
+
+def test_host_stats_are_bounded():
+    strategy = InputStrategy(max_hosts=2)
+    for host in ("a", "b", "a", "c"):
+        strategy.record(host, "local", True, 0.1)
+    assert {host for host, _, _ in strategy.iter_stats()} == {"a", "c"}
+    assert InputStrategy.host_of("https://CDN.Example.com:8443/x.png") == "cdn.example.com"
+
+
+def fake_paths(plugin, local, remote):
+    """替换两条获取路径，返回各自的调用记录"""
+    calls = []
+
+    async def acquire_local(url, model=None):
+        calls.append("local")
+        await asyncio.sleep(0.01)
+        return local
+
+    async def acquire_remote(url):
+        calls.append("remote")
+        await asyncio.sleep(0.02)
+        return remote
+
+    plugin._acquire_input_local = acquire_local
+    plugin._convert_url_via_api_to_image = acquire_remote
+    return calls
+
+
+IMAGE = EncodedImage(b"jpeg", 1, 1)
+REMOTE_OK = (IMAGE, "", "")
+
+
+def test_sequential_falls_back_only_after_decode_failure(run_plugin):
+    async def scenario(plugin):
+        calls = fake_paths(plugin, (None, "下载失败: 404", InputFailure.DOWNLOAD), REMOTE_OK)
+        assert await plugin._process_image_url(URL) == (None, "下载失败: 404", InputFailure.DOWNLOAD)
+        assert calls == ["local"]
+
+        calls = fake_paths(plugin, (None, "图片处理失败: bad", InputFailure.DECODE), REMOTE_OK)
+        assert await plugin._process_image_url(URL) == REMOTE_OK
+        assert calls == ["local", "remote"]
+
+    run_plugin(scenario, image_cache={"enable": False})
+
+
+def test_sequential_keeps_local_reason_when_remote_has_no_message(run_plugin):
+    async def scenario(plugin):
+        fake_paths(plugin, (None, "图片处理失败: bad", InputFailure.DECODE), (None, "", InputFailure.CONVERT))
+        assert await plugin._process_image_url(URL) == (None, "图片处理失败: bad", InputFailure.DECODE)
+
+    run_plugin(scenario, image_cache={"enable": False})
+
+
+def test_race_stops_on_too_large(run_plugin):
+    async def scenario(plugin):
+        failure = (None, "图片过大 (超过 1 MB 上限)", InputFailure.TOO_LARGE)
+        calls = fake_paths(plugin, failure, REMOTE_OK)
+        assert await plugin._process_image_url(URL) == failure
+        assert sorted(calls) == ["local", "remote"]
+
+        fake_paths(plugin, (None, "下载失败: 404", InputFailure.DOWNLOAD), REMOTE_OK)
+        assert await plugin._process_image_url(URL) == REMOTE_OK
+        stats = {path: stats for _, path, stats in plugin.input_strategy.iter_stats()}
+        assert stats["remote"].wins == 1 and stats["local"].wins == 0
+
+    run_plugin(scenario, image_cache={"enable": False}, input_strategy={"policy": "race"})
@@ -0,0 +1,128 @@
+import sqlite3
+import time
+
+import pytest
+
+from main import JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs.db", max_attempts=2)
+
+
+def add(store: JobStore, job_id: str, user: str = "u1", created_at: float = None):
+    store.add({
+        "id": job_id, "status": "queued", "command": "文", "prompt": f"prompt {job_id}", "umo": "umo",
+        "user": user, "grp": "g1", "created_at": created_at if created_at is not None else time.time(),
+        "image": b"jpeg",
+    })
+
+
+def test_claim_in_submission_order(store):
+    add(store, "b", created_at=2)
+    add(store, "a", created_at=1)
+    job = store.claim()
+    assert job["id"] == "a"
+    assert store.get("a")["status"] == "running"
+    assert store.get("a")["attempts"] == 1
+    assert store.claim()["id"] == "b"
+    assert store.claim() is None
+
+
+def test_claim_skips_busy_users(store):
+    add(store, "a", user="u1", created_at=1)
+    add(store, "b", user="u2", created_at=2)
+    assert store.claim(exclude_users=["u1"])["id"] == "b"
+    assert store.claim(exclude_users=["u1", "u2"]) is None
+
+
+def test_pending_counts_and_position(store):
+    add(store, "a", user="u1", created_at=1)
+    add(store, "b", user="u2", created_at=2)
+    add(store, "c", user="u1", created_at=3)
+    store.claim()
+    assert store.pending_counts("u1") == (3, 2)
+    assert store.position(3) == 1
+
+
+def test_recover_requeues_and_gives_up_after_max_attempts(store):
+    add(store, "a", created_at=1)
+    add(store, "b", created_at=2)
+    store.claim()
+    assert store.recover() == (1, 0)
+    assert store.get("a")["status"] == "queued"
+
+    store.claim()  # a 第二次执行
+    store.claim()  # b 第一次执行
+    assert store.recover() == (1, 1)
+    failed = store.get("a")
+    assert failed["status"] == "failed" and failed["error"]
+    assert store.get("b")["status"] == "queued"
+
+
+def test_finish_drops_input_image(store, tmp_path):
+    add(store, "a")
+    store.claim()
+    store.finish("a", "done", "https://cdn.example.com/a.png")
+    with sqlite3.connect(tmp_path / "jobs.db") as conn:
+        assert conn.execute("SELECT image FROM jobs WHERE id = 'a'").fetchone()[0] is None
+    assert store.get("a")["result"] == "https://cdn.example.com/a.png"
+
+
+def test_delivery_is_claimed_once(store):
+    add(store, "a")
+    store.claim()
+    store.finish("a", "done", "url")
+    assert [job["id"] for job in store.undelivered()] == ["a"]
+
+    assert store.claim_delivery("a")
+    assert not store.claim_delivery("a")
+    assert store.undelivered() == []
+
+    store.mark_delivered("a", False)  # 推送失败：释放占用，留给补投
+    assert [job["id"] for job in store.undelivered()] == ["a"]
+    assert store.claim_delivery("a")
+    store.mark_delivered("a", True)
+    assert store.undelivered() == []
+    assert not store.claim_delivery("a")
+
+
+def test_recover_releases_interrupted_delivery(store):
+    add(store, "a")
+    store.claim()
+    store.finish("a", "failed", "", "boom")
+    store.claim_delivery("a")
+    store.recover()
+    assert [job["id"] for job in store.undelivered()] == ["a"]
+
+
+def test_delivery_gives_up_after_max_attempts(store):
+    add(store, "a")
+    store.claim()
+    store.finish("a", "done", "url")
+    for _ in range(JobStore.MAX_DELIVER_ATTEMPTS):
+        store.claim_delivery("a")
+        store.mark_delivered("a", False)
+    assert store.undelivered() == []
+
+
+def test_cancel_only_queued(store):
+    add(store, "a", created_at=1)
+    add(store, "b", created_at=2)
+    store.claim()
+    assert not store.cancel("a")
+    assert store.cancel("b")
+    assert store.get("b")["status"] == "cancelled"
+    assert store.counts() == {"running": 1, "cancelled": 1}
+
+
+def test_prune_removes_only_expired_finished_jobs(tmp_path):
+    store = JobStore(tmp_path / "jobs.db", keep_hours=0)
+    add(store, "a", created_at=1)
+    add(store, "b", created_at=2)
+    store.claim()
+    store.finish("a", "done", "url")
+    time.sleep(0.01)
+    assert store.prune() == 1
+    assert store.get("a") is None and store.get("b") is not None
@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+import time
+
+
+def add_job(store, job_id: str, created_at: float):
+    store.add({
+        "id": job_id, "status": "queued", "command": "文", "prompt": f"prompt {job_id}", "umo": "umo",
+        "user": "u1", "grp": "g1", "created_at": created_at,
+    })
+
+
+async def wait_for_status(store, job_id: str, status: str, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job and job["status"] == status:
+            return job
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"任务 {job_id} 没有变成 {status}: {store.get(job_id)}")
+
+
+async def fake_generate(*_args, **_kwargs):
+    return True, "https://cdn.example.com/out.png"
+
+
+def test_worker_keeps_running_when_execution_fails(run_plugin):
+    async def scenario(plugin):
+        store = plugin.job_store
+        plugin._generate_image_shared = fake_generate
+        execute = plugin._execute_job
+
+        async def flaky_execute(job):
+            if job["id"] == "a":
+                raise RuntimeError("boom")
+            await execute(job)
+
+        plugin._execute_job = flaky_execute
+        add_job(store, "a", 1)
+        add_job(store, "b", 2)
+        plugin._job_wakeup.set()
+
+        failed = await wait_for_status(store, "a", "failed")
+        assert "boom" in failed["error"]
+        await wait_for_status(store, "b", "done")
+
+    run_plugin(scenario, jobs={"enable": True, "workers": 1})
+
+
+def test_store_error_on_finish_still_delivers_and_continues(run_plugin):
+    async def scenario(plugin):
+        store = plugin.job_store
+        plugin._generate_image_shared = fake_generate
+        finish = store.finish
+
+        def locked_finish(job_id, *args, **kwargs):
+            if job_id == "a":
+                raise sqlite3.OperationalError("database is locked")
+            return finish(job_id, *args, **kwargs)
+
+        store.finish = locked_finish
+        add_job(store, "a", 1)
+        add_job(store, "b", 2)
+        plugin._job_wakeup.set()
+
+        await wait_for_status(store, "b", "done")
+        assert store.get("a")["status"] == "running"  # 重启后由 recover 处理
+        assert len(plugin.context.sent) == 2
+
+    run_plugin(scenario, jobs={"enable": True, "workers": 1})
@@ -0,0 +1,67 @@
+import pytest
+
+from main import KeyPool, _parse_retry_after
+
+
+def test_zero_cooldown_is_clamped(clock):
+    pool = KeyPool(["key-a"])
+    api_key, _ = pool.acquire()
+    pool.throttle(api_key, 0)
+    assert pool.acquire() == (None, KeyPool.MIN_COOLDOWN)
+    assert not pool.has_available()
+
+    clock.advance(KeyPool.MIN_COOLDOWN)
+    assert pool.acquire()[0] is api_key
+
+
+def test_cooling_key_is_skipped(clock):
+    pool = KeyPool(["key-a", "key-b"])
+    first, _ = pool.acquire()
+    pool.throttle(first, 30)
+    for _ in range(3):
+        other, wait = pool.acquire()
+        assert other is not first and wait == 0
+
+    clock.advance(30)
+    assert pool.has_available()
+    # 冷却结束后重新参与调度，按请求数最少优先
+    assert pool.acquire()[0] is first
+
+
+def test_all_keys_cooling_reports_shortest_wait(clock):
+    pool = KeyPool(["key-a", "key-b"])
+    pool.throttle(pool.keys[0], 10)
+    pool.throttle(pool.keys[1], 4)
+    api_key, wait = pool.acquire()
+    assert api_key is None
+    assert wait == pytest.approx(4)
+
+
+def test_token_bucket_rate_limit(clock):
+    pool = KeyPool(["key-a"], rate_per_minute=60, burst=1)
+    assert pool.acquire()[0] is not None
+    api_key, wait = pool.acquire()
+    assert api_key is None
+    assert wait == pytest.approx(1)
+
+    clock.advance(1)
+    assert pool.acquire()[0] is not None
+
+
+def test_throttle_drains_tokens(clock):
+    pool = KeyPool(["key-a"], rate_per_minute=60, burst=5)
+    api_key, _ = pool.acquire()
+    pool.throttle(api_key, 2)
+    clock.advance(2)
+    # 冷却结束后令牌从 0 开始按速率恢复
+    assert pool.acquire()[0] is not None
+    assert api_key.tokens == pytest.approx(1)
+
+
+@pytest.mark.parametrize("value, expected", [("0", 0.0), ("12", 12.0), ("", None), ("soon", None)])
+def test_parse_retry_after_seconds(value, expected):
+    assert _parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_past_date_is_zero():
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
@@ -0,0 +1,65 @@
+from main import LRUCache
+
+
+def test_byte_accounting_on_put_replace_and_pop():
+    cache = LRUCache(max_bytes=100, ttl=0)
+    cache.put("a", "A", 30)
+    cache.put("b", "B", 20)
+    assert cache.total_bytes == 50
+
+    cache.put("a", "A2", 10)  # 覆盖同一个键按新大小计
+    assert cache.total_bytes == 30
+    assert cache.get("a") == "A2"
+
+    assert cache.pop("b") == "B"
+    assert cache.pop("missing") is None
+    assert cache.total_bytes == 10 and len(cache) == 1
+
+
+def test_evicts_least_recently_used_until_under_limit():
+    cache = LRUCache(max_bytes=100, ttl=0)
+    cache.put("a", 1, 40)
+    cache.put("b", 2, 40)
+    cache.get("a")  # a 变成最近使用
+    cache.put("c", 3, 40)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.total_bytes == 80
+    assert cache.evictions == 1
+
+
+def test_oversized_entry_is_not_cached():
+    cache = LRUCache(max_bytes=100, ttl=0)
+    cache.put("a", 1, 60)
+    cache.put("huge", 2, 101)
+    assert cache.get("huge") is None
+    assert cache.total_bytes == 60 and cache.evictions == 0
+
+
+def test_max_items():
+    cache = LRUCache(max_bytes=1000, ttl=0, max_items=2)
+    for key in "abc":
+        cache.put(key, key, 1)
+    assert len(cache) == 2 and cache.get("a") is None
+    assert cache.total_bytes == 2
+
+
+def test_ttl_expiry_releases_bytes(clock):
+    cache = LRUCache(max_bytes=100, ttl=10)
+    cache.put("a", 1, 30)
+    clock.advance(9)
+    assert cache.get("a") == 1
+    clock.advance(2)
+    assert cache.get("a") is None
+    assert cache.total_bytes == 0
+    assert cache.expirations == 1
+
+
+def test_hit_ratio_and_clear():
+    cache = LRUCache(max_bytes=100, ttl=0)
+    cache.put("a", 1, 10)
+    cache.get("a")
+    cache.get("b")
+    assert cache.hit_ratio() == 0.5
+    cache.clear()
+    assert len(cache) == 0 and cache.total_bytes == 0
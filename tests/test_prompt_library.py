@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import main
+from main import PromptEntry, PromptLibrary
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_text(data if isinstance(data, str) else json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    return path
+
+
+def test_json_list_with_all_fields(tmp_path):
+    path = write(tmp_path, "prompts.json", [
+        {"name": "手办", "prompt": "做成手办", "aliases": ["figure", "手办"], "category": "风格",
+         "model": "model-b", "image": "Required"},
+        {"name": "海报", "prompt": "做成海报", "aliases": "poster|宣传"},
+    ])
+    figure, poster = PromptLibrary.parse_file(path)
+    assert (figure.name, figure.prompt, figure.aliases) == ("手办", "做成手办", ("figure",))
+    assert (figure.category, figure.model, figure.image) == ("风格", "model-b", "required")
+    assert poster.aliases == ("poster", "宣传") and poster.category == "未分类" and poster.image == "optional"
+
+
+def test_prompts_key_and_dict_forms(tmp_path):
+    wrapped = write(tmp_path, "a.json", {"prompts": [{"name": "a", "prompt": "x"}]})
+    assert [e.name for e in PromptLibrary.parse_file(wrapped)] == ["a"]
+
+    mapping = write(tmp_path, "b.json", {"a": "x", "b": {"prompt": "y", "image": "none"}, "3": "z"})
+    entries = PromptLibrary.parse_file(mapping)
+    assert [(e.name, e.prompt, e.image) for e in entries] == [("a", "x", "optional"), ("b", "y", "none"),
+                                                             ("3", "z", "optional")]
+
+
+def test_yaml_file(tmp_path):
+    pytest.importorskip("yaml")
+    path = write(tmp_path, "prompts.yml", "- name: 新指令\n  prompt: xx\n  image: bogus\n")
+    [entry] = PromptLibrary.parse_file(path)
+    assert (entry.name, entry.prompt, entry.image) == ("新指令", "xx", "optional")
+
+
+def test_yaml_without_pyyaml_is_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "yaml", None)
+    with pytest.raises(RuntimeError):
+        PromptLibrary.parse_file(write(tmp_path, "prompts.yaml", "a: x\n"))
+
+
+def test_empty_file_has_no_entries(tmp_path):
+    assert PromptLibrary.parse_file(write(tmp_path, "empty.json", "null")) == []
+
+
+@pytest.mark.parametrize("data", [
+    ["just a string"],
+    [{"name": "a"}],
+    {"a": {"aliases": ["b"]}},
+    "42",
+])
+def test_malformed_entries_are_rejected(tmp_path, data):
+    with pytest.raises(ValueError):
+        PromptLibrary.parse_file(write(tmp_path, "bad.json", data))
+
+
+def test_invalid_json_raises_value_error(tmp_path):
+    with pytest.raises(ValueError):
+        PromptLibrary.parse_file(write(tmp_path, "bad.json", "[{"))
+
+
+def test_later_entries_override_earlier_ones():
+    library = PromptLibrary([
+        PromptEntry("a", "old", ["x"]),
+        PromptEntry("b", "b", ["a2"], category="风格"),
+        PromptEntry("a", "new", ["b"]),
+    ])
+    assert len(library) == 2 and library.get("a").prompt == "new"
+    assert list(library.entries) == ["b", "a"]
+    assert library.aliases == {"a2": "b", "b": "a"}
+    assert [e.name for e in library.search("风格")] == ["b"]
+    assert [e.name for e in library.search("a2")] == ["b"]
@@ -0,0 +1,49 @@
+import pytest
+
+from main import PromptRouter
+
+
+@pytest.fixture
+def router():
+    return PromptRouter({"手办化": "手办化", "hb": "手办化", "手办": "手办", "赛博城市": "赛博城市"})
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("手办化", ("手办化", "")),
+    ("/手办化", ("手办化", "")),
+    ("  /hb  --new  ", ("手办化", "--new")),
+    ("手办化 可爱 一点", ("手办化", "可爱 一点")),
+    ("手办 x", ("手办", "x")),
+    ("　赛博城市\n夜景", ("赛博城市", "夜景")),
+])
+def test_matches_names_and_aliases(router, text, expected):
+    assert router.match(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "手", "手办化x", "/赛博", "hbx 1", "你好", "/", "   "])
+def test_non_commands(router, text):
+    assert router.match(text) is None
+
+
+def test_first_character_reject_is_counted(router):
+    router.match("你好")
+    router.match("/手办化")
+    assert router.lookups == 2
+    assert router.rejected_first == 1
+    assert router.matches == 1
+    assert router.hits["手办化"] == 1
+
+
+def test_names_with_whitespace_are_skipped():
+    router = PromptRouter({"a b": "a b", "ok": "ok"})
+    assert router.size == 1
+    assert router.match("a b") is None
+
+
+def test_load_swaps_tree_and_keeps_stats(router):
+    router.match("手办化")
+    router.load(PromptRouter.build({"新指令": "新指令"}))
+    assert router.match("手办化") is None
+    assert router.match("/新指令 参数") == ("新指令", "参数")
+    assert router.size == 1
+    assert router.matches == 2
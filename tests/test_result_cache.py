@@ -0,0 +1,59 @@
+import asyncio
+import sqlite3
+
+import main
+from main import ResultCache
+
+URL = "https://cdn.example.com/a.png"
+
+
+def test_key_ignores_case_and_whitespace():
+    assert ResultCache.make_key("m", "  A  cute\ncat ") == ResultCache.make_key("m", "a cute cat")
+    assert ResultCache.make_key("m", "cat") != ResultCache.make_key("other", "cat")
+
+
+def test_memory_entry_expires_after_ttl(clock):
+    cache = ResultCache(ttl=60, max_entries=10)
+    asyncio.run(cache.put("k", URL))
+    clock.advance(59)
+    assert asyncio.run(cache.get("k")) == URL
+    clock.advance(2)
+    assert asyncio.run(cache.get("k")) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_max_entries_evicts_least_recently_used():
+    cache = ResultCache(ttl=60, max_entries=2)
+
+    async def scenario():
+        await cache.put("a", URL)
+        await cache.put("b", URL)
+        await cache.get("a")
+        await cache.put("c", URL)
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == [URL, None, URL]
+
+
+def test_sqlite_tier_survives_restart_and_honours_ttl(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    db_path = tmp_path / "results.db"
+    asyncio.run(ResultCache(ttl=60, max_entries=10, db_path=db_path).put("k", URL))
+
+    restarted = ResultCache(ttl=60, max_entries=10, db_path=db_path)
+    assert asyncio.run(restarted.get("k")) == URL
+    assert restarted.db_hits == 1
+
+    now[0] += 61
+    assert asyncio.run(ResultCache(ttl=60, max_entries=10, db_path=db_path).get("k")) is None
+
+
+def test_sqlite_errors_degrade_to_miss(tmp_path):
+    db_path = tmp_path / "results.db"
+    cache = ResultCache(ttl=60, max_entries=10, db_path=db_path)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DROP TABLE results")
+    asyncio.run(cache.put("k", URL))  # 写磁盘失败只记日志，内存层照常可用
+    assert asyncio.run(cache.get("k")) == URL
+    assert asyncio.run(cache.get("missing")) is None
@@ -0,0 +1,67 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import main
+from main import RetryPolicy
+
+
+@pytest.mark.parametrize("status, has_url, expected", [
+    (200, True, ("ok", False)),
+    (200, False, ("no_url", True)),
+    (429, True, ("rate_limited", True)),
+    (401, True, ("auth_error", False)),
+    (403, True, ("auth_error", False)),
+    (400, True, ("client_error", False)),
+    (413, True, ("client_error", True)),
+    (500, True, ("server_error", True)),
+    (503, True, ("server_error", True)),
+    (501, True, ("server_error", False)),
+])
+def test_classify_status(status, has_url, expected):
+    assert RetryPolicy().classify_status(status, has_url) == expected
+
+
+@pytest.mark.parametrize("exc, expected", [
+    (asyncio.TimeoutError(), ("timeout", True)),
+    (aiohttp.ClientConnectionError(), ("network", True)),
+    (ValueError("bad json"), ("error", False)),
+])
+def test_classify_exception(exc, expected):
+    assert RetryPolicy.classify_exception(exc) == expected
+
+
+def test_backoff_is_capped_full_jitter(monkeypatch):
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: (low, high))
+    assert policy.backoff(0) == (0, 1)
+    assert policy.backoff(3) == (0, 8)
+    assert policy.backoff(10) == (0, 10)
+
+
+def test_attempt_timeout_shrinks_to_remaining_time(clock):
+    policy = RetryPolicy(attempt_timeout=120, deadline=240)
+    assert policy.start_deadline() == clock.now + 240
+    assert policy.attempt_timeout_for(300) == 120
+    assert policy.attempt_timeout_for(45) == 45
+
+
+def test_expired_deadline_stops_before_calling_upstream(run_plugin):
+    async def scenario(plugin):
+        deadline = main.time.monotonic() + plugin.retry_policy.min_attempt_timeout - 1
+        ok, message = await plugin._generate_image("cat", deadline=deadline)
+        assert not ok and "总时限" in message
+        assert plugin.retry_policy.outcomes == {"deadline": 1}
+
+    run_plugin(scenario)
+
+
+def test_network_errors_are_retried_up_to_max_attempts(run_plugin):
+    async def scenario(plugin):
+        ok, _ = await plugin._generate_image("cat")
+        assert not ok
+        assert plugin.retry_policy.outcomes["network"] == 3
+
+    # api_url 指向不监听的端口：每次都是连接失败
+    run_plugin(scenario, retry={"max_attempts": 3, "base_delay": 0, "max_delay": 0})
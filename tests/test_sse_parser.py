@@ -0,0 +1,72 @@
+import json
+
+from main import SSEStreamParser
+
+
+def event(content: str) -> bytes:
+    return f"data: {json.dumps({'choices': [{'delta': {'content': content}}]}, ensure_ascii=False)}\n\n".encode()
+
+
+def test_line_split_across_reads():
+    parser = SSEStreamParser()
+    raw = event("你好，世界")
+    cut = raw.index("世".encode()) + 1  # 从一个多字节字符中间切开
+    assert parser.feed(raw[:cut]) == ""
+    assert parser.feed(raw[cut:]) == "你好，世界"
+    assert parser.content == "你好，世界"
+
+
+def test_byte_by_byte_feed():
+    parser = SSEStreamParser()
+    raw = event("a") + event("b") + b"data: [DONE]\n\n"
+    added = "".join(parser.feed(raw[i:i + 1]) for i in range(len(raw)))
+    assert added == "ab"
+    assert parser.done
+
+
+def test_multi_line_event_is_joined_before_parsing():
+    parser = SSEStreamParser()
+    raw = b'data: {"choices":\ndata: [{"delta": {"content": "x"}}]}\n\n'
+    assert parser.feed(raw) == "x"
+    assert parser.bad_chunks == 0
+
+
+def test_json_per_line_without_blank_separator():
+    parser = SSEStreamParser()
+    raw = event("a").rstrip(b"\n") + b"\n" + event("b").rstrip(b"\n") + b"\n\n"
+    assert parser.feed(raw) == "ab"
+
+
+def test_bad_chunk_is_skipped_and_counted():
+    parser = SSEStreamParser()
+    raw = b"data: {not json\n\n" + event("ok") + b'data: [1, 2]\n\ndata: {"choices": "x"}\n\n'
+    assert parser.feed(raw) == "ok"
+    assert parser.bad_chunks == 1
+    assert parser.content == "ok"
+
+
+def test_comments_crlf_and_other_fields_are_ignored():
+    parser = SSEStreamParser()
+    raw = b": keep-alive\r\nevent: message\r\nid: 1\r\n" + event("x").replace(b"\n", b"\r\n")
+    assert parser.feed(raw) == "x"
+
+
+def test_close_flushes_trailing_line_without_newline():
+    parser = SSEStreamParser()
+    assert parser.feed(event("a").rstrip(b"\n")) == ""
+    assert parser.close() == "a"
+
+
+def test_image_url_only_after_closing_paren():
+    parser = SSEStreamParser()
+    parser.feed(event("![img](https://cdn.example.com/a.png"))
+    assert parser.find_image_url() == ""
+    parser.feed(event(")"))
+    assert parser.find_image_url() == "https://cdn.example.com/a.png"
+
+
+def test_bare_url_only_when_final():
+    parser = SSEStreamParser()
+    parser.feed(event("生成完成 https://cdn.example.com/b.png"))
+    assert parser.find_image_url() == ""
+    assert parser.find_image_url(final=True) == "https://cdn.example.com/b.png"